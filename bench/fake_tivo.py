@@ -0,0 +1,216 @@
+""" A fake TiVo, serving a made-up Now Playing List over HTTP.
+
+    It answers QueryContainer for /NowPlaying the way a TiVo does: at
+    most 50 items a page, with AnchorOffset, ItemCount and Recurse, and
+    TotalItems and LastChangeDate in the details. It asks for digest
+    auth (user "tivo", the MAK as the password), keeps connections
+    alive, and can add a delay to each request and to each new
+    connection, standing in for a TiVo's slow web server and TLS
+    handshake, and answer some requests with 503, as a busy TiVo does.
+
+    Used by the benchmarks, or run on its own:
+
+    usage: python bench/fake_tivo.py [-p port] [-n shows] [-m mak]
+                                     [-d delay] [-c connect_delay]
+                                     [-b busy]
+
+    Delays are in seconds; busy is the fraction of requests answered
+    with 503.
+
+"""
+
+import getopt
+import hashlib
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+NS = 'http://www.tivo.com/developer/calypso-protocol-1.6/'
+REALM = 'TiVo DVR'
+PAGE = 50
+
+def make_shows(count, seed=0):
+    """ count made-up recordings, as dicts of their NPL details. """
+    rand = random.Random(seed)
+    shows = []
+    for i in range(count):
+        series = rand.randrange(max(count // 8, 1))
+        shows.append({
+            'Title': 'Series %d' % series,
+            'EpisodeTitle': 'Episode %d' % i,
+            'Description': 'Something happens in episode %d. Copyright '
+                           'Tribune Media Services, Inc.' % i,
+            'SeriesId': 'SH%06d' % series,
+            'ProgramId': 'EP%06d%04d' % (series, i),
+            'CaptureDate': '0x%X' % (1500000000 + i * 3600),
+            'Duration': str(rand.randrange(15, 180) * 60000),
+            'SourceSize': str(rand.randrange(1, 80) * 100 * 1024 ** 2),
+            'SourceChannel': str(rand.randrange(2, 999)),
+            'SourceStation': 'STN%d' % rand.randrange(100),
+            'InProgress': 'Yes' if i == 0 else '',
+            'id': str(1000 + i)})
+    return shows
+
+def item_xml(show, host):
+    details = ''.join('<%s>%s</%s>' % (key, escape(show[key]), key)
+                      for key in ('Title', 'EpisodeTitle', 'Description',
+                                  'SeriesId', 'ProgramId', 'CaptureDate',
+                                  'Duration', 'SourceSize', 'SourceChannel',
+                                  'SourceStation', 'InProgress')
+                      if show[key])
+    return ('<Item><Details><ContentType>video/x-tivo-raw-tts</ContentType>'
+            '<SourceFormat>video/x-tivo-raw-tts</SourceFormat>%s</Details>'
+            '<Links><Content><Url>http://%s/download/%s.TiVo?Container='
+            '%%2FNowPlaying&amp;id=%s</Url><ContentType>video/x-tivo-raw-tts'
+            '</ContentType></Content><CustomIcon><Url>urn:tivo:image:'
+            'save-until-i-delete-recording</Url></CustomIcon>'
+            '<TiVoVideoDetails><Url>https://%s/TiVoVideoDetails?id=%s</Url>'
+            '</TiVoVideoDetails></Links></Item>' %
+            (details, host, escape(show['Title']).replace(' ', '%20'),
+             show['id'], host, show['id']))
+
+def page_xml(shows, start, count, host, last_change):
+    items = shows[start:start + count]
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<TiVoContainer xmlns="%s"><Details><ContentType>'
+            'x-tivo-container/tivo-videos</ContentType><Title>Now Playing'
+            '</Title><LastChangeDate>%s</LastChangeDate><TotalItems>%d'
+            '</TotalItems></Details><SortOrder>Type,CaptureDate</SortOrder>'
+            '<ItemStart>%d</ItemStart><ItemCount>%d</ItemCount>%s'
+            '</TiVoContainer>' %
+            (NS, last_change, len(shows), start, len(items),
+             ''.join(item_xml(show, host) for show in items)))
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Digest '):
+            return False
+        params = dict((k, v.strip('"')) for k, v in
+                      re.findall(r'(\w+)=("[^"]*"|[^,\s]*)', auth[7:]))
+        if params.get('nonce') not in self.server.nonces:
+            return False
+        md5 = lambda s: hashlib.md5(s.encode('utf-8')).hexdigest()
+        ha1 = md5('tivo:%s:%s' % (REALM, self.server.mak))
+        ha2 = md5('GET:' + params.get('uri', ''))
+        expect = md5(':'.join((ha1, params['nonce'], params.get('nc', ''),
+                               params.get('cnonce', ''),
+                               params.get('qop', ''), ha2)))
+        return (params.get('response') == expect and
+                params.get('uri') == self.path)
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        if server.delay:
+            time.sleep(server.delay)
+        if not self.authorized():
+            server.count('challenges')
+            nonce = hashlib.md5(os.urandom(16)).hexdigest()
+            server.nonces.add(nonce)
+            self.reply(401, b'', [('WWW-Authenticate',
+                                   'Digest realm="%s", nonce="%s", '
+                                   'qop="auth"' % (REALM, nonce))])
+            return
+        if server.busy and server.rand.random() < server.busy:
+            server.count('busy')
+            self.reply(503)
+            return
+        query = parse_qs(urlsplit(self.path).query)
+        if query.get('Command') != ['QueryContainer']:
+            self.reply(404)
+            return
+        try:
+            start = int(query.get('AnchorOffset', ['0'])[0])
+            count = min(int(query.get('ItemCount', [PAGE])[0]), PAGE)
+        except ValueError:
+            self.reply(400)
+            return
+        server.count('pages')
+        body = page_xml(server.shows, start, count, self.headers['Host'],
+                        server.last_change).encode('utf-8')
+        self.reply(200, body, [('Content-Type', 'text/xml')])
+
+class FakeTiVo(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, shows=1500, mak='0123456789', delay=0.0,
+                 connect_delay=0.0, busy=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.shows = make_shows(shows)
+        self.mak = mak
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.busy = busy
+        self.rand = random.Random(1)
+        self.last_change = '0x%X' % int(time.time())
+        self.nonces = set()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        return ('http://127.0.0.1:%d/TiVoConnect?Command=QueryContainer'
+                '&Container=%%2FNowPlaying' % self.server_address[1])
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='fake_tivo')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'p:n:m:d:c:b:')
+    kwargs = {'port': 8080}
+    names = {'-p': ('port', int), '-n': ('shows', int), '-m': ('mak', str),
+             '-d': ('delay', float), '-c': ('connect_delay', float),
+             '-b': ('busy', float)}
+    for opt, value in opts:
+        name, kind = names[opt]
+        kwargs[name] = kind(value)
+    server = FakeTiVo(**kwargs)
+    print('Serving %d shows at %s' % (len(server.shows), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,120 @@
+""" Compare fetching a Now Playing List serially and over the pool.
+
+    Starts a fake TiVo (bench/fake_tivo.py) and fetches its whole NPL
+    twice: page after page with urllib, a new connection and a digest
+    challenge for each, as ToGo used to; and with nplfetch, the first
+    page and then the rest at once over kept-alive connections. Reports
+    the time, requests and connections each took, and whether both got
+    the same shows in the same order.
+
+    usage: python bench/npl_fetch.py [-n shows] [-d delay]
+                                     [-c connect_delay] [-b busy]
+                                     [-k connections]
+
+    The delays (in seconds) are added by the fake TiVo to each request
+    and each new connection; busy is the fraction of requests it turns
+    away with 503. nplfetch waits BUSY_WAIT seconds after each of those,
+    so -b makes for a slow run.
+
+"""
+
+import getopt
+import os
+import re
+import sys
+import time
+import urllib.request
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH), 'plugins', 'togo'))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+import fake_tivo
+import nplfetch
+
+MAK = '0123456789'
+
+def urls(body):
+    # Just the path; each run has its own server, on its own port
+    return re.findall(r'<Content><Url>http://[^/]*([^<]*)</Url>',
+                      body.decode('utf-8'))
+
+def serial(server):
+    auth = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+    auth.add_password(fake_tivo.REALM, server.url, 'tivo', MAK)
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPDigestAuthHandler(auth))
+
+    def get(url):
+        while True:
+            try:
+                with opener.open(url) as page:
+                    return page.read()
+            except urllib.request.HTTPError as e:
+                if e.code != 503:
+                    raise
+                time.sleep(nplfetch.BUSY_WAIT)
+
+    first = get(server.url + '&Recurse=Yes&ItemCount=0')
+    total = int(re.search(rb'<TotalItems>(\d+)<', first).group(1))
+    shows = []
+    while len(shows) < total:
+        page = urls(get(server.url + '&Recurse=Yes&ItemCount=50'
+                        '&AnchorOffset=%d' % len(shows)))
+        if not page:
+            break
+        shows += page
+    return shows
+
+def pooled(server, size):
+    pool = nplfetch.Pool(server.url, MAK, size)
+    url = server.url + '&Recurse=Yes'
+    first = pool.get(url + '&ItemCount=%d' % nplfetch.PAGE)
+    total = int(re.search(rb'<TotalItems>(\d+)<', first).group(1))
+    shows = urls(first)
+    for page in nplfetch.fetch_pages(pool, url, total):
+        shows += urls(page)
+    pool.close()
+    return shows
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'n:d:c:b:k:')
+    shows = 1500
+    delay = 0.02
+    connect_delay = 0.05
+    busy = 0.0
+    size = 3
+    for opt, value in opts:
+        if opt == '-n':
+            shows = int(value)
+        elif opt == '-d':
+            delay = float(value)
+        elif opt == '-c':
+            connect_delay = float(value)
+        elif opt == '-b':
+            busy = float(value)
+        elif opt == '-k':
+            size = max(int(value), 1)
+
+    results = []
+    print('%-10s %10s %10s %12s' % ('', 'seconds', 'requests',
+                                    'connections'))
+    for name, fetch in (('serial', serial),
+                        ('pooled', lambda s: pooled(s, size))):
+        server = fake_tivo.FakeTiVo(shows=shows, mak=MAK, delay=delay,
+                                    connect_delay=connect_delay,
+                                    busy=busy).start()
+        start = time.time()
+        results.append(fetch(server))
+        taken = time.time() - start
+        server.stop()
+        print('%-10s %10.2f %10d %12d' % (name, taken,
+                                          server.stats.get('requests', 0),
+                                          server.stats.get('connections', 0)))
+    print('\n%d shows; lists %s' % (len(results[0]),
+                                    'match' if results[0] == results[1]
+                                    else 'DIFFER'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,145 @@
+""" Compare the ffprobe and ffmpeg probe backends of video_info.
+
+    Generates short synthetic clips with ffmpeg's lavfi sources, then
+    probes each one with both backends, reporting the wall time of the
+    probe command and the CPU time spent parsing its output, plus any
+    vInfo keys on which the two backends disagree.
+
+    usage: python bench/probe_backends.py [-c config] [-n runs] [-k]
+
+    Run from the pyTivo directory. -k keeps the generated clips.
+
+    The parsers are transcode's own, from plugins/video/probeparse.py.
+    transcode itself doesn't import under Python 3, so the probes are
+    run directly, without the ffmpeg slot scheduler or ffmpeg_wait.
+
+"""
+
+import getopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'plugins', 'video'))
+sys.path.insert(0, ROOT)
+
+import config
+import probeparse
+
+# name, extension, ffmpeg output options
+CLIPS = [
+    ('mpeg2/mp2', '.mpg', ['-c:v', 'mpeg2video', '-c:a', 'mp2',
+                           '-f', 'vob']),
+    ('mpeg4/aac', '.mp4', ['-c:v', 'mpeg4', '-c:a', 'aac']),
+    ('mpeg2/ac3 5.1 ts', '.ts', ['-c:v', 'mpeg2video', '-c:a', 'ac3',
+                                 '-ac', '6', '-f', 'mpegts']),
+    ('mpeg4/ac3+mp3 mkv', '.mkv', ['-map', '0:v', '-map', '1:a',
+                                   '-map', '1:a', '-c:v', 'mpeg4',
+                                   '-c:a:0', 'ac3', '-c:a:1', 'mp3',
+                                   '-metadata:s:a:0', 'language=eng',
+                                   '-metadata:s:a:1', 'language=spa',
+                                   '-metadata', 'title=Synthetic']),
+]
+
+PARSE_LOOPS = 200
+
+def run_probe(cmd, use_stdout=False):
+    """ What cmd writes to stderr, or stdout if use_stdout, as text. """
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    output = proc.stdout if use_stdout else proc.stderr
+    return output.decode('utf-8', 'replace')
+
+def make_clips(ffmpeg, dest):
+    clips = []
+    for name, ext, opts in CLIPS:
+        path = os.path.join(dest, name.replace('/', '_').replace(' ', '_') +
+                            ext)
+        cmd = [ffmpeg, '-v', 'error', '-y',
+               '-f', 'lavfi', '-i', 'testsrc=size=720x480:rate=30000/1001',
+               '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+               '-t', '10'] + opts + [path]
+        if subprocess.call(cmd) == 0:
+            clips.append((name, path))
+        else:
+            print('could not generate %s, skipping' % name)
+    return clips
+
+def cpu_time(func, output):
+    start = time.process_time()
+    for i in range(PARSE_LOOPS):
+        func(output)
+    return (time.process_time() - start) / PARSE_LOOPS
+
+def bench(name, path, runs):
+    ffmpeg_cmd = [config.get_bin('ffmpeg'), '-i', path]
+    ffprobe_cmd = [config.get_bin('ffprobe'), '-v', 'error',
+                   '-print_format', 'json', '-show_streams', '-show_format',
+                   path]
+
+    results = {}
+    for backend, cmd, use_stdout, parse in (
+            ('ffmpeg', ffmpeg_cmd, False, probeparse.parse_ffmpeg),
+            ('ffprobe', ffprobe_cmd, True,
+             lambda x: probeparse.parse_ffprobe(json.loads(x)))):
+        wall = []
+        for i in range(runs):
+            start = time.time()
+            output = run_probe(cmd, use_stdout)
+            wall.append(time.time() - start)
+        wall.sort()
+        results[backend] = (wall[len(wall) // 2], cpu_time(parse, output),
+                            parse(output))
+
+    print('%-20s %10.1f %10.3f %10.1f %10.3f' %
+          (name, results['ffmpeg'][0] * 1000, results['ffmpeg'][1] * 1000,
+           results['ffprobe'][0] * 1000, results['ffprobe'][1] * 1000))
+
+    old, new = results['ffmpeg'][2], results['ffprobe'][2]
+    for key in sorted(set(old) | set(new)):
+        if key != 'rawmeta' and old.get(key) != new.get(key):
+            print('    %-10s ffmpeg=%r ffprobe=%r' %
+                  (key, old.get(key), new.get(key)))
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'c:n:k', ['config='])
+    runs = 10
+    keep = False
+    conf = []
+    for opt, value in opts:
+        if opt in ('-c', '--config'):
+            conf = [opt, value]
+        elif opt == '-n':
+            runs = max(int(value), 1)
+        elif opt == '-k':
+            keep = True
+    config.init(conf)
+
+    ffmpeg = config.get_bin('ffmpeg')
+    if not ffmpeg or not config.get_bin('ffprobe'):
+        print('ffmpeg and ffprobe are both needed')
+        return 1
+
+    dest = tempfile.mkdtemp(prefix='pytivo-probe-')
+    try:
+        clips = make_clips(ffmpeg, dest)
+        print('%d runs per backend, median probe wall time, parse CPU '
+              'per call\n' % runs)
+        print('%-20s %10s %10s %10s %10s' % ('clip', 'ffmpeg ms', 'parse ms',
+                                             'ffprobe ms', 'parse ms'))
+        for name, path in clips:
+            bench(name, path, runs)
+    finally:
+        if keep:
+            print('\nclips kept in %s' % dest)
+        else:
+            shutil.rmtree(dest)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,140 @@
+""" Compare segmented, parallel encoding with a single ffmpeg.
+
+    Generates a 1080p source with ffmpeg's lavfi sources, then encodes it
+    to MPEG-2 for an HD TiVo, once with a single ffmpeg and once cut at
+    keyframes into one piece per worker, with the pieces encoded at the
+    same time and joined. Reports the wall time of each, the speedup,
+    and the duration of both outputs.
+
+    usage: python bench/segmented_encode.py [-c config] [-w workers]
+                                            [-t seconds] [-f ps|ts] [-k]
+
+    Run from the pyTivo directory. -w defaults to the number of cores,
+    -t (length of the source) to 120. -k keeps the generated files.
+
+"""
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import scheduler
+from plugins.video import segmented
+
+# Roughly what transcode.select_settings() gives an HD TiVo
+SETTINGS = ['-bufsize', '4096k', '-c:v', 'mpeg2video', '-b:v', '16384k',
+            '-maxrate', '30000k', '-r', '29.97', '-c:a', 'ac3',
+            '-b:a', '448k', '-ar', '48000', '-ac', '2']
+
+FORMATS = {'ps': ['-f', 'vob'], 'ts': ['-f', 'mpegts']}
+
+def make_source(ffmpeg, path, seconds):
+    cmd = [ffmpeg, '-v', 'error', '-y',
+           '-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=30000/1001',
+           '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+           '-t', str(seconds), '-c:v', 'mpeg4', '-q:v', '4', '-g', '60',
+           '-c:a', 'aac', path]
+    return subprocess.call(cmd) == 0
+
+def duration(path):
+    ffprobe = config.get_bin('ffprobe')
+    if not ffprobe:
+        return 0.0
+    try:
+        output = subprocess.check_output([ffprobe, '-v', 'error',
+            '-show_entries', 'format=duration', '-of', 'csv=p=0', path])
+        return float(output)
+    except (subprocess.CalledProcessError, ValueError):
+        return 0.0
+
+def single(source, settings, dest):
+    start = time.time()
+    cmd = segmented.command(source, settings, 0, None, dest)
+    if subprocess.call(cmd) != 0:
+        return None
+    return time.time() - start
+
+def parallel(source, settings, dest, workers, seconds):
+    start = time.time()
+    keys = segmented.keyframes(source)
+    cuts = segmented.plan_cuts(keys, seconds, float(seconds) / workers)
+    probe = time.time() - start
+    pieces = [dest + '.%03d' % i for i in range(len(cuts))]
+    if not segmented.encode(source, settings, cuts, pieces, workers):
+        return None
+    with open(dest, 'wb') as out:
+        segmented.join(pieces, out.write)
+    for piece in pieces:
+        os.remove(piece)
+    return time.time() - start, probe, len(cuts)
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'c:w:t:f:k', ['config='])
+    workers = scheduler.cpu_count()
+    seconds = 120
+    fmt = 'ps'
+    keep = False
+    conf = []
+    for opt, value in opts:
+        if opt in ('-c', '--config'):
+            conf = [opt, value]
+        elif opt == '-w':
+            workers = max(int(value), 1)
+        elif opt == '-t':
+            seconds = max(int(value), 1)
+        elif opt == '-f' and value in FORMATS:
+            fmt = value
+        elif opt == '-k':
+            keep = True
+    config.init(conf)
+
+    ffmpeg = config.get_bin('ffmpeg')
+    if not ffmpeg:
+        print('ffmpeg is needed')
+        return 1
+    if not config.get_bin('ffprobe'):
+        print('no ffprobe: cuts will not be on keyframes')
+
+    dest = tempfile.mkdtemp(prefix='pytivo-segmented-')
+    try:
+        source = os.path.join(dest, 'source.mkv')
+        if not make_source(ffmpeg, source, seconds):
+            print('could not generate the source')
+            return 1
+        settings = SETTINGS + FORMATS[fmt] + ['-']
+        ext = '.' + fmt
+
+        print('%ds 1080p source, %s output, %d cores, %d workers\n' %
+              (seconds, fmt, scheduler.cpu_count(), workers))
+        one = single(source, settings, os.path.join(dest, 'single' + ext))
+        many = parallel(source, settings,
+                        os.path.join(dest, 'parallel' + ext), workers, seconds)
+        if one is None or many is None:
+            print('encode failed')
+            return 1
+        wall, probe, count = many
+
+        print('%-10s %10s %10s %12s' %
+              ('', 'wall s', 'x realtime', 'duration s'))
+        for name, taken in (('single', one), ('parallel', wall)):
+            out = os.path.join(dest, name + ext)
+            print('%-10s %10.2f %10.2f %12.2f' %
+                  (name, taken, seconds / taken, duration(out)))
+        print('\n%d pieces, keyframe scan %.2fs, speedup %.2fx' %
+              (count, probe, one / wall))
+    finally:
+        if keep:
+            print('\nfiles kept in %s' % dest)
+        else:
+            shutil.rmtree(dest)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+""" Compare decrypting a .tivo file in pyTivo with tivodecode/tivolibre.
+
+    Decrypts the same program stream .tivo file with tivodecoder.decode()
+    and with each external decoder found, and reports the throughput of
+    each, in megabytes of input a second, and whether the outputs match.
+
+    usage: python bench/tivo_decrypt.py [-c config] [-m mak] [-s MB]
+                                        file.tivo
+
+    Run from the pyTivo directory. The MAK comes from tivo_mak in the
+    config unless given with -m. -s stops each decoder after that many
+    megabytes of output; the default is the whole file.
+
+"""
+
+import getopt
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import tivodecoder
+
+BLOCKSIZE = 512 * 1024
+
+def consume(read, limit):
+    """ Read until EOF or limit bytes; the digest and size. """
+    digest = hashlib.md5()
+    size = 0
+    while limit is None or size < limit:
+        block = read()
+        if not block:
+            break
+        if limit is not None:
+            block = block[:limit - size]
+        digest.update(block)
+        size += len(block)
+    return digest.hexdigest(), size
+
+def python(path, mak, limit):
+    with open(path, 'rb') as f:
+        blocks = tivodecoder.decode(f, mak)
+        start = time.time()
+        result = consume(lambda: next(blocks, b''), limit)
+        taken = time.time() - start
+        blocks.close()
+    return result + (taken,)
+
+def external(cmd, limit):
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, bufsize=BLOCKSIZE)
+    result = consume(lambda: proc.stdout.read(BLOCKSIZE), limit)
+    taken = time.time() - start
+    proc.kill()
+    proc.communicate()
+    return result + (taken,)
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'c:m:s:', ['config='])
+    conf = []
+    mak = None
+    limit = None
+    for opt, value in opts:
+        if opt in ('-c', '--config'):
+            conf = [opt, value]
+        elif opt == '-m':
+            mak = value
+        elif opt == '-s':
+            limit = int(float(value) * 1024 ** 2)
+    if len(args) != 1:
+        print(__doc__)
+        return 1
+    config.init(conf)
+    path = args[0]
+    mak = mak or config.get_server('tivo_mak')
+    if not mak:
+        print('no MAK; set tivo_mak or use -m')
+        return 1
+    if tivodecoder.is_ts_file(path):
+        print('%s is a transport stream; only program streams are '
+              'decrypted in pyTivo' % path)
+        return 1
+
+    runs = [('python', None)]
+    tivodecode = config.get_bin('tivodecode')
+    if tivodecode:
+        runs.append(('tivodecode', [tivodecode, '-m', mak, path]))
+    tivolibre = config.get_bin('tivolibre')
+    if tivolibre:
+        runs.append(('tivolibre', [tivolibre, '-m', mak, '-i', path]))
+
+    print('%-12s %10s %10s %12s %s' % ('', 'MB', 'seconds', 'MB/s', 'md5'))
+    digests = set()
+    for name, cmd in runs:
+        if cmd:
+            digest, size, taken = external(cmd, limit)
+        else:
+            digest, size, taken = python(path, mak, limit)
+        digests.add(digest)
+        print('%-12s %10.1f %10.2f %12.2f %s' %
+              (name, size / 1024.0 ** 2, taken,
+               size / 1024.0 ** 2 / max(taken, 1e-9), digest))
+    if len(runs) > 1:
+        print('\noutputs %s' % ('match' if len(digests) == 1 else 'DIFFER'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
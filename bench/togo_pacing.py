@@ -0,0 +1,136 @@
+""" Compare fixed and adaptive pacing of a ToGo download.
+
+    Simulates downloading a .ts recording over a link that drops
+    packets when it's read faster than it can keep up with: each read
+    paced with less than the link's sleep risks sync or continuity
+    errors, more so the faster it goes. The clock is simulated, so this
+    runs in a moment.
+
+    Both paces follow the same rule for errors. With togo_ts_error_mode
+    "retry" (the default here), a download with errors is done again,
+    with 0.01 s more sleep (togo_slow_on_retry), up to the retry limit;
+    with "ignore", it's kept as it is. The fixed pace is what ToGo did
+    before: a sleep set by togo_download_speed. The adaptive pace is
+    pacing.Pacer, as ToGo sets it up: for a TiVo seen for the first
+    time, and again for its next download, starting from the pace
+    remembered from the first. A retry starts where the last try left
+    off.
+
+    usage: python bench/togo_pacing.py [-s size_mb] [-l link_delay]
+                                       [-r link_rate] [-t retries]
+                                       [-m retry|ignore]
+
+    link_delay is the sleep per read, in seconds, below which the link
+    makes errors; link_rate is its speed, in MB/s, with no sleep.
+
+"""
+
+import getopt
+import os
+import random
+import sys
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH), 'plugins', 'togo'))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+import pacing
+
+CHUNK = 282000      # as read by ToGo
+
+class Link(object):
+    def __init__(self, delay, rate, seed=1):
+        self.delay = delay
+        self.rate = rate * 1024 * 1024
+        self.rand = random.Random(seed)
+
+    def read(self, sleep):
+        """ Seconds to read a chunk, and the errors in it. """
+        errors = 0
+        if sleep < self.delay:
+            if self.rand.random() < (self.delay - sleep) / self.delay / 2:
+                errors = 1
+        return CHUNK / self.rate, errors
+
+def download(link, size, sleep, pacer=None):
+    """ Returns the seconds taken and the errors made. """
+    now = 0.0
+    errors = 0
+    for i in range(size // CHUNK + 1):
+        taken, found = link.read(sleep)
+        now += taken
+        errors += found
+        if pacer:
+            sleep = pacer.record(CHUNK, found, now)
+        now += sleep
+    return now, errors
+
+def fixed(link, size, retries, mode):
+    total = 0.0
+    sleep = 0.0
+    for attempt in range(retries + 1):
+        taken, errors = download(link, size, sleep)
+        total += taken
+        if not errors or mode == 'ignore':
+            break
+        sleep += 0.01
+    return total, errors, attempt + 1
+
+def adaptive(link, size, retries, mode, sleep=0.0):
+    """ As fixed(), but paced the way ToGo paces a .ts download. Also
+        returns the pace to remember.
+
+    """
+    total = 0.0
+    for attempt in range(retries + 1):
+        floor = 0.0
+        if mode != 'ignore':
+            floor = sleep
+        pacer = pacing.Pacer(sleep, floor)
+        taken, errors = download(link, size, sleep, pacer)
+        total += taken
+        if not errors or mode == 'ignore':
+            break
+        sleep = pacer.best_delay() or pacer.delay
+    return total, errors, attempt + 1, pacer.best_delay() or sleep
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 's:l:r:t:m:')
+    size = 2000
+    link_delay = 0.03
+    link_rate = 12.0
+    retries = 3
+    mode = 'retry'
+    for opt, value in opts:
+        if opt == '-s':
+            size = int(value)
+        elif opt == '-l':
+            link_delay = float(value)
+        elif opt == '-r':
+            link_rate = float(value)
+        elif opt == '-t':
+            retries = int(value)
+        elif opt == '-m':
+            mode = value
+    size *= 1024 * 1024
+
+    print('%-16s %10s %8s %10s %8s' % ('', 'seconds', 'MB/s', 'downloads',
+                                       'errors'))
+    def report(name, taken, errors, tries):
+        print('%-16s %10.1f %8.2f %10d %8d' %
+              (name, taken, size / taken / 1024 ** 2, tries, errors))
+
+    report('fixed', *fixed(Link(link_delay, link_rate), size, retries,
+                           mode))
+    taken, errors, tries, start = adaptive(Link(link_delay, link_rate),
+                                           size, retries, mode)
+    report('adaptive, first', taken, errors, tries)
+    taken, errors, tries, last = adaptive(Link(link_delay, link_rate, 2),
+                                          size, retries, mode, start)
+    report('adaptive, next', taken, errors, tries)
+    print('\nremembered pace %.4f s; link needs %.4f s' %
+          (start, link_delay))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,98 @@
+""" Compare the ToGo transport stream check with the old sync loop.
+
+    Builds a clean transport stream in memory, then checks it in ToGo's
+    282000-byte chunks four ways: the old struct.unpack_from() loop
+    over each packet's sync byte, and tscheck without NumPy, both its
+    quick check ("runs") and packet by packet ("slices", as for a chunk
+    with errors), and with NumPy (if installed). Reports the throughput
+    of each.
+
+    usage: python bench/ts_check.py [-s MB]
+
+    -s is the size of the stream, 200 MB by default.
+
+"""
+
+import getopt
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'plugins', 'togo'))
+
+import tscheck
+
+CHUNK = 282000
+
+def make_stream(size):
+    """ Video, audio and null packets, with a PCR every 20. """
+    packets = []
+    counters = {}
+    pcr = 0
+    for i in range(size // tscheck.PACKET):
+        pid = (0x100, 0x101, 0x100, 0x1fff)[i % 4]
+        cc = counters[pid] = (counters.get(pid, -1) + 1) & 0x0f
+        if i % 20 == 0:
+            pcr += 540000
+            base = pcr // 300
+            head = bytearray([0x47, 0x41, 0x00, 0x30 | cc, 7, 0x10,
+                              (base >> 25) & 0xff, (base >> 17) & 0xff,
+                              (base >> 9) & 0xff, (base >> 1) & 0xff,
+                              ((base & 1) << 7) | 0x7e, 0])
+        else:
+            head = bytearray([0x47, 0x40 | (pid >> 8), pid & 0xff,
+                              0x10 | cc])
+        packets.append(bytes(head) + b'\xff' * (tscheck.PACKET - len(head)))
+    return b''.join(packets)
+
+def old_loop(data):
+    errors = 0
+    for p in range(0, len(data), CHUNK):
+        output = data[p:p + CHUNK]
+        cur_byte = 0
+        while cur_byte < len(output):
+            if struct.unpack_from('>B', output, cur_byte)[0] != 0x47:
+                errors += 1
+            cur_byte += 188
+    return errors
+
+def checker(data):
+    check = tscheck.TSChecker()
+    for p in range(0, len(data), CHUNK):
+        check.feed(data[p:p + CHUNK])
+    check.finish()
+    return check.errors
+
+def timed(func, data):
+    start = time.time()
+    errors = func(data)
+    return len(data) / max(time.time() - start, 1e-9) / 1024 ** 2, errors
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 's:')
+    size = 200
+    for opt, value in opts:
+        if opt == '-s':
+            size = max(int(value), 1)
+    data = make_stream(size * 1024 ** 2)
+    numpy = tscheck.numpy
+
+    print('%-10s %10s %8s' % ('', 'MB/s', 'errors'))
+    print('%-10s %10.1f %8d' % (('old',) + timed(old_loop, data)))
+    tscheck.numpy = None
+    print('%-10s %10.1f %8d' % (('runs',) + timed(checker, data)))
+    scan_runs = tscheck.TSChecker._scan_runs
+    tscheck.TSChecker._scan_runs = lambda self, data, p, n: None
+    print('%-10s %10.1f %8d' % (('slices',) + timed(checker, data)))
+    tscheck.TSChecker._scan_runs = scan_runs
+    tscheck.numpy = numpy
+    if numpy is not None:
+        print('%-10s %10.1f %8d' % (('numpy',) + timed(checker, data)))
+    else:
+        print('numpy      not available')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,68 @@
+""" Compare the Turing and SimpleTuring keystream generators.
+
+    Decrypts random buffers of several sizes with both classes, from the
+    same key and IV, checks that the output is identical, and reports
+    the throughput of each and the speedup.
+
+    usage: python bench/turing_keystream.py [-n runs] [-s size,...]
+
+    Sizes are in bytes; the default covers a .tivo details chunk up to
+    a megabyte of stream.
+
+"""
+
+import getopt
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import turing
+
+SIZES = [2048, 16384, 131072, 1048576]
+
+def throughput(cls, key, iv, data, skip, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        output = cls(key, iv).crypt(data, skip)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return len(data) / max(best, 1e-9) / 1024 ** 2, output
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'n:s:')
+    runs = 3
+    sizes = SIZES
+    for opt, value in opts:
+        if opt == '-n':
+            runs = max(int(value), 1)
+        elif opt == '-s':
+            sizes = [int(x) for x in value.split(',')]
+
+    # Keyed the way metadata._tdcat_py keys it
+    key = hashlib.sha1(os.urandom(20)).digest()[:16] + b'\0\0\0\0'
+    turkey = hashlib.sha1(key[:17]).digest()
+    turiv = hashlib.sha1(key).digest()
+
+    print('NumPy: %s, best of %d runs\n' %
+          (turing.numpy and turing.numpy.__version__ or 'not available',
+           runs))
+    print('%10s %14s %14s %9s %s' % ('bytes', 'simple MB/s', 'fast MB/s',
+                                     'speedup', 'same'))
+    for size in sizes:
+        data = os.urandom(size)
+        skip = 1536
+        slow, expected = throughput(turing.SimpleTuring, turkey, turiv,
+                                    data, skip, runs)
+        fast, output = throughput(turing.Turing, turkey, turiv, data,
+                                  skip, runs)
+        print('%10d %14.2f %14.2f %8.1fx %s' %
+              (size, slow, fast, fast / slow, output == expected))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -63,13 +63,19 @@ def init(argv, in_service=False):
 
     reset()
 
+# Bumped whenever the settings may have changed, so anything worked out
+# from them knows to start over
+generation = 0
+
 def reset():
     global bin_paths
     global config
     global configs_found
     global tivos_found
+    global generation
 
     bin_paths = {}
+    generation += 1
 
     config = ConfigParser.ConfigParser()
     configs_found = config.read(config_files)
@@ -90,6 +96,9 @@ def reset():
             config.add_section(section)
 
 def write():
+    global generation
+    generation += 1
+
     if not os.path.isdir(os.path.dirname(configs_found[-1])):
         os.mkdir(os.path.dirname(configs_found[-1]))
 
@@ -277,6 +286,204 @@ def getFFmpegWait():
     else:
         return 0
 
+def getPoolThreads():
+    try:
+        return max(int(get_server('pool_threads', 0)), 0)
+    except ValueError:
+        return 0
+
+def getPoolStreamThreads():
+    try:
+        return max(int(get_server('pool_stream_threads', 4)), 1)
+    except ValueError:
+        return 4
+
+def getPoolQueue():
+    try:
+        return max(int(get_server('pool_queue', 16)), 1)
+    except ValueError:
+        return 16
+
+def getPoolRetryAfter():
+    try:
+        return max(int(get_server('pool_retry_after', 5)), 1)
+    except ValueError:
+        return 5
+
+def getCacheDir():
+    path = get_server('cache_dir', '')
+    if not path:
+        path = os.path.dirname(os.path.abspath(configs_found[-1]))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def getProbeCache():
+    try:
+        return config.getboolean('Server', 'probe_cache')
+    except:
+        return True
+
+def getProbeCacheSize():
+    try:
+        return max(int(get_server('probe_cache_size', 50000)), 1)
+    except ValueError:
+        return 50000
+
+def getProbeBackend():
+    backend = get_server('probe_backend', 'ffprobe').lower()
+    if backend not in ('ffprobe', 'ffmpeg'):
+        backend = 'ffprobe'
+    return backend
+
+def getProbeThreads():
+    try:
+        return max(int(get_server('probe_threads', 16)), 1)
+    except ValueError:
+        return 16
+
+def getProbeBudget():
+    try:
+        return max(float(get_server('probe_budget', 5)), 0)
+    except ValueError:
+        return 5.0
+
+def getTranscodeCache():
+    try:
+        return config.getboolean('Server', 'transcode_cache')
+    except:
+        return False
+
+def getTranscodeCacheSize():
+    try:
+        size = float(get_server('transcode_cache_size', 20))
+    except ValueError:
+        size = 20
+    return int(max(size, 0) * 1024 ** 3)
+
+def getFFmpegSlots():
+    try:
+        return max(int(get_server('ffmpeg_slots', 0)), 0)
+    except ValueError:
+        return 0
+
+def getFFmpegProbeSlots():
+    try:
+        return max(int(get_server('ffmpeg_probe_slots', 1)), 0)
+    except ValueError:
+        return 1
+
+def getFFmpegSlotWait():
+    try:
+        return max(int(get_server('ffmpeg_slot_wait', 10)), 1)
+    except ValueError:
+        return 10
+
+def getTranscodeBuffer():
+    try:
+        size = float(get_server('transcode_buffer', 2048))
+    except ValueError:
+        size = 2048
+    return int(max(size, 1) * 1024 ** 2)
+
+def getPreTranscode():
+    try:
+        return config.getboolean('Server', 'pretranscode')
+    except:
+        return False
+
+def _hours(value, default):
+    windows = []
+    try:
+        for window in value.split(','):
+            start, end = [int(x) % 24 for x in window.split('-')]
+            windows.append((start, end))
+    except ValueError:
+        return default
+    return windows
+
+def in_hours(windows, hour):
+    """ True if hour falls in one of the (start, end) windows. """
+    for start, end in windows:
+        if start <= end:
+            if start <= hour < end:
+                return True
+        elif hour >= start or hour < end:
+            return True
+    return False
+
+def getPreTranscodeHours():
+    """ The pretranscode_hours windows, as (start, end) hours; a window
+        may wrap past midnight.
+
+    """
+    return _hours(get_server('pretranscode_hours', '1-6'), [(1, 6)])
+
+def getPreTranscodeSize():
+    try:
+        size = float(get_server('pretranscode_size', 50))
+    except ValueError:
+        size = 50
+    return int(max(size, 0) * 1024 ** 3)
+
+def getPreTranscodeWorkers():
+    try:
+        return max(int(get_server('pretranscode_workers', 1)), 1)
+    except ValueError:
+        return 1
+
+def getTivoDecoder():
+    decoder = get_server('tivo_decoder', 'auto').lower()
+    if decoder not in ('auto', 'python', 'external'):
+        return 'auto'
+    return decoder
+
+def getTogoNPLConnections():
+    try:
+        return max(int(get_server('togo_npl_connections', 3)), 1)
+    except ValueError:
+        return 3
+
+def getToGoHours(tsn=None):
+    """ The togo_hours windows for deferred transfers, as for
+        getPreTranscodeHours(); empty if there are none.
+
+    """
+    value = get_tsn('togo_hours', tsn) or ''
+    if not value.strip():
+        return []
+    return _hours(value, [])
+
+def getToGoConcurrency(tsn=None):
+    try:
+        return max(int(get_tsn('togo_concurrency', tsn) or 1), 1)
+    except ValueError:
+        return 1
+
+def getToGoPostWorkers():
+    try:
+        return max(int(get_server('togo_postprocess_workers', 1)), 1)
+    except ValueError:
+        return 1
+
+def getToGoPostQueue():
+    try:
+        return max(int(get_server('togo_postprocess_queue', 4)), 1)
+    except ValueError:
+        return 4
+
+def getToGoAdaptiveSpeed(tsn=None):
+    try:
+        return config.getboolean('_tivo_' + tsn, 'togo_adaptive_speed')
+    except:
+        try:
+            return config.getboolean(get_section(tsn), 'togo_adaptive_speed')
+        except:
+            try:
+                return config.getboolean('Server', 'togo_adaptive_speed')
+            except:
+                return True
+
 def getFFmpegPrams(tsn):
     return get_tsn('ffmpeg_pram', tsn, True)
 
@@ -0,0 +1,117 @@
+""" Stream files to HTTP clients.
+
+    Regular files go from disk to the socket with socket.sendfile(),
+    which hands the copy to os.sendfile() where the platform has it, so
+    the data never passes through Python buffers. Anything else (pipes
+    from decoders, or platforms without sendfile) falls back to a plain
+    read/write loop.
+
+"""
+
+import io
+import os
+import stat
+import time
+
+BLOCKSIZE = 512 * 1024
+
+# Bytes handed to each sendfile call; the status dict is updated
+# between calls, so this also bounds how stale the rate can get.
+CHUNKSIZE = 4 * 1024 * 1024
+
+def is_regular(f):
+    """ True if f is backed by a regular file that sendfile can read. """
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
+class Meter(object):
+    """ Per-second rate and output accounting, kept in the same
+        'rate'/'output' keys the transfer status dicts already use.
+
+    """
+    def __init__(self, status=None):
+        self.status = status
+        self.count = 0
+        self.last_interval = time.time()
+
+    def add(self, length):
+        self.count += length
+        if self.status is None:
+            return
+        now = time.time()
+        elapsed = now - self.last_interval
+        if elapsed >= 1:
+            self.status['rate'] = (self.count * 8.0) / elapsed
+            self.status['output'] += self.count
+            self.count = 0
+            self.last_interval = now
+
+def stream_file(handler, f, offset=0, count=None, prefix=b'', status=None):
+    """ Send the contents of the open file f to handler's client.
+
+        prefix (e.g. a TiVo header) is sent ahead of the file, and offset
+        and count address the prefix and file together, as the client
+        sees them. If count is None, everything from offset to the end of
+        the file is sent. status, if given, gets 'rate' and 'output'
+        updates once a second. Returns the number of bytes sent; socket
+        errors are left for the caller.
+
+    """
+    wfile = handler.wfile
+    meter = Meter(status)
+    sent = 0
+
+    if offset < len(prefix):
+        head = prefix[offset:]
+        if count is not None:
+            head = head[:count]
+            count -= len(head)
+        wfile.write(head)
+        sent += len(head)
+        meter.add(len(head))
+        offset = 0
+    else:
+        offset -= len(prefix)
+
+    # Anything buffered must reach the socket before sendfile does
+    wfile.flush()
+
+    if count is not None and count <= 0:
+        return sent
+
+    if is_regular(f):
+        sock = handler.connection
+        while count is None or count > 0:
+            if count is None:
+                length = CHUNKSIZE
+            else:
+                length = min(CHUNKSIZE, count)
+            done = sock.sendfile(f, offset, length)
+            if not done:
+                break
+            offset += done
+            sent += done
+            meter.add(done)
+            if count is not None:
+                count -= done
+    else:
+        if offset:
+            f.seek(offset)
+        while count is None or count > 0:
+            if count is None:
+                length = BLOCKSIZE
+            else:
+                length = min(BLOCKSIZE, count)
+            block = f.read(length)
+            if not block:
+                break
+            wfile.write(block)
+            sent += len(block)
+            meter.add(len(block))
+            if count is not None:
+                count -= len(block)
+        wfile.flush()
+
+    return sent
@@ -0,0 +1,105 @@
+""" One background thread for pyTivo's timed chores.
+
+    Idle transcodes to reap, old transfer status to expire and the like
+    are queued here instead of each getting a threading.Timer. Pending
+    tasks sit in a heap ordered by deadline, so scheduling and each run
+    cost O(log n); cancelled tasks are simply skipped when they come up.
+
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger('pyTivo.housekeeping')
+
+class Task(object):
+    def __init__(self, when, func, args, name, interval):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.name = name or getattr(func, '__name__', 'task')
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Housekeeper(object):
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, func, args=(), name=None, interval=None):
+        """ Run func(*args) in delay seconds, and then every interval
+            seconds if interval is given. Returns the Task, which can be
+            cancelled.
+
+        """
+        task = Task(time.time() + delay, func, args, name, interval)
+        with self.cond:
+            self._push(task)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run,
+                                               name='housekeeping')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return task
+
+    def every(self, interval, func, args=(), name=None):
+        return self.schedule(interval, func, args, name, interval)
+
+    def _push(self, task):
+        heapq.heappush(self.heap, (task.when, next(self.seq), task))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                task = heapq.heappop(self.heap)[2]
+
+            try:
+                task.func(*task.args)
+            except Exception as msg:
+                logger.error('%s failed: %s' % (task.name, msg))
+
+            if task.interval and not task.cancelled:
+                task.when = time.time() + task.interval
+                with self.cond:
+                    self._push(task)
+
+    def deadlines(self):
+        """ (seconds from now, name) for each pending task, soonest
+            first.
+
+        """
+        now = time.time()
+        with self.cond:
+            return [(when - now, task.name)
+                    for when, seq, task in sorted(self.heap)
+                    if not task.cancelled]
+
+_housekeeper = Housekeeper()
+
+def schedule(delay, func, args=(), name=None):
+    return _housekeeper.schedule(delay, func, args, name)
+
+def every(interval, func, args=(), name=None):
+    return _housekeeper.every(interval, func, args, name)
+
+def deadlines():
+    return _housekeeper.deadlines()
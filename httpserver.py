@@ -5,17 +5,20 @@ import gzip
 import logging
 import mimetypes
 import os
+import queue as Queue
 import sys
-import shutil
 import socket
+import threading
 import time
+import uuid
 from io import StringIO
-from email.utils import formatdate
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from urllib.parse import unquote_plus, quote
 from xml.sax.saxutils import escape
 
 from Cheetah.Template import Template
 import config
+import filestream
 from plugin import GetPlugin, EncodeUnicode
 
 # determine if application is a script file or frozen exe
@@ -52,7 +55,198 @@ BASE_HTML = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
 RELOAD = '<p>The <a href="%s">page</a> will reload in %d seconds.</p>'
 UNSUP = '<h3>Unsupported Command</h3> <p>Query:</p> <ul>%s</ul>'
 
-class TivoHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+BUSY = ('HTTP/1.1 503 Service Unavailable\r\n'
+        'Retry-After: %d\r\n'
+        'Content-Length: 0\r\n'
+        'Connection: close\r\n\r\n')
+
+# Requests for these paths are short XML/HTML exchanges; anything else
+# is assumed to be a file being streamed out.
+CONTROL_PATHS = ('/TiVoConnect', '/ ')
+
+# How long browsers may reuse files from the "content" directories
+# before revalidating them
+CONTENT_MAX_AGE = 3600
+
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+
+def parse_range(header, size):
+    """ Parse a "Range: bytes=..." header against a file of the given
+        size. Returns a sorted list of merged (first, last) byte
+        positions, [] if no range can be satisfied, or None if the
+        header should be ignored and the whole file sent.
+
+    """
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # suffix range: the final N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                first, last = max(size - length, 0), size - 1
+            else:
+                first = int(first)
+                if first >= size:
+                    continue
+                last = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if first > last:
+            return None
+        ranges.append((first, min(last, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return merged
+
+class PooledMixIn:
+    """Serve connections from fixed pools of worker threads.
+
+    Two lanes are kept: 'control' for TiVoConnect commands and 'stream'
+    for file transfers, each with its own workers and bounded queue, so
+    long-lived send_file requests can't starve QueryContainer and
+    QueryItem. Every connection is queued to the control lane, whose
+    worker peeks at the request line and passes streams on to the
+    stream lane, so a slow client never holds up the accept loop. A
+    control connection is kept alive, with the same peek between
+    requests: a stream is handed on to the stream lane, and a
+    connection that goes quiet is closed, so it doesn't hold a worker.
+    While others are queued for the control lane, it's closed after
+    each response instead. When a lane's queue is full the connection
+    is answered with 503 and Retry-After instead of spawning another
+    thread. With no pool configured, connections fall through to the
+    next process_request() (one thread per connection).
+    """
+
+    pool = None
+
+    def start_pool(self, control_threads, stream_threads, queue_size,
+                   retry_after):
+        self.retry_after = retry_after
+        self.pool = {}
+        self.pool_threads = []
+        self.pool_local = threading.local()
+        for lane, count in (('control', control_threads),
+                            ('stream', stream_threads)):
+            lane_queue = Queue.Queue(queue_size)
+            self.pool[lane] = lane_queue
+            for i in range(count):
+                t = threading.Thread(target=self.pool_worker,
+                                     args=(lane, lane_queue),
+                                     name='pyTivo-%s-%d' % (lane, i))
+                t.daemon = True
+                t.start()
+                self.pool_threads.append((lane_queue, t))
+
+    def stop_pool(self):
+        if not self.pool:
+            return
+        self.pool = None
+        for lane_queue, t in self.pool_threads:
+            try:
+                lane_queue.put_nowait(None)
+            except Queue.Full:
+                pass
+
+    def pool_worker(self, lane, lane_queue):
+        self.pool_local.lane = lane
+        while True:
+            job = lane_queue.get()
+            if job is None:
+                break
+            request, client_address = job
+            if self.pool is None:
+                # shutting down -- drop whatever is still queued
+                self.shutdown_request(request)
+                continue
+            if lane == 'control' and self.pool_lane(request) == 'stream':
+                self.pool_dispatch('stream', request, client_address)
+                continue
+            self.pool_local.handoff = False
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if self.pool_local.handoff:
+                    self.pool_dispatch('stream', request, client_address)
+                else:
+                    self.shutdown_request(request)
+
+    def current_lane(self):
+        """The lane of the worker running this, or None."""
+        if not self.pool:
+            return None
+        return getattr(self.pool_local, 'lane', None)
+
+    def pool_waiting(self, lane):
+        """Whether connections are queued for the lane's workers."""
+        return bool(self.pool) and not self.pool[lane].empty()
+
+    def pool_handoff(self):
+        """Pass the connection of the control worker running this on to
+        the stream lane, once its handler returns."""
+        self.pool_local.handoff = True
+
+    def pool_lane(self, request):
+        """Peek at the request line to pick a lane, without consuming it,
+        or None if none came. This waits for the client, so it runs in a
+        control worker."""
+        old_timeout = request.gettimeout()
+        try:
+            request.settimeout(2)
+            line = request.recv(256, socket.MSG_PEEK)
+        except (socket.error, socket.timeout):
+            line = b''
+        finally:
+            request.settimeout(old_timeout)
+        if not line:
+            return None
+        try:
+            path = line.split(b' ', 1)[1].decode('latin-1')
+        except IndexError:
+            return 'control'
+        if path.startswith(CONTROL_PATHS):
+            return 'control'
+        return 'stream'
+
+    def pool_dispatch(self, lane, request, client_address):
+        try:
+            self.pool[lane].put_nowait((request, client_address))
+        except Queue.Full:
+            self.logger.warning('%s queue full, refusing %s' %
+                                (lane, client_address[0]))
+            try:
+                request.sendall((BUSY % self.retry_after).encode('ascii'))
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.pool:
+            return super().process_request(request, client_address)
+        # Sorted into its lane by a control worker
+        self.pool_dispatch('control', request, client_address)
+
+class TivoHTTPServer(PooledMixIn, SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
     def __init__(self, server_address, RequestHandlerClass):
         self.containers = {}
         self.stop = False
@@ -61,6 +255,17 @@ class TivoHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
         self.daemon_threads = True
 
+        threads = config.getPoolThreads()
+        if threads:
+            self.start_pool(threads, config.getPoolStreamThreads(),
+                            config.getPoolQueue(), config.getPoolRetryAfter())
+            self.logger.info('Serving with %d control and %d stream workers'
+                             % (threads, config.getPoolStreamThreads()))
+
+    def server_close(self):
+        self.stop_pool()
+        BaseHTTPServer.HTTPServer.server_close(self)
+
     def add_container(self, name, settings):
         if name in self.containers or name == 'TiVoConnect':
             raise Exception('Container Name in use')
@@ -100,6 +305,26 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
         self.request.settimeout(180) # This allows pyTivo to die when user selects Stop Transfer on the TiVo
 
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.server.current_lane() == 'control':
+                lane = self.server.pool_lane(self.request)
+                if lane == 'stream':
+                    self.server.pool_handoff()
+                if lane != 'control':
+                    break
+            self.handle_one_request()
+
+    def end_headers(self):
+        if (self.server.current_lane() == 'control' and
+            not self.close_connection and
+            self.server.pool_waiting('control')):
+            # Don't keep a control worker from those waiting for one
+            self.send_header('Connection', 'close')
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+
     def address_string(self):
         host, port = self.client_address[:2]
         return host
@@ -208,7 +433,8 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 self.send_xml(SERVER_INFO)
                 return
 
-            elif command in ('GetActiveTransferCount', 'GetTransferStatus'):
+            elif command in ('GetActiveTransferCount', 'GetTransferStatus',
+                             'GetTranscodeStats'):
                 plugin = GetPlugin('video')
                 if hasattr(plugin, command):
                     method = getattr(plugin, command)
@@ -228,30 +454,131 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.unsupported(query)
 
     def send_content_file(self, path):
-        lmdate = os.path.getmtime(path)
         try:
+            st = os.stat(path)
             handle = open(path, 'rb')
         except:
             self.send_error(404)
             return
 
-        # Send the header
-        mime = mimetypes.guess_type(path)[0]
-        self.send_response(200)
-        if mime:
-            self.send_header('Content-Type', mime)
-        self.send_header('Content-Length', os.path.getsize(path))
-        self.send_header('Last-Modified', formatdate(lmdate))
-        self.end_headers()
+        lmdate = st.st_mtime
+        size = st.st_size
+        etag = '"%x-%x"' % (int(lmdate), size)
+        last_modified = formatdate(lmdate, usegmt=True)
+        mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        def common_headers():
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('ETag', etag)
+            self.send_header('Accept-Ranges', 'bytes')
+            if self.is_content_path(path):
+                self.send_header('Cache-Control',
+                                 'max-age=%d' % CONTENT_MAX_AGE)
+
+        if self.not_modified(etag, lmdate):
+            handle.close()
+            self.send_response(304)
+            common_headers()
+            self.end_headers()
+            self.wfile.flush()
+            return
+
+        ranges = None
+        range_header = self.headers.get('Range')
+        if range_header and self.if_range(etag, last_modified):
+            ranges = parse_range(range_header, size)
+
+        if ranges == []:
+            handle.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', 0)
+            common_headers()
+            self.end_headers()
+            self.wfile.flush()
+            return
 
-        # Send the body of the file
+        # Send the header, and the body of the file
         try:
-            shutil.copyfileobj(handle, self.wfile)
+            if not ranges:
+                self.send_response(200)
+                self.send_header('Content-Type', mime)
+                self.send_header('Content-Length', size)
+                common_headers()
+                self.end_headers()
+                filestream.stream_file(self, handle)
+
+            elif len(ranges) == 1:
+                first, last = ranges[0]
+                self.send_response(206)
+                self.send_header('Content-Type', mime)
+                self.send_header('Content-Length', last - first + 1)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+                common_headers()
+                self.end_headers()
+                filestream.stream_file(self, handle, first, last - first + 1)
+
+            else:
+                boundary = uuid.uuid4().hex
+                parts = []
+                for first, last in ranges:
+                    part_head = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                                 'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                                 (boundary, mime, first, last, size))
+                    parts.append((part_head.encode('ascii'), first, last))
+                tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+                length = len(tail) + sum(len(head) + last - first + 1
+                                         for head, first, last in parts)
+
+                self.send_response(206)
+                self.send_header('Content-Type',
+                    'multipart/byteranges; boundary=' + boundary)
+                self.send_header('Content-Length', length)
+                common_headers()
+                self.end_headers()
+                for head, first, last in parts:
+                    self.wfile.write(head)
+                    filestream.stream_file(self, handle, first,
+                                           last - first + 1)
+                self.wfile.write(tail)
         except:
             pass
         handle.close()
         self.wfile.flush()
 
+    def not_modified(self, etag, lmdate):
+        """ Check If-None-Match, or failing that If-Modified-Since. """
+        none_match = self.headers.get('If-None-Match')
+        if none_match:
+            tags = [x.strip() for x in none_match.split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+        since = self.headers.get('If-Modified-Since')
+        if since:
+            since = parsedate_tz(since)
+            if since:
+                try:
+                    return int(lmdate) <= mktime_tz(since)
+                except (OverflowError, ValueError):
+                    pass
+        return False
+
+    def if_range(self, etag, last_modified):
+        """ Should a Range header be honoured, given any If-Range? """
+        validator = self.headers.get('If-Range')
+        return not validator or validator.strip() in (etag, last_modified)
+
+    def is_content_path(self, path):
+        """ Is this one of pyTivo's own files from a "content" directory
+            (web UI stylesheets, icons, the Desktop bundle)?
+
+        """
+        rel = os.path.relpath(os.path.abspath(path),
+                              os.path.abspath(SCRIPTDIR))
+        parts = rel.split(os.path.sep)
+        return parts[0] != os.path.pardir and 'content' in parts
+
     def handle_file(self, query, splitpath):
         if '..' not in splitpath:    # Protect against path exploits
             ## Pass it off to a plugin?
@@ -317,6 +644,15 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.wfile.write(page)
         self.wfile.flush()
 
+    def send_busy(self):
+        """ 503, to try again after pool_retry_after seconds. """
+        self.send_response(503)
+        self.send_header('Retry-After', config.getPoolRetryAfter())
+        self.send_header('Content-Length', 0)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+
     def send_xml(self, page):
         self.send_fixed(page, 'text/xml')
 
@@ -38,11 +38,11 @@ discarded. [1]_
 
 """
 
-from __future__ import generators
+import threading
 import time
-from heapq import heappush, heappop, heapify
+from collections import OrderedDict
 
-__version__ = "0.2"
+__version__ = "0.3"
 __all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
 __docformat__ = 'reStructuredText en'
 
@@ -65,6 +65,14 @@ class LRUCache(object):
     a Python dictionary, with the exception that objects you put into the
     cache may be discarded before you take them out.
 
+    Records are kept in an ordered dict in access order, so lookups,
+    stores and evictions are all constant time. Every operation holds an
+    internal lock, so one cache can be shared between request threads.
+    Records may be given a time-to-live, either for the whole cache or
+    per record via set(); an expired record behaves as if it had been
+    discarded. The hits, misses and evictions counters are kept for
+    tuning cache sizes.
+
     Some example usage::
 
     cache = LRUCache(32) # new cache
@@ -95,111 +103,176 @@ class LRUCache(object):
 
     for j in cache:   # iterate (in LRU order)
         print j, cache[j] # iterator produces keys, not values
+
+    cache.set('bar', 'baz', ttl=60) # discarded after a minute
+
+    print cache.stats() # hits, misses, evictions
     """
 
     class __Node(object):
         """Record of a cached value. Not for public consumption."""
 
-        def __init__(self, key, obj, timestamp):
+        __slots__ = ('key', 'obj', 'mtime', 'expires')
+
+        def __init__(self, key, obj, timestamp, expires):
             object.__init__(self)
             self.key = key
             self.obj = obj
-            self.atime = timestamp
-            self.mtime = self.atime
-
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
+            self.mtime = timestamp
+            self.expires = expires
 
         def __repr__(self):
             return "<%s %s => %s (%s)>" % \
                    (self.__class__, self.key, self.obj, \
-                    time.asctime(time.localtime(self.atime)))
+                    time.asctime(time.localtime(self.mtime)))
 
-    def __init__(self, size=DEFAULT_SIZE):
+    def __init__(self, size=DEFAULT_SIZE, ttl=None):
         # Check arguments
-        if size <= 0:
-            raise ValueError(size)
-        elif type(size) is not type(0):
+        if type(size) is not type(0):
             raise TypeError(size)
+        elif size <= 0:
+            raise ValueError(size)
         object.__init__(self)
-        self.__heap = []
-        self.__dict = {}
+        self.__dict = OrderedDict()
+        self.__lock = threading.RLock()
+        self.ttl = ttl
+        """Default time-to-live of a record in seconds, or None to keep
+        records until they are discarded for space."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.size = size
         """Maximum size of the cache.
         If more than 'size' elements are added to the cache,
         the least-recently-used ones will be discarded."""
 
+    def __expired(self, node, now):
+        return node.expires is not None and node.expires <= now
+
+    def __lookup(self, key):
+        """Return the live node for key, dropping it if it has expired.
+        Must be called with the lock held."""
+        node = self.__dict.get(key)
+        if node is not None and self.__expired(node, time.time()):
+            del self.__dict[key]
+            self.evictions += 1
+            node = None
+        return node
+
+    def __shrink(self, size):
+        """Discard least-recently-used records until at most size remain.
+        Must be called with the lock held."""
+        while len(self.__dict) > size:
+            self.__dict.popitem(last=False)
+            self.evictions += 1
+
     def __len__(self):
-        return len(self.__heap)
+        with self.__lock:
+            return len(self.__dict)
 
     def __contains__(self, key):
-        return self.__dict.has_key(key)
+        with self.__lock:
+            if self.__lookup(key) is None:
+                self.misses += 1
+                return False
+            return True
 
     def __setitem__(self, key, obj):
-        if self.__dict.has_key(key):
-            node = self.__dict[key]
-            node.obj = obj
-            node.atime = time.time()
-            node.mtime = node.atime
-            heapify(self.__heap)
+        self.set(key, obj)
+
+    def set(self, key, obj, ttl=None):
+        """Store obj under key. ttl overrides the cache-wide time-to-live
+        for this record only."""
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        if ttl is None:
+            expires = None
         else:
-            # size may have been reset, so we loop
-            overage = len(self.__heap) - self.size + 1
-            for i in xrange(overage):
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
-            self.__dict[key] = node
-            heappush(self.__heap, node)
+            expires = now + ttl
+        with self.__lock:
+            node = self.__dict.get(key)
+            if node is not None:
+                node.obj = obj
+                node.mtime = now
+                node.expires = expires
+                self.__dict.move_to_end(key)
+            else:
+                # size may have been reset, so make room for the new one
+                self.__shrink(self.size - 1)
+                self.__dict[key] = self.__Node(key, obj, now, expires)
 
     def __getitem__(self, key):
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            node.atime = time.time()
-            heapify(self.__heap)
+        with self.__lock:
+            node = self.__lookup(key)
+            if node is None:
+                self.misses += 1
+                raise CacheKeyError(key)
+            self.__dict.move_to_end(key)
+            self.hits += 1
             return node.obj
 
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if it's missing."""
+        try:
+            return self[key]
+        except CacheKeyError:
+            return default
+
     def __delitem__(self, key):
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
+        with self.__lock:
+            node = self.__dict.pop(key, None)
+            if node is None:
+                raise CacheKeyError(key)
             return node.obj
 
+    def clear(self):
+        """Discard every record. The statistics are kept."""
+        with self.__lock:
+            self.__dict.clear()
+
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
+        # iterate over a snapshot so callers may delete as they go
+        with self.__lock:
+            now = time.time()
+            keys = [key for key, node in self.__dict.items()
+                    if not self.__expired(node, now)]
+        return iter(keys)
 
     def __setattr__(self, name, value):
-        object.__setattr__(self, name, value)
-        # automagically shrink heap on resize
         if name == 'size':
-            overage = len(self.__heap) - value
-            for i in range(overage):
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+            if type(value) is not type(0):
+                raise TypeError(value)
+            elif value <= 0:
+                raise ValueError(value)
+            # automagically shrink on resize
+            with self.__lock:
+                object.__setattr__(self, name, value)
+                self.__shrink(value)
+        else:
+            object.__setattr__(self, name, value)
 
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+        return "<%s (%d elements)>" % (str(self.__class__), len(self))
 
     def mtime(self, key):
         """Return the last modification time for the cache record with key.
         May be useful for cache instances where the stored values can get
         'stale', such as caching file or network resource contents."""
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
+        with self.__lock:
+            node = self.__lookup(key)
+            if node is None:
+                raise CacheKeyError(key)
             return node.mtime
 
+    def stats(self):
+        """Return a dict of the hit, miss and eviction counters, along with
+        the current and maximum number of records."""
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'length': len(self.__dict), 'size': self.size}
+
 if __name__ == "__main__":
     cache = LRUCache(25)
     print(cache)
@@ -220,3 +293,7 @@ if __name__ == "__main__":
     print(cache.mtime(46))
     for c in cache:
         print(c)
+    cache.set('short', 'lived', ttl=0.1)
+    time.sleep(0.2)
+    print('short' in cache)
+    print(cache.stats())
@@ -7,8 +7,13 @@ import struct
 import subprocess
 import sys
 from datetime import datetime
+from io import BytesIO
 from xml.dom import minidom
 from xml.parsers import expat
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 try:
     import plistlib
 except:
@@ -101,15 +106,6 @@ def tag_data(element, tag):
         return ''
     return element.firstChild.data
 
-def _vtag_data(element, tag):
-    for name in tag.split('/'):
-        new_element = element.getElementsByTagName(name)
-        if not new_element:
-            return []
-        element = new_element[0]
-    elements = element.getElementsByTagName('element')
-    return [x.firstChild.data for x in elements if x.firstChild]
-
 def _vtag_data_alternate(element, tag):
     elements = [element]
     for name in tag.split('/'):
@@ -119,11 +115,55 @@ def _vtag_data_alternate(element, tag):
         elements = new_elements
     return [x.firstChild.data for x in elements if x.firstChild]
 
-def _tag_value(element, tag):
-    item = element.getElementsByTagName(tag)
-    if item:
-        value = item[0].attributes['value'].value
-        return int(value[0])
+def _local(tag):
+    # The tag without its {namespace}
+    return tag.rsplit('}', 1)[-1]
+
+def _source(xml):
+    if isinstance(xml, (bytes, str)):
+        return BytesIO(xml if isinstance(xml, bytes) else xml.encode('utf-8'))
+    return xml
+
+def parse_container(xml):
+    """ Parse a TiVoContainer page -- a file object, or the page itself
+        -- in one streaming pass. Returns (details, items): details is a
+        dict of the container's own text elements, by path below
+        TiVoContainer ('Details/TotalItems', 'ItemCount'...), and items
+        a list of such dicts, one per Item, by path below it
+        ('Details/Title', 'Links/Content/Url'...). As with tag_data(),
+        the first of repeated paths wins. Each Item's elements are
+        freed once read, so the whole tree is never held.
+
+    """
+    details = {}
+    items = []
+    record = details
+    path = []
+    depth = 0                   # of the Item being read, if any
+    root = None
+    for event, elem in ElementTree.iterparse(_source(xml),
+                                             ('start', 'end')):
+        if event == 'start':
+            path.append(_local(elem.tag))
+            if root is None:
+                root = elem
+            elif len(path) == 2 and path[1] == 'Item':
+                record = {}
+                depth = 2
+            continue
+        if len(path) == 2 and depth:
+            items.append(record)
+            record = details
+            depth = 0
+            root.clear()
+        elif len(elem) == 0 and len(path) > 1:
+            key = '/'.join(path[depth or 1:])
+            if key not in record:
+                record[key] = elem.text or ''
+            if depth:
+                elem.clear()
+        path.pop()
+    return details, items
 
 def from_moov(full_path):
     if full_path in mp4_cache:
@@ -420,7 +460,14 @@ def basic(full_path, mtime=None):
 
     return metadata
 
-def from_container(xmldoc):
+def _clean_description(data):
+    data = data.replace(TRIBUNE_CR, '').replace(ROVI_CR, '')
+    if data.endswith(' *'):
+        data = data[:-2]
+    return data
+
+def from_container(item):
+    """ Metadata from one item record of parse_container(). """
     metadata = {}
 
     keys = {'title': 'Title', 'episodeTitle': 'EpisodeTitle',
@@ -430,15 +477,11 @@ def from_container(xmldoc):
             'callsign': 'SourceStation', 'showingBits': 'ShowingBits',
             'mpaaRating': 'MpaaRating', 'recordDate': 'CaptureDate'}
 
-    details = xmldoc.getElementsByTagName('Details')[0]
-
     for key in keys:
-        data = tag_data(details, keys[key])
+        data = item.get('Details/' + keys[key])
         if data:
             if key == 'description':
-                data = data.replace(TRIBUNE_CR, '').replace(ROVI_CR, '')
-                if data.endswith(' *'):
-                    data = data[:-2]
+                data = _clean_description(data)
             elif key == 'tvRating':
                 data = int(data)
             elif key == 'displayMajorNumber':
@@ -449,11 +492,11 @@ def from_container(xmldoc):
     return metadata
 
 def from_details(xml):
-    metadata = {}
+    """ Metadata from a TiVoVideoDetails page, read in one streaming
+        pass.
 
-    xmldoc = minidom.parseString(xml)
-    showing = xmldoc.getElementsByTagName('showing')[0]
-    program = showing.getElementsByTagName('program')[0]
+    """
+    metadata = {}
 
     items = {'description': 'program/description',
              'title': 'program/title',
@@ -469,37 +512,67 @@ def from_details(xml):
              'partIndex': 'partIndex',
              'time': 'time'}
 
-    for item in items:
-        data = tag_data(showing, items[item])
-        if data:
-            if item == 'description':
-                data = data.replace(TRIBUNE_CR, '').replace(ROVI_CR, '')
-                if data.endswith(' *'):
-                    data = data[:-2]
-            metadata[item] = data
-
     vItems = ['vActor', 'vChoreographer', 'vDirector',
               'vExecProducer', 'vProgramGenre', 'vGuestStar',
               'vHost', 'vProducer', 'vWriter']
 
-    for item in vItems:
-        data = _vtag_data(program, item)
+    # The first of each of these anywhere in the showing, or, for the
+    # ratings, in its program, has a value attribute
+    values = {'showingBits': 0, 'tvRating': 0, 'starRating': 1,
+              'mpaaRating': 1}
+
+    texts = {}
+    lists = {}
+    found = {}
+    path = None                 # below the showing, once it starts
+    vlist = None                # the vItem list being read
+    for event, elem in ElementTree.iterparse(_source(xml),
+                                             ('start', 'end')):
+        name = _local(elem.tag)
+        if path is None:
+            if event == 'start' and name == 'showing':
+                path = []
+            continue
+        if event == 'start':
+            path.append(name)
+            in_program = path[0] == 'program'
+            if name in values and name not in found and \
+               (in_program or not values[name]):
+                found[name] = elem.get('value')
+            elif name in vItems and in_program and name not in lists:
+                vlist = lists[name] = []
+            continue
+        if not path:
+            break               # the end of the showing
+        key = '/'.join(path)
+        if len(elem) == 0 and key not in texts:
+            texts[key] = elem.text or ''
+        if name == 'element' and vlist is not None and elem.text:
+            vlist.append(elem.text)
+        elif name in vItems and lists.get(name) is vlist:
+            vlist = None
+        path.pop()
+        elem.clear()
+
+    for item in items:
+        data = texts.get(items[item])
         if data:
+            if item == 'description':
+                data = _clean_description(data)
             metadata[item] = data
 
-    sb = showing.getElementsByTagName('showingBits')
-    if sb:
-        metadata['showingBits'] = sb[0].attributes['value'].value
+    for item in vItems:
+        if lists.get(item):
+            metadata[item] = lists[item]
+
+    if found.get('showingBits') is not None:
+        metadata['showingBits'] = found['showingBits']
 
     #for tag in ['starRating', 'mpaaRating', 'colorCode']:
-    for tag in ['starRating', 'mpaaRating']:
-        value = _tag_value(program, tag)
-        if value:
-            metadata[tag] = value
-
-    rating = _tag_value(showing, 'tvRating')
-    if rating:
-        metadata['tvRating'] = rating
+    for tag in ['starRating', 'mpaaRating', 'tvRating']:
+        value = found.get(tag)
+        if value and int(value[0]):
+            metadata[tag] = int(value[0])
 
     return metadata
 
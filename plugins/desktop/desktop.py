@@ -37,6 +37,15 @@ class Desktop(Plugin):
                 exedir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(sys.executable)))))  # on Mac pyTivo is inside a .app bundle
                 asar_file = os.path.join(exedir, 'pyTivoDesktop.app', 'contents', 'resources', 'app.asar')
 
+            # Only unpack when the bundle has changed, so the files keep
+            # their modification times and browsers can cache them
+            index_file = os.path.join(SCRIPTDIR, 'content', 'index.html')
+            try:
+                if os.path.getmtime(index_file) >= os.path.getmtime(asar_file):
+                    return True
+            except OSError:
+                pass
+
             try:
                 with AsarArchive.open(asar_file) as archive:
                     archive.extract(os.path.join(SCRIPTDIR, 'content'))
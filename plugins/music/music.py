@@ -1,7 +1,6 @@
 import os
 import random
 import re
-import shutil
 import subprocess
 import sys
 import time
@@ -15,6 +14,8 @@ from mutagen.mp3 import MP3
 from Cheetah.Template import Template
 from lrucache import LRUCache
 import config
+import filestream
+import scheduler
 from plugin import EncodeUnicode, Plugin, quote, unquote
 from plugins.video.transcode import kill
 
@@ -103,15 +104,29 @@ class Music(Plugin):
         ext = os.path.splitext(fname)[1].lower()
         needs_transcode = ext in TRANSCODE or seek or duration or always
 
-        if not needs_transcode:
-            fsize = os.path.getsize(fname)
-            handler.send_response(200)
-            handler.send_header('Content-Length', fsize)
-        else:
-            handler.send_response(206)
-            handler.send_header('Transfer-Encoding', 'chunked')
-        handler.send_header('Content-Type', 'audio/mpeg')
-        handler.end_headers()
+        if needs_transcode:
+            try:
+                job = scheduler.acquire(scheduler.PLAYBACK, fname,
+                                        config.getFFmpegSlotWait())
+            except scheduler.Busy as msg:
+                handler.server.logger.info(msg)
+                handler.send_busy()
+                return
+
+        try:
+            if not needs_transcode:
+                fsize = os.path.getsize(fname)
+                handler.send_response(200)
+                handler.send_header('Content-Length', fsize)
+            else:
+                handler.send_response(206)
+                handler.send_header('Transfer-Encoding', 'chunked')
+            handler.send_header('Content-Type', 'audio/mpeg')
+            handler.end_headers()
+        except:
+            if needs_transcode:
+                job.release()
+            raise
 
         if needs_transcode:
             if mswindows:
@@ -128,26 +143,29 @@ class Music(Plugin):
             if duration:
                 cmd[-1:] = ['-t', '%.3f' % (duration / 1000.0), '-']
 
-            ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
-                                      stdout=subprocess.PIPE,
-                                      stdin=subprocess.PIPE)
-            while True:
-                try:
-                    block = ffmpeg.stdout.read(BLOCKSIZE)
-                    handler.wfile.write('%x\r\n' % len(block))
-                    handler.wfile.write(block)
-                    handler.wfile.write('\r\n')
-                except Exception, msg:
-                    handler.server.logger.info(msg)
-                    kill(ffmpeg)
-                    break
-
-                if not block:
-                    break
+            try:
+                ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
+                                          stdout=subprocess.PIPE,
+                                          stdin=subprocess.PIPE)
+                while True:
+                    try:
+                        block = ffmpeg.stdout.read(BLOCKSIZE)
+                        handler.wfile.write('%x\r\n' % len(block))
+                        handler.wfile.write(block)
+                        handler.wfile.write('\r\n')
+                    except Exception, msg:
+                        handler.server.logger.info(msg)
+                        kill(ffmpeg)
+                        break
+
+                    if not block:
+                        break
+            finally:
+                job.release()
         else:
             f = open(fname, 'rb')
             try:
-                shutil.copyfileobj(f, handler.wfile)
+                filestream.stream_file(handler, f)
             except:
                 pass
             f.close()
@@ -254,17 +272,24 @@ class Music(Plugin):
                 if mswindows:
                     fname = fname.encode('cp1252')
                 cmd = [ffmpeg_path, '-i', fname]
-                ffmpeg = subprocess.Popen(cmd, stderr=subprocess.PIPE,
-                                               stdout=subprocess.PIPE, 
-                                               stdin=subprocess.PIPE)
-
-                # wait 10 sec if ffmpeg is not back give up
-                for i in xrange(200):
-                    time.sleep(.05)
-                    if not ffmpeg.poll() == None:
-                        break
-
-                if ffmpeg.poll() != None:
+                job = scheduler.acquire(scheduler.PROBE, fname)
+                try:
+                    ffmpeg = subprocess.Popen(cmd, stderr=subprocess.PIPE,
+                                                   stdout=subprocess.PIPE, 
+                                                   stdin=subprocess.PIPE)
+
+                    # wait 10 sec if ffmpeg is not back give up
+                    for i in xrange(200):
+                        time.sleep(.05)
+                        if not ffmpeg.poll() == None:
+                            break
+                    finished = ffmpeg.poll() != None
+                    if not finished:
+                        kill(ffmpeg)
+                finally:
+                    job.release()
+
+                if finished:
                     output = ffmpeg.stderr.read()
                     d = durre(output)
                     if d:
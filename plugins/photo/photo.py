@@ -48,6 +48,7 @@ except ImportError:
         print 'Python Imaging Library not found; using FFmpeg'
 
 import config
+import scheduler
 from Cheetah.Template import Template
 from lrucache import LRUCache
 from plugin import EncodeUnicode, Plugin, quote, unquote
@@ -84,36 +85,9 @@ class Photo(Plugin):
     
     CONTENT_TYPE = 'x-container/tivo-photos'
 
-    class LockedLRUCache(LRUCache):
-        def __init__(self, num):
-            LRUCache.__init__(self, num)
-            self.lock = threading.RLock()
-
-        def acquire(self, blocking=1):
-            return self.lock.acquire(blocking)
-
-        def release(self):
-            self.lock.release()
-
-        def __setitem__(self, key, obj):
-            self.acquire()
-            try:
-                LRUCache.__setitem__(self, key, obj)
-            finally:
-                self.release()
-
-        def __getitem__(self, key):
-            item = None
-            self.acquire()
-            try:
-                item = LRUCache.__getitem__(self, key)
-            finally:
-                self.release()
-            return item
-
-    media_data_cache = LockedLRUCache(300)  # info and thumbnails
-    recurse_cache = LockedLRUCache(5)       # recursive directory lists
-    dir_cache = LockedLRUCache(10)          # non-recursive lists
+    media_data_cache = LRUCache(300)  # info and thumbnails
+    recurse_cache = LRUCache(5)       # recursive directory lists
+    dir_cache = LRUCache(10)          # non-recursive lists
 
     def new_size(self, oldw, oldh, width, height, pshape):
         pixw, pixh = [int(x) for x in pshape.split(':')]
@@ -228,23 +202,24 @@ class Photo(Plugin):
         # Windows and other OS buffer 4096 and ffmpeg can output more
         # than that.
         err_tmp = tempfile.TemporaryFile()
-        ffmpeg = subprocess.Popen(cmd, stderr=err_tmp,
-                                  stdout=subprocess.PIPE,
-                                  stdin=subprocess.PIPE)
-
-        # wait configured # of seconds: if ffmpeg is not back give up
-        limit = config.getFFmpegWait()
-        if limit:
-            for i in xrange(limit * 20):
-                time.sleep(.05)
-                if not ffmpeg.poll() == None:
-                    break
-
-            if ffmpeg.poll() == None:
-                kill(ffmpeg)
-                return False, 'FFmpeg timed out'
-        else:
-            ffmpeg.wait()
+        with scheduler.acquire(scheduler.THUMBNAIL, fname):
+            ffmpeg = subprocess.Popen(cmd, stderr=err_tmp,
+                                      stdout=subprocess.PIPE,
+                                      stdin=subprocess.PIPE)
+
+            # wait configured # of seconds: if ffmpeg is not back give up
+            limit = config.getFFmpegWait()
+            if limit:
+                for i in xrange(limit * 20):
+                    time.sleep(.05)
+                    if not ffmpeg.poll() == None:
+                        break
+
+                if ffmpeg.poll() == None:
+                    kill(ffmpeg)
+                    return False, 'FFmpeg timed out'
+            else:
+                ffmpeg.wait()
 
         err_tmp.seek(0)
         output = err_tmp.read()
@@ -305,22 +280,23 @@ class Photo(Plugin):
 
         cmd = [ffmpeg_path, '-i', fname, '-vf', filters, '-f', 'mjpeg', '-']
         jpeg_tmp = tempfile.TemporaryFile()
-        ffmpeg = subprocess.Popen(cmd, stdout=jpeg_tmp,
-                                  stdin=subprocess.PIPE)
-
-        # wait configured # of seconds: if ffmpeg is not back give up
-        limit = config.getFFmpegWait()
-        if limit:
-            for i in xrange(limit * 20):
-                time.sleep(.05)
-                if not ffmpeg.poll() == None:
-                    break
-
-            if ffmpeg.poll() == None:
-                kill(ffmpeg)
-                return False, 'FFmpeg timed out'
-        else:
-            ffmpeg.wait()
+        with scheduler.acquire(scheduler.THUMBNAIL, fname):
+            ffmpeg = subprocess.Popen(cmd, stdout=jpeg_tmp,
+                                      stdin=subprocess.PIPE)
+
+            # wait configured # of seconds: if ffmpeg is not back give up
+            limit = config.getFFmpegWait()
+            if limit:
+                for i in xrange(limit * 20):
+                    time.sleep(.05)
+                    if not ffmpeg.poll() == None:
+                        break
+
+                if ffmpeg.poll() == None:
+                    kill(ffmpeg)
+                    return False, 'FFmpeg timed out'
+            else:
+                ffmpeg.wait()
 
         jpeg_tmp.seek(0)
         output = jpeg_tmp.read()
@@ -0,0 +1,314 @@
+""" ToGo's transfer queue, kept in SQLite so it survives a restart.
+
+    Each queued transfer is a job: the show's URL, the TiVo it's on,
+    the options it was queued with, a priority and a state. Jobs run
+    highest priority first, then in the order they were queued, with
+    at most togo_concurrency running from any one TiVo at a time. A job
+    queued as deferred waits for the TiVo's togo_hours, when the TiVo
+    and the network should be idle. Once downloaded, a job is
+    post-processing until its post-processing task, kept with it, is
+    done; once the task is taken into the post-processing queue, that
+    doesn't hold up the TiVo's next download.
+
+    On startup, jobs that were running when pyTivo stopped go back in
+    the queue, and their partial files are removed, so every transfer
+    queued before a restart or a crash still happens; those that were
+    post-processing are handed back to be post-processed again.
+
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import config
+import housekeeping
+
+logger = logging.getLogger('pyTivo.togo.jobqueue')
+
+DB_NAME = 'togo_queue.db'
+
+# Seconds between checks for deferred jobs whose hours have come
+CHECK = 300
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+POSTPROCESSING = 'postprocessing'
+FINISHED = 'finished'
+ERROR = 'error'
+ACTIVE = (QUEUED, RUNNING, POSTPROCESSING)
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS jobs (
+    url TEXT PRIMARY KEY,
+    tsn TEXT NOT NULL,
+    tivo TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    deferred INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    options TEXT NOT NULL,
+    outfile TEXT,
+    error TEXT,
+    changed REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, priority, seq)"""
+
+FIELDS = ('url', 'tsn', 'tivo', 'priority', 'seq', 'deferred', 'state',
+          'options', 'outfile', 'error', 'changed')
+
+# Run order: jobs post-processing, then running, then the rest by
+# priority and age
+ORDER = ("ORDER BY state = 'postprocessing' DESC, state = 'running' DESC, "
+         "priority DESC, seq")
+
+class JobQueue(object):
+    def __init__(self, path, run=None):
+        self.path = path
+        self.run = run          # run(job), called in the job's thread
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.running = {}       # url -> thread, for jobs run in this process
+
+    def _job(self, row):
+        job = dict(zip(FIELDS, row))
+        job['options'] = json.loads(job['options'])
+        job['deferred'] = bool(job['deferred'])
+        return job
+
+    def _select(self, where='', args=()):
+        return [self._job(row) for row in self.db.execute(
+            'SELECT %s FROM jobs %s %s' % (', '.join(FIELDS), where, ORDER),
+            args)]
+
+    def _set(self, url, **fields):
+        fields['changed'] = time.time()
+        names = sorted(fields)
+        self.db.execute('UPDATE jobs SET %s WHERE url = ?' %
+                        ', '.join('%s = ?' % name for name in names),
+                        [fields[name] for name in names] + [url])
+        self.db.commit()
+
+    def recover(self):
+        """ Put back in the queue the jobs that were running when pyTivo
+            stopped, removing what they'd written. Returns how many jobs
+            are waiting.
+
+        """
+        with self.lock:
+            for job in self._select('WHERE state = ?', (RUNNING,)):
+                outfile = job['outfile']
+                if outfile and os.path.isfile(outfile):
+                    try:
+                        os.remove(outfile)
+                        logger.info('Removed partial transfer %s' % outfile)
+                    except OSError as msg:
+                        logger.error('Unable to remove partial transfer '
+                                     '%s: %s' % (outfile, msg))
+                self._set(job['url'], state=QUEUED, outfile=None)
+            return self.count()
+
+    def add(self, url, tsn, tivo, options, priority=0, deferred=False):
+        """ Queue url, or requeue it if its last transfer is over. False
+            if it's being transferred now.
+
+        """
+        with self.lock:
+            job = self.get(url)
+            if job and job['state'] == RUNNING:
+                return False
+            seq = self.db.execute('SELECT COALESCE(MAX(seq), 0) + 1 '
+                                  'FROM jobs').fetchone()[0]
+            if job and job['state'] == QUEUED:
+                seq = job['seq']
+            self.db.execute(
+                'INSERT OR REPLACE INTO jobs (url, tsn, tivo, priority, seq, '
+                'deferred, state, options, changed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, tsn or '', tivo, priority, seq, int(bool(deferred)),
+                 QUEUED, json.dumps(options), time.time()))
+            self.db.commit()
+        self.dispatch()
+        return True
+
+    def get(self, url):
+        with self.lock:
+            jobs = self._select('WHERE url = ?', (url,))
+        return jobs[0] if jobs else None
+
+    def urls(self, tsn=None):
+        """ The URLs of the jobs queued or running, in the order they'll
+            run; only those from the TiVo with this TSN, if given.
+
+        """
+        where = 'WHERE state IN (?, ?, ?)'
+        args = ACTIVE
+        if tsn is not None:
+            where += ' AND tsn = ?'
+            args += (tsn,)
+        with self.lock:
+            return [job['url'] for job in self._select(where, args)]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM jobs WHERE state '
+                                   'IN (?, ?, ?)', ACTIVE).fetchone()[0]
+
+    def started(self, url, outfile):
+        """ Note where url is being written, to clean up after a crash. """
+        with self.lock:
+            self._set(url, outfile=outfile)
+
+    def processing(self, url, task):
+        """ Note that url is downloaded, and waiting on task, a dict of
+            what its post-processing needs.
+
+        """
+        with self.lock:
+            job = self.get(url)
+            if job:
+                job['options']['post'] = task
+                self._set(url, state=POSTPROCESSING,
+                          options=json.dumps(job['options']))
+
+    def post_tasks(self):
+        """ The post-processing tasks of the jobs waiting on one. """
+        with self.lock:
+            return [job['options']['post'] for job in
+                    self._select('WHERE state = ?', (POSTPROCESSING,))
+                    if 'post' in job['options']]
+
+    def requeue(self, url):
+        """ Run url again, next among the jobs of its priority. """
+        with self.lock:
+            self._set(url, state=QUEUED, outfile=None)
+
+    def finish(self, url, error=''):
+        with self.lock:
+            self._set(url, state=ERROR if error else FINISHED, error=error)
+
+    def remove(self, url):
+        """ Drop url from the queue; False if it's running or
+            post-processing.
+
+        """
+        with self.lock:
+            job = self.get(url)
+            if url in self.running or (job and
+                                       job['state'] == POSTPROCESSING):
+                return False
+            self.db.execute('DELETE FROM jobs WHERE url = ?', (url,))
+            self.db.commit()
+            return True
+
+    def expire(self, age):
+        """ Forget finished jobs older than age seconds. """
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE state IN (?, ?) AND '
+                            'changed < ?', (FINISHED, ERROR,
+                                            time.time() - age))
+            self.db.commit()
+
+    def runnable(self, now=None):
+        """ The queued jobs that may start now, in order. """
+        hour = time.localtime(now).tm_hour
+        with self.lock:
+            busy = {}
+            for job in self._select('WHERE state IN (?, ?)',
+                                    (RUNNING, POSTPROCESSING)):
+                # A download waiting for room in the post-processing
+                # queue still holds up its TiVo's next one
+                if job['state'] == RUNNING or job['url'] in self.running:
+                    busy[job['tsn']] = busy.get(job['tsn'], 0) + 1
+            ready = []
+            for job in self._select('WHERE state = ?', (QUEUED,)):
+                tsn = job['tsn']
+                if job['url'] in self.running:
+                    # Still winding up, to run again
+                    busy[tsn] = busy.get(tsn, 0) + 1
+                    continue
+                if busy.get(tsn, 0) >= config.getToGoConcurrency(tsn):
+                    continue
+                if job['deferred']:
+                    hours = config.getToGoHours(tsn)
+                    if hours and not config.in_hours(hours, hour):
+                        continue
+                busy[tsn] = busy.get(tsn, 0) + 1
+                ready.append(job)
+            return ready
+
+    def dispatch(self):
+        """ Start every job that may run now, each in its own thread. """
+        if self.run is None:
+            return
+        with self.lock:
+            for job in self.runnable():
+                self._set(job['url'], state=RUNNING)
+                job['state'] = RUNNING
+                thread = threading.Thread(target=self._run, args=(job,),
+                                          name='togo')
+                thread.daemon = True
+                self.running[job['url']] = thread
+                thread.start()
+
+    def _run(self, job):
+        url = job['url']
+        try:
+            self.run(job)
+        except Exception as msg:
+            logger.error('ToGo job %s failed: %s' % (url, msg))
+            with self.lock:
+                current = self.get(url)
+                if current and current['state'] == RUNNING:
+                    self.finish(url, str(msg))
+        finally:
+            with self.lock:
+                self.running.pop(url, None)
+                current = self.get(url)
+                if current and current['state'] == RUNNING:
+                    # run() didn't say how it went
+                    self.finish(url)
+        self.dispatch()
+
+    def active(self):
+        """ How many jobs are running in this process. """
+        with self.lock:
+            return len(self.running)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue(run=None):
+    """ The ToGo job queue, opened and recovered on first use. run, if
+        given, becomes what runs each job, and starts the queue going.
+
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            path = os.path.join(config.getCacheDir(), DB_NAME)
+            try:
+                _queue = JobQueue(path)
+            except sqlite3.Error as msg:
+                logger.error('Unable to open ToGo queue %s: %s' % (path, msg))
+                _queue = JobQueue(':memory:')
+            waiting = _queue.recover()
+            if waiting:
+                logger.info('%d ToGo transfers waiting' % waiting)
+            housekeeping.every(CHECK, _queue.dispatch, name='togo queue')
+        start = run is not None and _queue.run is None
+        if start:
+            _queue.run = run
+    if start:
+        _queue.dispatch()
+    return _queue
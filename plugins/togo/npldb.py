@@ -0,0 +1,273 @@
+""" Persistent store of each TiVo's Now Playing List.
+
+    ToGo used to keep what it learned of each TiVo's recordings in
+    module-level dicts, which grew with every show ever listed and were
+    lost on restart, so the first visit after one fetched the whole list
+    again. Here each TiVo gets an SQLite database under cache_dir/npl,
+    with one row per recording, keyed by its content URL.
+
+    A sync rewrites only the rows whose data changed, marks every row it
+    saw with a new generation, and then drops the rows it didn't see --
+    the recordings deleted on the TiVo. The TiVo's LastChangeDate is
+    kept with the rows, so a list that hasn't changed since the last
+    sync, even one from before a restart, isn't fetched again.
+    GetShowsList and the flat NPL view are answered from here, paged
+    and sorted by SQLite.
+
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.togo.npldb')
+
+DB_DIR = 'npl'
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS shows (
+    url TEXT PRIMARY KEY,
+    series_id TEXT,
+    episode_id TEXT,
+    title TEXT,
+    capture_date INTEGER,
+    duration INTEGER,
+    source_size INTEGER,
+    position INTEGER NOT NULL,
+    show TEXT,
+    item TEXT,
+    meta TEXT NOT NULL,
+    details_url TEXT,
+    seen INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS shows_position ON shows (position);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT)"""
+
+# TiVo SortOrder field -> column
+SORTS = {'Title': 'title COLLATE NOCASE', 'CaptureDate': 'capture_date',
+         'Duration': 'duration', 'SourceSize': 'source_size'}
+
+def _int(value, base=10):
+    try:
+        return int(value, base)
+    except (TypeError, ValueError):
+        return 0
+
+def order_by(sort):
+    """ An ORDER BY clause for a TiVo-style SortOrder, like
+        "!CaptureDate,Title"; unknown fields are ignored, and ties keep
+        the TiVo's own order.
+
+    """
+    terms = []
+    for field in (sort or '').split(','):
+        field = field.strip()
+        desc = field.startswith('!')
+        column = SORTS.get(field.lstrip('!'))
+        if column:
+            terms.append(column + (' DESC' if desc else ''))
+    return ', '.join(terms + ['position'])
+
+class NPLStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.checked = 0        # when the TiVo was last asked for changes
+        self.shows_cache = None
+
+    def _state(self, key, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?',
+                              (key,)).fetchone()
+        if row:
+            return row[0]
+        return default
+
+    def _set_state(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO state (key, value) '
+                        'VALUES (?, ?)', (key, value))
+
+    def last_change(self):
+        with self.lock:
+            return self._state('lastChangeDate')
+
+    def sync(self, rows, last_change):
+        """ Make the store hold exactly rows, the TiVo's whole list, in
+            order. Each row is a dict with url, series_id, episode_id,
+            show (the GetShowsList entry), item (the NPL fields), meta
+            and details_url. Returns (changed, removed) row counts.
+
+        """
+        changed = 0
+        with self.lock:
+            generation = int(self._state('generation', 0)) + 1
+            for position, row in enumerate(rows):
+                show = json.dumps(row['show'], sort_keys=True)
+                item = json.dumps(row['item'], sort_keys=True)
+                meta = json.dumps(row['meta'], sort_keys=True)
+                cur = self.db.execute(
+                    'UPDATE shows SET seen = ?, position = ? WHERE url = ? '
+                    'AND show IS ? AND item IS ? AND meta = ? '
+                    'AND series_id IS ? AND episode_id IS ?',
+                    (generation, position, row['url'], show, item, meta,
+                     row['series_id'], row['episode_id']))
+                if cur.rowcount:
+                    continue
+                changed += 1
+                self.db.execute(
+                    'INSERT OR REPLACE INTO shows (url, series_id, '
+                    'episode_id, title, capture_date, duration, '
+                    'source_size, position, show, item, meta, '
+                    'details_url, seen) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (row['url'], row['series_id'], row['episode_id'],
+                     row['show'].get('title', ''),
+                     _int(row['item'].get('CaptureDate'), 16),
+                     _int(row['item'].get('Duration')),
+                     _int(row['item'].get('SourceSize')),
+                     position, show, item, meta, row['details_url'],
+                     generation))
+            removed = self.db.execute('DELETE FROM shows WHERE seen < ?',
+                                      (generation,)).rowcount
+            self._set_state('generation', str(generation))
+            self._set_state('lastChangeDate', last_change)
+            self.db.commit()
+            self.shows_cache = None
+        if changed or removed:
+            logger.debug('NPL sync: %d of %d changed, %d removed' %
+                         (changed, len(rows), removed))
+        return changed, removed
+
+    def note(self, url, meta, details_url):
+        """ Remember the metadata of a show seen outside a full sync, as
+            in a folder of the NPL page, so a transfer of it can be named.
+            The next sync keeps it only if it's still on the TiVo.
+
+        """
+        with self.lock:
+            generation = int(self._state('generation', 0))
+            self.db.execute(
+                'INSERT OR IGNORE INTO shows (url, position, meta, '
+                'details_url, seen) VALUES (?, ?, ?, ?, ?)',
+                (url, 1 << 30, json.dumps(meta, sort_keys=True),
+                 details_url, generation))
+            self.db.commit()
+
+    def meta(self, url):
+        """ The metadata.from_container() data for url, or None. """
+        with self.lock:
+            row = self.db.execute('SELECT meta FROM shows WHERE url = ?',
+                                  (url,)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def details_url(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT details_url FROM shows '
+                                  'WHERE url = ?', (url,)).fetchone()
+        return row and row[0]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM shows '
+                                   'WHERE show IS NOT NULL').fetchone()[0]
+
+    def shows_json(self, start=0, count=None, sort=None):
+        """ The GetShowsList answer: series ID -> episode ID -> entry,
+            in the TiVo's order unless sorted, as JSON. The whole list
+            is kept ready until the next sync.
+
+        """
+        whole = not start and count is None and not sort
+        with self.lock:
+            if whole and self.shows_cache is not None:
+                return self.shows_cache
+            rows = self.db.execute(
+                'SELECT series_id, episode_id, show FROM shows '
+                'WHERE show IS NOT NULL ORDER BY %s LIMIT ? OFFSET ?' %
+                order_by(sort),
+                (-1 if count is None else count, max(start, 0))).fetchall()
+        result = {}
+        for series_id, episode_id, show in rows:
+            result.setdefault(series_id, {})[episode_id] = json.loads(show)
+        data = json.dumps(result)
+        if whole:
+            with self.lock:
+                self.shows_cache = data
+        return data
+
+    def items(self, start=0, count=50, sort=None, anchor=None):
+        """ A page of the flat NPL: (ItemStart, TotalItems, entries),
+            each entry the NPL fields merged with the metadata. With an
+            anchor URL, start counts from just after it, as AnchorItem
+            and AnchorOffset do on a TiVo.
+
+        """
+        order = order_by(sort)
+        with self.lock:
+            total = self.db.execute('SELECT COUNT(*) FROM shows '
+                                    'WHERE item IS NOT NULL').fetchone()[0]
+            if anchor:
+                urls = [row[0] for row in self.db.execute(
+                    'SELECT url FROM shows WHERE item IS NOT NULL '
+                    'ORDER BY ' + order)]
+                if anchor in urls:
+                    start += urls.index(anchor) + 1
+            start = max(0, min(start, total))
+            rows = self.db.execute(
+                'SELECT item, meta FROM shows WHERE item IS NOT NULL '
+                'ORDER BY %s LIMIT ? OFFSET ?' % order,
+                (count, start)).fetchall()
+        entries = []
+        for item, meta in rows:
+            entry = json.loads(item)
+            entry.update(json.loads(meta))
+            entries.append(entry)
+        return start, total, entries
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM shows')
+            self.db.execute('DELETE FROM state')
+            self.db.commit()
+            self.shows_cache = None
+            self.checked = 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(tsn):
+    """ The NPLStore for the TiVo with this TSN, opened on first use. If
+        the database can't be opened, the store lives in memory for this
+        run instead.
+
+    """
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', tsn or 'unknown')
+    with _stores_lock:
+        store = _stores.get(name)
+        if store is None:
+            path = os.path.join(config.getCacheDir(), DB_DIR, name + '.db')
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                store = NPLStore(path)
+            except (sqlite3.Error, OSError) as msg:
+                logger.error('Unable to open NPL store %s: %s' % (path, msg))
+                store = NPLStore(':memory:')
+            _stores[name] = store
+        return store
@@ -0,0 +1,240 @@
+""" Fetch a TiVo's Now Playing List a page at a time, several at once.
+
+    A TiVo hands out its NPL 50 items per request, and with urllib2 each
+    request is a new HTTPS connection, with its own TLS handshake and a
+    401 round trip for digest auth, so a big list took a long serial
+    loop. Here each TiVo has a small pool of kept-alive connections that
+    share the last digest challenge, so after the first request most
+    need neither a handshake nor a 401. Once the first page gives the
+    total, the rest are fetched in parallel over the pool, and come back
+    in order. A 503 ("server busy") from the TiVo is waited out and
+    retried, as tivo_open() does.
+
+"""
+
+import base64
+import hashlib
+import http.client
+import logging
+import os
+import re
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+import config
+
+logger = logging.getLogger('pyTivo.togo.nplfetch')
+
+PAGE = 50           # the most items a TiVo returns per request
+BUSY_WAIT = 5       # seconds to wait after a 503
+USER = 'tivo'
+COOKIE = 'sid=ADEADDA7EDEBAC1E'
+
+class Pool(object):
+    """ Up to size kept-alive connections to one TiVo. get() is safe to
+        call from several threads at once; each call waits for a free
+        connection.
+
+    """
+    def __init__(self, baseurl, mak, size=3, tsn=None, timeout=60):
+        parts = urlsplit(baseurl)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.mak = mak
+        self.tsn = tsn
+        self.timeout = timeout
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.challenge = None   # (scheme, params) of the last 401
+        self.count = 0          # digest nonce count
+        self.cnonce = None
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout,
+                context=ssl._create_unverified_context())
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def _authorization(self, uri):
+        with self.lock:
+            if self.challenge is None:
+                return None
+            scheme, params = self.challenge
+            if scheme == 'basic':
+                auth = '%s:%s' % (USER, self.mak)
+                return 'Basic ' + base64.b64encode(
+                    auth.encode('utf-8')).decode('ascii')
+            self.count += 1
+            nc = '%08x' % self.count
+            cnonce = self.cnonce
+        realm = params.get('realm', '')
+        nonce = params.get('nonce', '')
+        md5 = lambda s: hashlib.md5(s.encode('utf-8')).hexdigest()
+        ha1 = md5('%s:%s:%s' % (USER, realm, self.mak))
+        ha2 = md5('GET:' + uri)
+        qop = 'auth' if 'auth' in params.get('qop', '').split(',') else None
+        if qop:
+            response = md5(':'.join((ha1, nonce, nc, cnonce, qop, ha2)))
+        else:
+            response = md5(':'.join((ha1, nonce, ha2)))
+        fields = ['username="%s"' % USER, 'realm="%s"' % realm,
+                  'nonce="%s"' % nonce, 'uri="%s"' % uri,
+                  'response="%s"' % response]
+        if 'opaque' in params:
+            fields.append('opaque="%s"' % params['opaque'])
+        if params.get('algorithm'):
+            fields.append('algorithm=%s' % params['algorithm'])
+        if qop:
+            fields += ['qop=%s' % qop, 'nc=%s' % nc, 'cnonce="%s"' % cnonce]
+        return 'Digest ' + ', '.join(fields)
+
+    def _challenged(self, header, sent):
+        """ Take up a 401's challenge; False if retrying is pointless:
+            there's no challenge, or one we just answered was refused
+            without being stale.
+
+        """
+        scheme, _, rest = (header or '').strip().partition(' ')
+        scheme = scheme.lower()
+        if scheme not in ('digest', 'basic'):
+            return False
+        params = dict((k.lower(), v.strip('"')) for k, v in
+                      re.findall(r'(\w+)=("[^"]*"|[^,\s]*)', rest))
+        with self.lock:
+            if (sent and params.get('stale', '').lower() != 'true' and
+                self.challenge == (scheme, params)):
+                return False
+            self.challenge = (scheme, params)
+            self.count = 0
+            self.cnonce = hashlib.md5(os.urandom(16)).hexdigest()[:16]
+        return True
+
+    def _request(self, conn, uri):
+        headers = {'Cookie': COOKIE}
+        if self.tsn:
+            headers['TSN'] = self.tsn
+        auth = self._authorization(uri)
+        if auth:
+            headers['Authorization'] = auth
+        conn.request('GET', uri, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        return response, body, auth
+
+    def get(self, url):
+        """ The body of url, a URL or path on this TiVo. Raises IOError
+            if it can't be had.
+
+        """
+        parts = urlsplit(url)
+        uri = parts.path + ('?' + parts.query if parts.query else '')
+        with self.slots:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            auth_tries = 0
+            while True:
+                try:
+                    response, body, sent = self._request(conn, uri)
+                except (http.client.HTTPException, OSError) as msg:
+                    conn.close()
+                    if reused:
+                        # The TiVo closed a kept-alive connection
+                        reused = False
+                        conn = self._connect()
+                        continue
+                    raise IOError('%s:%d: %s' % (self.host, self.port, msg))
+
+                if response.status == 401 and auth_tries < 2 and \
+                   self._challenged(response.getheader('WWW-Authenticate'),
+                                    sent):
+                    auth_tries += 1
+                elif response.status == 503:
+                    time.sleep(BUSY_WAIT)
+                elif response.status == 200:
+                    break
+                else:
+                    conn.close()
+                    raise IOError('%s:%d: HTTP Error %d: %s' %
+                                  (self.host, self.port, response.status,
+                                   response.reason))
+                if response.will_close:
+                    conn.close()
+                    conn = self._connect()
+                    reused = False
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+            return body
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+def fetch_pages(pool, url, total, start=PAGE, page=PAGE):
+    """ The NPL pages of url from item start up to total, fetched over
+        the pool at once, as a list of bodies in order.
+
+    """
+    offsets = list(range(start, total, page))
+    pages = [None] * len(offsets)
+    failed = []
+    lock = threading.Lock()
+    todo = iter(range(len(offsets)))
+
+    def worker():
+        while True:
+            with lock:
+                if failed:
+                    return
+                i = next(todo, None)
+            if i is None:
+                return
+            try:
+                pages[i] = pool.get('%s&ItemCount=%d&AnchorOffset=%d' %
+                                    (url, page, offsets[i]))
+            except IOError as msg:
+                with lock:
+                    failed.append(msg)
+
+    threads = [threading.Thread(target=worker, name='nplfetch')
+               for i in range(min(pool.size, len(offsets)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failed:
+        raise failed[0]
+    return pages
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(baseurl, mak):
+    """ The shared Pool for the TiVo at baseurl. """
+    parts = urlsplit(baseurl)
+    key = (parts.scheme, parts.netloc)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.mak != mak:
+            if pool is not None:
+                pool.close()
+            pool = Pool(baseurl, mak, config.getTogoNPLConnections(),
+                        config.get_server('togo_tsn'))
+            _pools[key] = pool
+        return pool
@@ -0,0 +1,154 @@
+""" Adaptive pacing of ToGo transport stream downloads.
+
+    Some TiVos, or the links to them, drop or mangle packets when a
+    transfer runs flat out, so ToGo sleeps a little after each read.
+    With a fixed sleep, clean TiVos were held back for nothing, and a
+    bad link only slowed down after a whole file had been retried.
+    Instead, the Pacer watches the new sync and continuity errors in
+    each chunk (as counted by tscheck): on errors, it raises the sleep
+    by half at once and notes that pace as unsafe; after a few clean
+    seconds, it cuts the sleep by a quarter, but never down to a pace
+    that gave errors. Throughput over a sliding window gives each
+    clean pace a rate, and the pace with the best clean rate, kept
+    above any unsafe one, is remembered for the TiVo, in cache_dir, to
+    start its next download. Where errors cost a retry, the Pacer is
+    given that safe pace as its floor, and doesn't look for faster.
+
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.togo.pacing')
+
+PACING_FILE = 'togo_pacing.json'
+
+WINDOW = 10.0       # seconds of throughput history
+SETTLE = 5.0        # seconds clean at a pace before going faster
+STEP = 0.002        # smallest change, in seconds of sleep per read
+MAX_DELAY = 0.25
+BACKOFF = 1.5       # factor for the sleep after errors
+SPEEDUP = 0.75      # factor for the sleep after a clean spell
+
+class Pacer(object):
+    def __init__(self, delay=0.0, floor=0.0):
+        self.floor = floor
+        self.delay = max(delay, floor)
+        self.samples = collections.deque()  # (time, bytes)
+        self.since = None           # when the pace last changed
+        self.unsafe = None          # the slowest pace that gave errors
+        self.best = None            # (rate, delay) of the best clean spell
+        self.errors = 0
+
+    def record(self, count, errors, now=None):
+        """ Note a chunk of count bytes, with errors new link errors in
+            it, and adjust the pace. Returns the sleep to take now.
+
+        """
+        if now is None:
+            now = time.time()
+        if self.since is None:
+            self.since = now
+        self.samples.append((now, count))
+        while self.samples[0][0] < now - WINDOW:
+            self.samples.popleft()
+
+        if errors:
+            self.errors += errors
+            self.unsafe = max(self.unsafe or 0, self.delay)
+            if self.best and self.best[1] <= self.unsafe:
+                # Clean for a while, but not safe after all
+                self.best = None
+            self._set(max(self.delay * BACKOFF, self.delay + STEP), now)
+            logger.debug('%d stream errors, pacing down to %.3f s' %
+                         (errors, self.delay))
+        elif now - self.since >= SETTLE:
+            rate = self.rate(now, self.since)
+            if self.best is None or rate > self.best[0]:
+                self.best = (rate, self.delay)
+            faster = self.delay * SPEEDUP - STEP
+            if self.unsafe is not None and faster <= self.unsafe:
+                faster = self.unsafe + STEP
+            if faster < self.delay:
+                self._set(faster, now)
+            else:
+                self.since = now
+        return self.delay
+
+    def _set(self, delay, now):
+        self.delay = min(max(delay, self.floor, 0.0), MAX_DELAY)
+        if self.delay < STEP and self.floor < STEP:
+            self.delay = self.floor
+        self.since = now
+
+    def rate(self, now=None, since=None):
+        """ Bytes a second over the window, or since since. """
+        if now is None:
+            now = time.time()
+        start = now - WINDOW
+        if since is not None:
+            start = max(start, since)
+        total = sum(count for when, count in self.samples if when > start)
+        return total / max(now - start, 1e-3)
+
+    def best_delay(self):
+        """ The pace with the best clean throughput, but slower than any
+            that gave errors; or None.
+
+        """
+        if self.best is None:
+            return None
+        if self.unsafe is not None:
+            return max(self.best[1], self.unsafe + STEP)
+        return self.best[1]
+
+class PacingStore(object):
+    """ The best pace found for each TiVo, by TSN, kept as JSON. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.paces = {}
+        try:
+            with open(path) as f:
+                self.paces = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def recall(self, tsn):
+        with self.lock:
+            entry = self.paces.get(tsn)
+        if entry:
+            return entry['delay']
+        return None
+
+    def remember(self, tsn, pacer):
+        delay = pacer.best_delay()
+        if delay is None:
+            return
+        with self.lock:
+            self.paces[tsn] = {'delay': delay, 'rate': pacer.best[0],
+                               'errors': pacer.errors, 'when': time.time()}
+            temp = self.path + '.new'
+            try:
+                with open(temp, 'w') as f:
+                    json.dump(self.paces, f)
+                os.replace(temp, self.path)
+            except (IOError, OSError) as msg:
+                logger.error('Unable to save ToGo pacing: %s' % msg)
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PacingStore(os.path.join(config.getCacheDir(),
+                                              PACING_FILE))
+        return _store
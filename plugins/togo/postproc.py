@@ -0,0 +1,65 @@
+""" ToGo's post-processing stage: a bounded queue and its own workers.
+
+    A transfer used to run its post-processing -- decrypting, writing
+    the .txt metadata, and VideoReDo's QSF, ad scan or profile save,
+    which can take longer than the download -- in the download thread,
+    so the next download from that TiVo waited on it. Now a finished
+    download is handed to this queue, and the download thread goes on
+    to the next job. The queue is bounded, so downloads that outrun the
+    workers wait, rather than piling up files on disk.
+
+"""
+
+import logging
+import queue
+import threading
+
+import config
+
+logger = logging.getLogger('pyTivo.togo.postproc')
+
+class PostProcessor(object):
+    def __init__(self, workers=1, size=4):
+        self.tasks = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='togo post')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        """ Queue func(*args), waiting while the queue is full. """
+        self.tasks.put((func, args))
+
+    def _work(self):
+        while True:
+            func, args = self.tasks.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                func(*args)
+            except Exception as msg:
+                logger.error('Post-processing failed: %s' % msg)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                self.tasks.task_done()
+
+    def pending(self):
+        """ Tasks waiting or being worked on. """
+        with self.lock:
+            return self.tasks.qsize() + self.busy
+
+_post = None
+_post_lock = threading.Lock()
+
+def get_postprocessor():
+    global _post
+    with _post_lock:
+        if _post is None:
+            _post = PostProcessor(config.getToGoPostWorkers(),
+                                  config.getToGoPostQueue())
+        return _post
@@ -5,7 +5,7 @@ import logging
 import os
 import subprocess
 import sys
-import thread
+import threading
 import time
 import urllib2
 import urlparse
@@ -13,20 +13,26 @@ import json
 import pytz
 import struct
 from urllib.parse import quote, unquote
-from xml.dom import minidom
 from datetime import datetime
 
 from Cheetah.Template import Template
 
 import config
+import housekeeping
+import jobqueue
 import metadata
+import npldb
+import nplfetch
+import pacing
+import postproc
+import tivodecoder
+import tscheck
 from plugin import EncodeUnicode, Plugin
 
 if sys.platform == "win32":
     from videoredo import interface
 
 logger = logging.getLogger('pyTivo.togo')
-tag_data = metadata.tag_data
 
 # determine if application is a script file or frozen exe
 SCRIPTDIR = os.path.dirname(__file__)
@@ -70,11 +76,50 @@ NPL_TEMPLATE = file(tnname, 'rb').read()
 mswindows = (sys.platform == "win32")
 
 status = {} # Global variable to control download threads
-tivo_cache = {} # Cache of TiVo NPL
-json_cache = {} # Cache of TiVo json NPL data
-queue = {} # Recordings to download -- list per TiVo
-basic_meta = {} # Data from NPL, parsed, indexed by progam URL
-details_urls = {} # URLs for extended data, indexed by main URL
+tivo_cache = {} # Cache of TiVo NPL pages, parsed to records
+
+NPL_CHECK = 60 # Seconds before a TiVo's NPL is checked for changes again
+
+# GetShowsList icon names for the TiVo's custom icons
+ICONS = {'urn:tivo:image:expires-soon-recording': 'expiring',
+         'urn:tivo:image:expired-recording': 'expired',
+         'urn:tivo:image:save-until-i-delete-recording': 'kuid',
+         'urn:tivo:image:suggestion-recording': 'suggestion',
+         'urn:tivo:image:in-progress-recording': 'inprogress'}
+
+STATUS_EXPIRY = 86400 # Seconds a finished transfer stays in status
+
+def expire_status():
+    """ Forget finished transfers a day after housekeeping first sees
+        them done.
+
+    """
+    now = time.time()
+    for url in list(status):
+        entry = status.get(url)
+        if not entry or not entry['finished'] or entry['running'] or \
+           entry['queued'] or entry['postprocessing']:
+            continue
+        if 'ended' not in entry:
+            entry['ended'] = now
+        elif now - entry['ended'] >= STATUS_EXPIRY:
+            del status[url]
+    jobqueue.get_queue().expire(STATUS_EXPIRY)
+
+housekeeping.every(3600, expire_status, name='togo status expiry')
+
+def new_status(options):
+    """ A fresh status entry for a transfer queued with these options.
+    """
+    entry = {'running': False, 'status': '', 'error': '', 'rate': 0, 'percent': 0,
+             'queued': True, 'size': 0, 'postprocessing': False, 'finished': False,
+             'retry': 0, 'ts_max_retries': int(config.get_server('togo_ts_max_retries', 0)),
+             'ts_error_count': 0, 'best_file': '', 'best_error_count': 0, 'download_delay':0.0,
+             'pacing': 0.0}
+    for key in ('decode', 'save', 'ts_format', 'postprocess', 'postprocess_profile',
+                'postprocess_decrypt', 'postprocess_delete'):
+        entry[key] = options[key]
+    return entry
 
 def null_cookie(name, value):
     return cookielib.Cookie(0, name, value, None, False, '', False, 
@@ -113,6 +158,26 @@ else:
 class ToGo(Plugin):
     CONTENT_TYPE = 'text/html'
 
+    def init(self):
+        self.jobs = jobqueue.get_queue()
+        # Transfers left from before a restart show as queued
+        for url in self.jobs.urls():
+            if url not in status:
+                status[url] = new_status(self.jobs.get(url)['options'])
+        self.jobs = jobqueue.get_queue(self.run_job)
+        # and those that were post-processing go back to it
+        tasks = self.jobs.post_tasks()
+        if tasks:
+            thread = threading.Thread(target=self.resubmit_posts,
+                                      args=(tasks,), name='togo post')
+            thread.daemon = True
+            thread.start()
+
+    def resubmit_posts(self, tasks):
+        post = postproc.get_postprocessor()
+        for task in tasks:
+            post.submit(self.post_process, task)
+
     def tivo_open(self, url):
         # Loop just in case we get a server busy message
         while True:
@@ -154,173 +219,200 @@ class ToGo(Plugin):
 
         handler.send_json(json.dumps(json_config))
 
-    def GetShowsList(self, handler, query):
-        json_config = {}
-        if 'TiVo' in query:
-            tivoIP = query['TiVo'][0]
-            tsn = config.tivos_by_ip(tivoIP)
-            attrs = config.tivos[tsn]
-            tivo_name = attrs.get('name', tivoIP)
-            tivo_mak = config.get_tsn('tivo_mak', tsn)
+    def tivo_url(self, tivoIP):
+        """ The TSN and the NPL base URL of the TiVo at tivoIP, with its
+            MAK registered for the URL.
+
+        """
+        tsn = config.tivos_by_ip(tivoIP)
+        attrs = config.tivos[tsn]
+        tivo_mak = config.get_tsn('tivo_mak', tsn)
+
+        protocol = attrs.get('protocol', 'https')
+        ip_port = '%s:%d' % (tivoIP, attrs.get('port', 443))
+        path = attrs.get('path', DEFPATH)
+        auth_handler.add_password('TiVo DVR', ip_port, 'tivo', tivo_mak)
+        return tsn, '%s://%s%s' % (protocol, ip_port, path)
+
+    def sync_npl(self, tivoIP, force=False):
+        """ Bring the stored Now Playing List of the TiVo at tivoIP up to
+            date, fetching the list only if its LastChangeDate has moved.
+            Unless forced, a TiVo asked in the last NPL_CHECK seconds
+            isn't asked again. Returns the store; raises IOError if the
+            TiVo can't be reached, and leaves the store alone if the list
+            can't be read.
+
+        """
+        tsn, baseurl = self.tivo_url(tivoIP)
+        store = npldb.get_store(tsn)
+        if not force and time.time() - store.checked < NPL_CHECK:
+            return store
+        tivo_name = config.tivos[tsn].get('name', tivoIP)
+        pool = nplfetch.get_pool(baseurl, config.get_tsn('tivo_mak', tsn))
+        theurl = baseurl + '&Recurse=Yes'
+
+        # The first page gives the total, and whether anything changed
+        details, items = metadata.parse_container(pool.get(
+            theurl + '&ItemCount=%d' % nplfetch.PAGE))
+
+        LastChangeDate = details.get('Details/LastChangeDate')
+        if LastChangeDate and store.last_change() == LastChangeDate:
+            logger.info("Shows retrieved from store")
+            store.checked = time.time()
+            return store
 
-            protocol = attrs.get('protocol', 'https')
-            ip_port = '%s:%d' % (tivoIP, attrs.get('port', 443))
-            path = attrs.get('path', DEFPATH)
-            baseurl = '%s://%s%s' % (protocol, ip_port, path)
-
-            # Get the total item count first
-            theurl = baseurl + '&Recurse=Yes&ItemCount=0'
-            auth_handler.add_password('TiVo DVR', ip_port, 'tivo', tivo_mak)
-            try:
-                page = self.tivo_open(theurl)
-            except IOError, e:
-                logger.error("Unable to open TiVo")
-                logger.info("Check your Media Access Key")
-                handler.send_error(404)
-                return
-
-            try:
-                xmldoc = minidom.parse(page)
-                page.close()
-            except:
-                logger.error("XML parser error")
-                handler.send_error(404)
-                return
+        try:
+            TotalItems = int(details.get('Details/TotalItems'))
+        except (TypeError, ValueError):
+            TotalItems = 0
 
-            try:
-                LastChangeDate = unicode(tag_data(xmldoc, 'TiVoContainer/Details/LastChangeDate'))
+        # Then the rest of the pages at once, over the pool
+        logger.debug("Retrieving " + str(TotalItems) + " shows from " +
+                     tivo_name)
+        pages = [items] + [metadata.parse_container(page)[1] for page in
+                           nplfetch.fetch_pages(pool, theurl, TotalItems)]
+
+        rows = []
+        ids = {'generated': 0, 'seen': set()}
+        for i, items in enumerate(pages):
+            wanted = min(nplfetch.PAGE, TotalItems - i * nplfetch.PAGE)
+            # A short page (the list changed under us) is topped up
+            while 0 < len(items) < wanted:
+                more = metadata.parse_container(pool.get(
+                    theurl + '&ItemCount=%d&AnchorOffset=%d' %
+                    (wanted - len(items), i * nplfetch.PAGE + len(items))))[1]
+                if not more:
+                    break
+                items = items + more
+            for item in items:
+                rows.append(self.show_row(item, baseurl, ids))
+        logger.debug("Retrieved " + str(len(rows)) + " from " + tivo_name)
+
+        store.sync(rows, LastChangeDate)
+        store.checked = time.time()
+        return store
+
+    def npl_item(self, item, baseurl):
+        """ The fields of an NPL item record that the NPL page shows, as
+            the TiVo gives them, with the content URL made absolute.
+
+        """
+        entry = {}
+        for tag in ('CopyProtected', 'ContentType'):
+            value = item.get('Details/' + tag, '')
+            if value:
+                entry[tag] = value
+        keys = {'Icon': 'Links/CustomIcon/Url',
+                'Url': 'Links/Content/Url',
+                'Details': 'Links/TiVoVideoDetails/Url',
+                'SourceSize': 'Details/SourceSize',
+                'Duration': 'Details/Duration',
+                'CaptureDate': 'Details/CaptureDate'}
+        for key in keys:
+            value = item.get(keys[key], '')
+            if value:
+                entry[key] = value
+        entry['Url'] = urlparse.urljoin(baseurl, entry.get('Url', ''))
+        return entry
+
+    def show_row(self, item, baseurl, ids):
+        """ The store row for one NPL item record: its GetShowsList
+            entry, NPL fields and metadata. ids carries the generated
+            IDs and the pairs used so far across the whole list.
+
+        """
+        SeriesID = item.get('Details/SeriesId', '')
+        if (not SeriesID):
+            SeriesID = 'PS%08d' % ids['generated']
+            ids['generated'] += 1
+
+        EpisodeID = item.get('Details/ProgramId', '')
+        if (not EpisodeID):
+            EpisodeID = 'PE%08d' % ids['generated']
+            ids['generated'] += 1
+
+        # Check for duplicate episode IDs and replace with generated ID
+        while (SeriesID, EpisodeID) in ids['seen']:
+            EpisodeID = 'PE%08d' % ids['generated']
+            ids['generated'] += 1
+        ids['seen'].add((SeriesID, EpisodeID))
+
+        show = {}
+        show['title'] = item.get('Details/Title', '')
+        show['url'] = item.get('Links/Content/Url', '')
+        show['detailsUrl'] = item.get('Links/TiVoVideoDetails/Url', '')
+        show['episodeTitle'] = item.get('Details/EpisodeTitle', '')
+        show['description'] = item.get('Details/Description', '')
+        show['recordDate'] = item.get('Details/CaptureDate', '')
+        show['duration'] = item.get('Details/Duration', '')
+        try:
+            show['sourceSize'] = int(item.get('Details/SourceSize', ''))
+        except ValueError:
+            show['sourceSize'] = 0
+        show['channel'] = item.get('Details/SourceChannel', '')
+        show['stationID'] = item.get('Details/SourceStation', '')
+        show['episodeID'] = EpisodeID
+        show['seriesID'] = SeriesID
+
+        show['inProgress'] = item.get('Details/InProgress', '') == 'Yes'
+        show['isProtected'] = item.get('Details/CopyProtected', '') == 'Yes'
+
+        icon = item.get('Links/CustomIcon/Url', '')
+        show['isSuggestion'] = icon == 'urn:tivo:image:suggestion-recording'
+
+        if show['isProtected']:
+            show['icon'] = 'protected'
+        else:
+            show['icon'] = ICONS.get(icon, 'normal')
 
-                # Check date of cache
-                if (tsn in json_cache and json_cache[tsn]['lastChangeDate'] == LastChangeDate):
-                    logger.info("Shows retrieved from cache")
-                    handler.send_json(json_cache[tsn]['data'])
-                    return
-            except:
-                pass
+        url = urlparse.urljoin(baseurl, show['url'])
+        show['url'] = url
+        return {'url': url, 'series_id': SeriesID, 'episode_id': EpisodeID,
+                'show': show, 'item': self.npl_item(item, baseurl),
+                'meta': metadata.from_container(item),
+                'details_url': show['detailsUrl']}
 
-            global basic_meta
-            global details_urls
+    def show_meta(self, url, tivoIP):
+        """ What the NPL said about the recording at url. """
+        return npldb.get_store(config.tivos_by_ip(tivoIP)).meta(url) or {}
 
-            # loop through grabbing 50 items at a time (50 is max TiVo will return)
+    def GetShowsList(self, handler, query):
+        json_config = {}
+        if 'TiVo' in query:
+            tivoIP = query['TiVo'][0]
+            store = npldb.get_store(config.tivos_by_ip(tivoIP))
             try:
-                TotalItems = int(unicode(tag_data(xmldoc, 'TiVoContainer/Details/TotalItems')))
-            except:
-                TotalItems = 0
-
-            if TotalItems <= 0:
-                handler.send_json(json_config)
-                return
-
-            GotItems = 0
-            GeneratedID = 0
-            while (GotItems < TotalItems):
-                logger.debug("Retrieving shows " + str(GotItems) + "-" + str(GotItems+50) + " of " + str(TotalItems) + " from " + tivo_name )
-                theurl = baseurl + '&Recurse=Yes&ItemCount=50'
-                theurl += '&AnchorOffset=%d' % GotItems
-                auth_handler.add_password('TiVo DVR', ip_port, 'tivo', tivo_mak)
-                try:
-                    page = self.tivo_open(theurl)
-                except IOError, e:
+                # Served from the store; the TiVo is asked at most every
+                # NPL_CHECK seconds, unless a refresh is asked for
+                self.sync_npl(tivoIP, query.get('Refresh', [''])[0] == 'Yes')
+            except IOError as e:
+                if not store.count():
+                    logger.error("Unable to open TiVo")
+                    logger.info("Check your Media Access Key")
+                    handler.send_error(404)
+                    return
+                logger.info("Unable to reach %s; shows retrieved from store" % tivoIP)
+            except Exception as msg:
+                logger.error("Unable to update shows from %s: %s" % (tivoIP, msg))
+                if not store.count():
                     handler.send_error(404)
                     return
 
-                try:
-                    xmldoc = minidom.parse(page)
-                    items = xmldoc.getElementsByTagName('Item')
-                    page.close()
-                except:
-                    logger.error("XML parser error")
-                    break
-
-                if len(items) <= 0:
-                    logger.info("items collection empty")
-                    break
-
-                for item in items:
-                    SeriesID = tag_data(item, 'Details/SeriesId')
-                    if (not SeriesID):
-                        SeriesID = 'PS%08d' % GeneratedID
-                        GeneratedID += 1
-
-                    if (not SeriesID in json_config):
-                        json_config[SeriesID] = {}
-
-                    EpisodeID = tag_data(item, 'Details/ProgramId')
-                    if (not EpisodeID):
-                        EpisodeID = 'PE%08d' % GeneratedID
-                        GeneratedID += 1
-
-                    # Check for duplicate episode IDs and replace with generated ID
-                    while EpisodeID in json_config[SeriesID]:
-                        EpisodeID = 'PE%08d' % GeneratedID
-                        GeneratedID += 1
-
-                    json_config[SeriesID][EpisodeID] = {}
-
-                    json_config[SeriesID][EpisodeID]['title'] = tag_data(item, 'Details/Title')
-                    json_config[SeriesID][EpisodeID]['url'] = tag_data(item, 'Links/Content/Url')
-                    json_config[SeriesID][EpisodeID]['detailsUrl'] = tag_data(item, 'Links/TiVoVideoDetails/Url')
-                    json_config[SeriesID][EpisodeID]['episodeTitle'] = tag_data(item, 'Details/EpisodeTitle')
-                    json_config[SeriesID][EpisodeID]['description'] = tag_data(item, 'Details/Description')
-                    json_config[SeriesID][EpisodeID]['recordDate'] = tag_data(item, 'Details/CaptureDate')
-                    json_config[SeriesID][EpisodeID]['duration'] = tag_data(item, 'Details/Duration')
-                    json_config[SeriesID][EpisodeID]['sourceSize'] = int(tag_data(item, 'Details/SourceSize'))
-                    json_config[SeriesID][EpisodeID]['channel'] = tag_data(item, 'Details/SourceChannel')
-                    json_config[SeriesID][EpisodeID]['stationID'] = tag_data(item, 'Details/SourceStation')
-                    json_config[SeriesID][EpisodeID]['episodeID'] = EpisodeID
-                    json_config[SeriesID][EpisodeID]['seriesID'] = SeriesID
-
-                    if tag_data(item, 'Details/InProgress') == 'Yes':
-                        json_config[SeriesID][EpisodeID]['inProgress'] = True
-                    else:
-                        json_config[SeriesID][EpisodeID]['inProgress'] = False
-
-                    if tag_data(item, 'Details/CopyProtected') == 'Yes':
-                        json_config[SeriesID][EpisodeID]['isProtected'] = True
-                    else:
-                        json_config[SeriesID][EpisodeID]['isProtected'] = False
-
-                    if tag_data(item, 'Links/CustomIcon/Url') == 'urn:tivo:image:suggestion-recording':
-                        json_config[SeriesID][EpisodeID]['isSuggestion'] = True
-                    else:
-                        json_config[SeriesID][EpisodeID]['isSuggestion'] = False
-
-                    if tag_data(item, 'Details/CopyProtected') == 'Yes':
-                        json_config[SeriesID][EpisodeID]['icon'] = 'protected'
-                    elif tag_data(item, 'Links/CustomIcon/Url') == 'urn:tivo:image:expires-soon-recording':
-                        json_config[SeriesID][EpisodeID]['icon'] = 'expiring'
-                    elif tag_data(item, 'Links/CustomIcon/Url') == 'urn:tivo:image:expired-recording':
-                        json_config[SeriesID][EpisodeID]['icon'] = 'expired'
-                    elif tag_data(item, 'Links/CustomIcon/Url') == 'urn:tivo:image:save-until-i-delete-recording':
-                        json_config[SeriesID][EpisodeID]['icon'] = 'kuid'
-                    elif tag_data(item, 'Links/CustomIcon/Url') == 'urn:tivo:image:suggestion-recording':
-                        json_config[SeriesID][EpisodeID]['icon'] = 'suggestion'
-                    elif tag_data(item, 'Links/CustomIcon/Url') == 'urn:tivo:image:in-progress-recording':
-                        json_config[SeriesID][EpisodeID]['icon'] = 'inprogress'
-                    else:
-                        json_config[SeriesID][EpisodeID]['icon'] = 'normal'
-
-                    url = urlparse.urljoin(baseurl, json_config[SeriesID][EpisodeID]['url'])
-                    json_config[SeriesID][EpisodeID]['url'] = url
-                    if not url in basic_meta:
-                        basic_meta[url] = metadata.from_container(item)
-                        if 'detailsUrl' in json_config[SeriesID][EpisodeID]:
-                            details_urls[url] = json_config[SeriesID][EpisodeID]['detailsUrl']
-
-                itemCount = tag_data(xmldoc, 'TiVoContainer/ItemCount')
-                try:
-                    logger.debug("Retrieved " + itemCount + " from " + tivo_name)
-                    GotItems += int(itemCount)
-                except ValueError:
-                    GotItems += len(items)
-
-
-            # Cache data for reuse
-            json_cache[tsn] = {}
-            json_cache[tsn]['data'] = json.dumps(json_config)
-            json_cache[tsn]['lastChangeDate'] = LastChangeDate
+            # Optional paging and sorting, TiVo style
+            start = 0
+            count = None
+            sort = None
+            try:
+                if 'AnchorOffset' in query:
+                    start = int(query['AnchorOffset'][0])
+                if 'ItemCount' in query:
+                    count = int(query['ItemCount'][0])
+            except ValueError:
+                pass
+            if 'SortOrder' in query:
+                sort = query['SortOrder'][0]
 
-            handler.send_json(json_cache[tsn]['data'])
+            handler.send_json(store.shows_json(start, count, sort))
         else:
             handler.send_json(json.dumps(json_config))
 
@@ -328,19 +420,15 @@ class ToGo(Plugin):
         json_config = {}
         if 'TiVo' in query:
             tivoIP = query['TiVo'][0]
-            if tivoIP in queue:
-                json_config['urls'] = []
-                for url in queue[tivoIP]:
-                    json_config['urls'].append(url)
+            urls = self.jobs.urls(config.tivos_by_ip(tivoIP))
+            if urls:
+                json_config['urls'] = urls
 
         handler.send_json(json.dumps(json_config))
 
     def GetTotalQueueCount(self, handler, query):
         json_config = {}
-        json_config['count'] = 0
-
-        for tivoIP in queue:
-            json_config['count'] += len(queue[tivoIP])
+        json_config['count'] = self.jobs.count()
 
         handler.send_json(json.dumps(json_config))
 
@@ -349,6 +437,15 @@ class ToGo(Plugin):
 
         if 'Url' in query:
             url = query['Url'][0]
+            job = self.jobs.get(url)
+            if job:
+                json_config['priority'] = job['priority']
+                json_config['deferred'] = job['deferred']
+                if url not in status:
+                    # Known only from the queue, as after a restart
+                    json_config['state'] = job['state']
+                    if job['error']:
+                        json_config['error'] = job['error']
             if url in status:
                 state = 'queued'
                 if status[url]['running'] == True:
@@ -370,6 +467,8 @@ class ToGo(Plugin):
                 json_config['retry'] = status[url]['retry']
                 json_config['maxRetries'] = status[url]['ts_max_retries']
                 json_config['errorCount'] = status[url]['ts_error_count']
+                json_config['errorKinds'] = status[url].get('ts_errors', {})
+                json_config['pacing'] = status[url].get('pacing', 0.0)
 
         handler.send_json(json.dumps(json_config))
 
@@ -406,96 +505,100 @@ class ToGo(Plugin):
             ip_port = '%s:%d' % (tivoIP, attrs.get('port', 443))
             path = attrs.get('path', DEFPATH)
             baseurl = '%s://%s%s' % (protocol, ip_port, path)
-            theurl = baseurl
-            if 'Folder' in query:
-                folder = query['Folder'][0]
-                theurl = urlparse.urljoin(theurl, folder)
-            theurl += '&ItemCount=%d' % shows_per_page
-            if 'AnchorItem' in query:
-                theurl += '&AnchorItem=' + quote(query['AnchorItem'][0])
-            if 'AnchorOffset' in query:
-                theurl += '&AnchorOffset=' + query['AnchorOffset'][0]
-            if 'SortOrder' in query:
-                theurl += '&SortOrder=' + query['SortOrder'][0]
-            if 'Recurse' in query:
-                    theurl += '&Recurse=' + query['Recurse'][0]
-
-            if (theurl not in tivo_cache or
-                (time.time() - tivo_cache[theurl]['thepage_time']) >= 60):
-                # if page is not cached or old then retreive it
-                auth_handler.add_password('TiVo DVR', ip_port, 'tivo', tivo_mak)
+            store = npldb.get_store(tsn)
+
+            if 'Folder' not in query and query.get('Recurse', [''])[0] == 'Yes':
+                # The flat list comes from the store
                 try:
-                    page = self.tivo_open(theurl)
-                except IOError, e:
-                    handler.redir(UNABLE % (tivoIP, cgi.escape(str(e))), 10)
-                    return
-                tivo_cache[theurl] = {'thepage': minidom.parse(page),
-                                      'thepage_time': time.time()}
-                page.close()
+                    self.sync_npl(tivoIP)
+                except Exception as e:
+                    if not store.count():
+                        handler.redir(UNABLE % (tivoIP, cgi.escape(str(e))), 10)
+                        return
+                    logger.info("Unable to update shows from %s: %s" % (tivoIP, e))
+
+                anchor = None
+                if 'AnchorItem' in query:
+                    anchor = query['AnchorItem'][0]
+                offset = 0
+                if 'AnchorOffset' in query:
+                    offset = getint(query['AnchorOffset'][0])
+                sort = None
+                if 'SortOrder' in query:
+                    sort = query['SortOrder'][0]
+
+                ItemStart, TotalItems, data = store.items(offset,
+                    shows_per_page, sort, anchor)
+                ItemCount = len(data)
+                title = ''
+                if data:
+                    FirstAnchor = data[0]['Url']
+                for entry in data:
+                    self.format_entry(entry)
+            else:
+                theurl = baseurl
+                if 'Folder' in query:
+                    folder = query['Folder'][0]
+                    theurl = urlparse.urljoin(theurl, folder)
+                theurl += '&ItemCount=%d' % shows_per_page
+                if 'AnchorItem' in query:
+                    theurl += '&AnchorItem=' + quote(query['AnchorItem'][0])
+                if 'AnchorOffset' in query:
+                    theurl += '&AnchorOffset=' + query['AnchorOffset'][0]
+                if 'SortOrder' in query:
+                    theurl += '&SortOrder=' + query['SortOrder'][0]
+                if 'Recurse' in query:
+                        theurl += '&Recurse=' + query['Recurse'][0]
+
+                if (theurl not in tivo_cache or
+                    (time.time() - tivo_cache[theurl]['thepage_time']) >= 60):
+                    # if page is not cached or old then retreive it
+                    auth_handler.add_password('TiVo DVR', ip_port, 'tivo', tivo_mak)
+                    try:
+                        page = self.tivo_open(theurl)
+                    except IOError as e:
+                        handler.redir(UNABLE % (tivoIP, cgi.escape(str(e))), 10)
+                        return
+                    tivo_cache[theurl] = {'thepage': metadata.parse_container(page),
+                                          'thepage_time': time.time()}
+                    page.close()
 
-            xmldoc = tivo_cache[theurl]['thepage']
-            items = xmldoc.getElementsByTagName('Item')
+                details, items = tivo_cache[theurl]['thepage']
 
-            TotalItems = tag_data(xmldoc, 'TiVoContainer/Details/TotalItems')
-            ItemStart = tag_data(xmldoc, 'TiVoContainer/ItemStart')
-            ItemCount = tag_data(xmldoc, 'TiVoContainer/ItemCount')
-            title = tag_data(xmldoc, 'TiVoContainer/Details/Title')
-            if items:
-                FirstAnchor = tag_data(items[0], 'Links/Content/Url')
+                TotalItems = details.get('Details/TotalItems', '')
+                ItemStart = details.get('ItemStart', '')
+                ItemCount = details.get('ItemCount', '')
+                title = details.get('Details/Title', '')
+                if items:
+                    FirstAnchor = items[0].get('Links/Content/Url', '')
 
-            data = []
-            for item in items:
-                entry = {}
-                for tag in ('CopyProtected', 'ContentType'):
-                    value = tag_data(item, 'Details/' + tag)
-                    if value:
-                        entry[tag] = value
-                if entry['ContentType'].startswith('x-tivo-container'):
-                    entry['Url'] = tag_data(item, 'Links/Content/Url')
-                    entry['Title'] = tag_data(item, 'Details/Title')
-                    entry['TotalItems'] = tag_data(item, 'Details/TotalItems')
-                    lc = tag_data(item, 'Details/LastCaptureDate')
-                    if not lc:
-                        lc = tag_data(item, 'Details/LastChangeDate')
-                    entry['LastChangeDate'] = time.strftime('%b %d, %Y',
-                        time.localtime(int(lc, 16)))
-                else:
-                    keys = {'Icon': 'Links/CustomIcon/Url',
-                            'Url': 'Links/Content/Url',
-                            'Details': 'Links/TiVoVideoDetails/Url',
-                            'SourceSize': 'Details/SourceSize',
-                            'Duration': 'Details/Duration',
-                            'CaptureDate': 'Details/CaptureDate'}
-                    for key in keys:
-                        value = tag_data(item, keys[key])
-                        if value:
-                            entry[key] = value
-
-                    if 'SourceSize' in entry:
-                        rawsize = entry['SourceSize']
-                        entry['SourceSize'] = metadata.human_size(rawsize)
-
-                    if 'Duration' in entry:
-                        dur = getint(entry['Duration']) / 1000
-                        entry['Duration'] = ( '%d:%02d:%02d' %
-                            (dur / 3600, (dur % 3600) / 60, dur % 60) )
-
-                    if 'CaptureDate' in entry:
-                        entry['CaptureDate'] = time.strftime('%b %d, %Y',
-                            time.localtime(int(entry['CaptureDate'], 16)))
-
-                    url = urlparse.urljoin(baseurl, entry['Url'])
-                    entry['Url'] = url
-                    if url in basic_meta:
-                        entry.update(basic_meta[url])
+                data = []
+                for item in items:
+                    if item.get('Details/ContentType', '').startswith('x-tivo-container'):
+                        entry = {}
+                        for tag in ('CopyProtected', 'ContentType'):
+                            value = item.get('Details/' + tag, '')
+                            if value:
+                                entry[tag] = value
+                        entry['Url'] = item.get('Links/Content/Url', '')
+                        entry['Title'] = item.get('Details/Title', '')
+                        entry['TotalItems'] = item.get('Details/TotalItems', '')
+                        lc = item.get('Details/LastCaptureDate', '')
+                        if not lc:
+                            lc = item.get('Details/LastChangeDate', '')
+                        entry['LastChangeDate'] = time.strftime('%b %d, %Y',
+                            time.localtime(int(lc, 16)))
                     else:
-                        basic_data = metadata.from_container(item)
+                        entry = self.npl_item(item, baseurl)
+                        url = entry['Url']
+                        basic_data = store.meta(url)
+                        if basic_data is None:
+                            basic_data = metadata.from_container(item)
+                            store.note(url, basic_data, entry.get('Details'))
                         entry.update(basic_data)
-                        basic_meta[url] = basic_data
-                        if 'Details' in entry:
-                            details_urls[url] = entry['Details']
+                        self.format_entry(entry)
 
-                data.append(entry)
+                    data.append(entry)
         else:
             data = []
             tivoIP = ''
@@ -511,10 +614,11 @@ class ToGo(Plugin):
         t.quote = quote
         t.folder = folder
         t.status = status
-        if tivoIP in queue:
-            t.queue = queue[tivoIP]
+        t.queue = self.jobs.urls(tsn)
+        t.togo_hours = config.getToGoHours(tsn)
         t.has_tivodecode = has_tivodecode
         t.has_tivolibre = has_tivolibre
+        t.has_tivodecoder = tivodecoder.use_python()
         t.togo_mpegts = config.is_ts_capable(tsn)
         t.tname = tivo_name
         t.tivoIP = tivoIP
@@ -530,119 +634,152 @@ class ToGo(Plugin):
         handler.send_html(str(t), refresh='300')
 
 
+    def format_entry(self, entry):
+        """ Put an NPL page entry's size, duration and date in the form
+            the page shows them.
+
+        """
+        if 'SourceSize' in entry:
+            rawsize = entry['SourceSize']
+            entry['SourceSize'] = metadata.human_size(rawsize)
+
+        if 'Duration' in entry:
+            try:
+                dur = int(entry['Duration']) / 1000
+            except ValueError:
+                dur = 0
+            entry['Duration'] = ( '%d:%02d:%02d' %
+                (dur / 3600, (dur % 3600) / 60, dur % 60) )
+
+        if 'CaptureDate' in entry:
+            entry['CaptureDate'] = time.strftime('%b %d, %Y',
+                time.localtime(int(entry['CaptureDate'], 16)))
+
     def get_out_file(self, url, tivoIP, togo_path):
         # Use TiVo Desktop style naming
-        if url in basic_meta:
-            if 'title' in basic_meta[url]:
-                title = basic_meta[url]['title']
+        meta = self.show_meta(url, tivoIP)
+        if 'title' in meta:
+            title = meta['title']
 
-                episodeTitle = ''
-                if 'episodeTitle' in basic_meta[url]:
-                    episodeTitle = basic_meta[url]['episodeTitle']
+            episodeTitle = ''
+            if 'episodeTitle' in meta:
+                episodeTitle = meta['episodeTitle']
 
-                recordDate = datetime.now()
-                if 'recordDate' in basic_meta[url]:
-                    recordDate = datetime.fromtimestamp(int(basic_meta[url]['recordDate'], 0), pytz.utc)
+            recordDate = datetime.now()
+            if 'recordDate' in meta:
+                recordDate = datetime.fromtimestamp(int(meta['recordDate'], 0), pytz.utc)
 
-                callSign = ''
-                if 'callsign' in basic_meta[url]:
-                    callSign = basic_meta[url]['callsign']
+            callSign = ''
+            if 'callsign' in meta:
+                callSign = meta['callsign']
 
-                count = 1
-                while True:
-                    fileName = title
+            count = 1
+            while True:
+                fileName = title
 
-                    try:
-                        sortable = config.config.getboolean('Server', 'togo_sortable_names')
-                    except:
-                        sortable = False
+                try:
+                    sortable = config.config.getboolean('Server', 'togo_sortable_names')
+                except:
+                    sortable = False
 
-                    if sortable == True:
-                        fileName += ' - '
-                        fileName += recordDate.strftime('%Y-%m-%d')
+                if sortable == True:
+                    fileName += ' - '
+                    fileName += recordDate.strftime('%Y-%m-%d')
 
-                        if len(episodeTitle):
-                            fileName += ' - \'' + episodeTitle + '\''
+                    if len(episodeTitle):
+                        fileName += ' - \'' + episodeTitle + '\''
 
-                        if len(callSign):
-                            fileName += ' (' + callSign + ')'
+                    if len(callSign):
+                        fileName += ' (' + callSign + ')'
+                else:
+                    if len(episodeTitle):
+                        fileName += ' - \'' + episodeTitle + '\''
+
+                    fileName += ' (Recorded '
+                    fileName += recordDate.strftime('%b %d, %Y')
+                    if len(callSign):
+                        fileName += ', ' + callSign
+                    fileName += ')'
+
+                ts = status[url]['ts_format'] and config.is_ts_capable(config.tivos_by_ip(tivoIP))
+                if not status[url]['decode']:
+                    if ts:
+                        fileName += ' (TS)'
                     else:
-                        if len(episodeTitle):
-                            fileName += ' - \'' + episodeTitle + '\''
-
-                        fileName += ' (Recorded '
-                        fileName += recordDate.strftime('%b %d, %Y')
-                        if len(callSign):
-                            fileName += ', ' + callSign
-                        fileName += ')'
-
-                    ts = status[url]['ts_format'] and config.is_ts_capable(config.tivos_by_ip(tivoIP))
-                    if not status[url]['decode']:
-                        if ts:
-                            fileName += ' (TS)'
-                        else:
-                            fileName += ' (PS)'
+                        fileName += ' (PS)'
 
-                    if count > 1:
-                        fileName += ' (%d)' % count
+                if count > 1:
+                    fileName += ' (%d)' % count
 
-                    if status[url]['decode']:
-                        if ts:
-                            fileName += '.ts'
-                        else:
-                            fileName += '.mpg'
+                if status[url]['decode']:
+                    if ts:
+                        fileName += '.ts'
                     else:
-                        fileName += '.tivo'
+                        fileName += '.mpg'
+                else:
+                    fileName += '.tivo'
 
-                    for ch in BADCHAR:
-                        fileName = fileName.replace(ch, BADCHAR[ch])
+                for ch in BADCHAR:
+                    fileName = fileName.replace(ch, BADCHAR[ch])
 
-                    if os.path.isfile(os.path.join(togo_path, fileName)):
-                        count += 1
-                        continue
+                if os.path.isfile(os.path.join(togo_path, fileName)):
+                    count += 1
+                    continue
 
-                    return os.path.join(togo_path, fileName)
+                return os.path.join(togo_path, fileName)
 
-            # If we get here then use old style naming
-            parse_url = urlparse.urlparse(url)
+        # If we get here then use old style naming
+        parse_url = urlparse.urlparse(url)
 
-            name = unquote(parse_url[2]).split('/')[-1].split('.')
-            try:
-                id = unquote(parse_url[4]).split('id=')[1]
-                name.insert(-1, ' - ' + id)
-            except:
-                pass
-            ts = status[url]['ts_format'] and config.is_ts_capable(config.tivos_by_ip(tivoIP))
-            if status[url]['decode']:
-                if ts:
-                    name[-1] = 'ts'
-                else:
-                    name[-1] = 'mpg'
+        name = unquote(parse_url[2]).split('/')[-1].split('.')
+        try:
+            id = unquote(parse_url[4]).split('id=')[1]
+            name.insert(-1, ' - ' + id)
+        except:
+            pass
+        ts = status[url]['ts_format'] and config.is_ts_capable(config.tivos_by_ip(tivoIP))
+        if status[url]['decode']:
+            if ts:
+                name[-1] = 'ts'
             else:
-                if ts:
-                    name.insert(-1, ' (TS)')
-                else:
-                    name.insert(-1, ' (PS)')
+                name[-1] = 'mpg'
+        else:
+            if ts:
+                name.insert(-1, ' (TS)')
+            else:
+                name.insert(-1, ' (PS)')
 
-            nameHold =  name
-            name.insert(-1, '.')
+        nameHold =  name
+        name.insert(-1, '.')
 
-            count = 2
-            newName = name
-            while (os.path.isfile(os.path.join(togo_path, ''.join(newName)))):
-                newName = nameHold
-                newName.insert(-1, ' (%d)' % count)
-                newName.insert(-1, '.')
-                count += 1
+        count = 2
+        newName = name
+        while (os.path.isfile(os.path.join(togo_path, ''.join(newName)))):
+            newName = nameHold
+            newName.insert(-1, ' (%d)' % count)
+            newName.insert(-1, '.')
+            count += 1
 
-            name = newName
-            name = ''.join(name)
-            for ch in BADCHAR:
-                name = name.replace(ch, BADCHAR[ch])
+        name = newName
+        name = ''.join(name)
+        for ch in BADCHAR:
+            name = name.replace(ch, BADCHAR[ch])
 
-            return os.path.join(togo_path, name)
+        return os.path.join(togo_path, name)
 
 
+    def ts_errors(self, url, errors, ts_check):
+        """ Log and count the errors the TS check found; True if there
+            were any.
+
+        """
+        for kind, start, end in errors:
+            logger.info('TS %s error detected: %d - %d' % (kind, start, end))
+        if errors:
+            status[url]['ts_error_count'] = ts_check.errors
+            status[url]['ts_errors'] = dict(ts_check.counts)
+        return bool(errors)
+
     def get_tivo_file(self, tivoIP, url, mak, togo_path):
         # global status
         status[url].update({'running': True, 'queued': False})
@@ -669,8 +806,16 @@ class ToGo(Plugin):
 
         has_tivodecode = bool(config.get_bin('tivodecode'))
         has_tivolibre = bool(config.get_bin('tivolibre'))
-        decode = status[url]['decode'] and (has_tivodecode or has_tivolibre)
-        if decode:
+        python_decoder = tivodecoder.use_python(ts_format)
+        decode = status[url]['decode'] and (has_tivodecode or has_tivolibre or
+                                            python_decoder)
+        tivodecode = None
+        raw = None
+        if decode and python_decoder:
+            # Downloaded as is, and decrypted in post-processing
+            raw = outfile + '.part'
+            f = open(raw, 'wb')
+        elif decode:
             fname = outfile
             if mswindows:
                 fname = fname.encode('cp1252')
@@ -686,6 +831,7 @@ class ToGo(Plugin):
             f = tivodecode.stdin
         else:
             f = open(outfile, 'wb')
+        self.jobs.started(url, raw or outfile)
 
 
         save_txt = status[url]['save']
@@ -700,7 +846,26 @@ class ToGo(Plugin):
         ts_error_mode = config.get_server('togo_ts_error_mode', 'ignore')
         slow_on_retry = bool(config.get_server('togo_slow_on_retry', 'true') == 'true')
         download_delay = float(5 - int(config.get_server('togo_download_speed', 5))) * 0.01;
+        tsn = config.tivos_by_ip(tivoIP)
+        adaptive = ts_format and config.getToGoAdaptiveSpeed(tsn)
+        if adaptive:
+            # Start at the best pace found for this TiVo before, or
+            # where the last try left off; that's slowed down already,
+            # so togo_slow_on_retry doesn't add to it
+            remembered = pacing.get_store().recall(tsn)
+            if remembered is not None:
+                download_delay = remembered
+            download_delay = max(download_delay, status[url]['pacing'])
         download_delay += status[url]['download_delay'];
+        pacer = None
+        if adaptive:
+            floor = 0.0
+            if ts_error_mode != 'ignore':
+                # Errors cost this download; hold to the pace known to
+                # be safe, rather than look for a faster one
+                floor = download_delay
+            pacer = pacing.Pacer(download_delay, floor)
+        link_errors = 0
         logger.info('Download delay set to %f' % download_delay)
 
         try:
@@ -715,27 +880,15 @@ class ToGo(Plugin):
             f.write(output)
 
             bytes_written += length
+            ts_check = tscheck.TSChecker(bytes_written)
             while status[url]['running']:
                 output = handle.read(282000) # Size needs to be divisible by 188 (524144)
                 if not output:
                     break
 
                 if ts_format:
-                    cur_byte = 0
-                    sync_loss_start = -1
-                    while cur_byte < len(output):
-                        if struct.unpack_from('>B', output, cur_byte)[0] != 0x47:
-                            sync_loss = True
-                            status[url]['ts_error_count'] += 1
-
-                            if sync_loss_start == -1:
-                                sync_loss_start = cur_byte
-                        else:
-                            if sync_loss_start != -1:
-                                logger.info('TS sync loss detected: %d - %d' % ((sync_loss_start + bytes_written), (cur_byte + bytes_written)))
-                                sync_loss_start = -1
-
-                        cur_byte += 188
+                    if self.ts_errors(url, ts_check.feed(output), ts_check):
+                        sync_loss = True
 
                     if sync_loss and ts_error_mode !=  'ignore':
                         if status[url]['retry'] < status[url]['ts_max_retries']:
@@ -764,8 +917,23 @@ class ToGo(Plugin):
                     length = 0
                     last_interval = now
 
+                if pacer:
+                    # Only sync and continuity errors come from the link;
+                    # PCR jumps and flagged packets come with the recording
+                    errors = (ts_check.counts[tscheck.SYNC_LOSS] +
+                              ts_check.counts[tscheck.CONTINUITY])
+                    download_delay = pacer.record(len(output),
+                                                  errors - link_errors)
+                    link_errors = errors
+                    status[url]['pacing'] = download_delay
+
                 time.sleep(download_delay)
 
+            if ts_format and status[url]['running']:
+                # A short last packet
+                if self.ts_errors(url, ts_check.finish(), ts_check):
+                    sync_loss = True
+
             if status[url]['running']:
                 if not sync_loss:
                     status[url]['error'] = ''
@@ -778,7 +946,12 @@ class ToGo(Plugin):
         handle.close()
         f.close()
 
-        if decode:
+        if pacer:
+            # A retry goes on from the safe pace this try found
+            status[url]['pacing'] = pacer.best_delay() or pacer.delay
+            pacing.get_store().remember(tsn, pacer)
+
+        if tivodecode:
             while tivodecode.poll() is None:
                 time.sleep(1)
 
@@ -826,21 +999,6 @@ class ToGo(Plugin):
 
                     break
 
-            metafile_name = ''
-            if save_txt and os.path.isfile(outfile):
-                meta = basic_meta[url]
-                try:
-                    handle = self.tivo_open(details_urls[url])
-                    meta.update(metadata.from_details(handle.read()))
-                    handle.close()
-                except:
-                    pass
-
-                metafile_name = outfile + '.txt'
-                metafile = open(metafile_name, 'w')
-                metadata.dump(metafile, meta)
-                metafile.close()
-
             status[url]['best_file'] = outfile
             status[url]['best_error_count'] = status[url]['ts_error_count']
 
@@ -850,22 +1008,20 @@ class ToGo(Plugin):
                 status[url]['queued'] = True
                 status[url]['retry'] += 1
                 status[url]['ts_error_count'] = 0
+                status[url]['ts_errors'] = {}
                 logger.info('TS sync losses detected, retrying download (%d)' % status[url]['retry'])
 
-                if slow_on_retry:
+                if slow_on_retry and not adaptive:
                     status[url]['download_delay'] += 0.01
                     logger.info('Increasing download delay')
 
-                queue[tivoIP].insert(1, url)
+                self.jobs.requeue(url)
             else:
-                if status[url]['postprocess'] != 'none':
-                    self.post_process_file(url, outfile, metafile_name)
-                else:
-                    status[url]['finished'] = True
+                self.queue_post(url, tivoIP, outfile, raw, save_txt)
 
 
         else:
-            os.remove(outfile)
+            os.remove(raw or outfile)
             logger.info('[%s] Transfer of "%s" from %s aborted' %
                         (time.strftime('%d/%b/%Y %H:%M:%S'), outfile,
                          tivo_name))
@@ -876,20 +1032,109 @@ class ToGo(Plugin):
                 status[url]['queued'] = True
                 status[url]['retry'] += 1
                 status[url]['ts_error_count'] = 0
+                status[url]['ts_errors'] = {}
                 logger.info('TS sync losses detected, retrying download (%d)' % status[url]['retry'])
 
-                if slow_on_retry:
+                if slow_on_retry and not adaptive:
                     status[url]['download_delay'] += 0.01
                     logger.info('Increasing download delay')
 
-                queue[tivoIP].insert(1, url)
+                self.jobs.requeue(url)
             else:
-                if status[url]['best_file'] and status[url]['postprocess'] != 'none':
-                    self.post_process_file(url, status[url]['best_file'])
+                if status[url]['best_file']:
+                    self.queue_post(url, tivoIP, status[url]['best_file'],
+                                    None, save_txt)
                 else:
                     status[url]['finished'] = True
 
 
+    def queue_post(self, url, tivoIP, outfile, raw, save_txt):
+        """ Hand a finished download to the post-processing workers.
+            This waits while their queue is full.
+
+        """
+        task = {'url': url, 'tivoIP': tivoIP, 'outfile': outfile, 'raw': raw,
+                'save': save_txt}
+        status[url]['postprocessing'] = True
+        status[url]['status'] = 'Waiting to post-process'
+        self.jobs.processing(url, task)
+        postproc.get_postprocessor().submit(self.post_process, task)
+
+    def post_process(self, task):
+        """ The second stage of a transfer, in a post-processing worker:
+            decrypt it if that was put off, write its .txt metadata, and
+            pass it to VideoReDo. However it goes, the job is finished.
+
+        """
+        url = task['url']
+        tivoIP = task['tivoIP']
+        outfile = task['outfile']
+        raw = task['raw']
+        if url not in status:
+            # Picked up again after a restart
+            job = self.jobs.get(url)
+            if not job:
+                logger.error('No ToGo job to post-process for %s' % url)
+                return
+            status[url] = new_status(job['options'])
+            status[url].update({'queued': False, 'postprocessing': True})
+
+        try:
+            if raw and os.path.isfile(raw):
+                status[url]['status'] = 'Decrypting'
+                tsn = config.tivos_by_ip(tivoIP)
+                temp = outfile + '.tmp'
+                try:
+                    tivodecoder.decode_file(raw, temp, config.get_tsn('tivo_mak', tsn))
+                    if os.path.isfile(outfile):
+                        os.remove(outfile)
+                    os.rename(temp, outfile)
+                except (IOError, OSError, tivodecoder.FormatError) as msg:
+                    logger.error('Decrypting "%s": %s' % (outfile, msg))
+                    status[url]['error'] = 'Error decrypting file'
+                    # Keep what was downloaded, as a .TiVo file
+                    if os.path.isfile(temp):
+                        os.remove(temp)
+                    outfile = os.path.splitext(outfile)[0] + '.TiVo'
+                    os.rename(raw, outfile)
+                else:
+                    # Note the decryption done before the download goes,
+                    # so a restart from here doesn't try it again
+                    task['raw'] = None
+                    self.jobs.processing(url, task)
+                    os.remove(raw)
+
+            metafile_name = ''
+            if task['save'] and os.path.isfile(outfile):
+                status[url]['status'] = 'Saving metadata'
+                meta = self.show_meta(url, tivoIP)
+                store = npldb.get_store(config.tivos_by_ip(tivoIP))
+                try:
+                    handle = self.tivo_open(store.details_url(url))
+                    meta.update(metadata.from_details(handle.read()))
+                    handle.close()
+                except:
+                    pass
+
+                metafile_name = outfile + '.txt'
+                metafile = open(metafile_name, 'w')
+                metadata.dump(metafile, meta)
+                metafile.close()
+
+            status[url]['status'] = ''
+            status[url]['postprocessing'] = False
+            if not status[url]['error']:
+                self.post_process_file(url, outfile, metafile_name)
+        except Exception as msg:
+            logger.error('Post-processing "%s": %s' % (outfile, msg))
+            status[url]['error'] = 'Error post-processing file'
+        finally:
+            status[url]['status'] = ''
+            status[url]['postprocessing'] = False
+            if status[url]['error']:
+                status[url]['finished'] = True
+            self.jobs.finish(url, status[url]['error'])
+
     def post_process_file(self, url, outfile, metafile=''):
         vrd_post_processing = status[url]['postprocess']
         if not vrd_post_processing or vrd_post_processing == 'none':
@@ -957,16 +1202,24 @@ class ToGo(Plugin):
                 logger.info('Failed to initialize VideoReDo COM interface')
 
 
-    def process_queue(self, tivoIP, mak, togo_path):
+    def run_job(self, job):
+        """ Transfer one job from the queue, in its own thread. """
+        url = job['url']
+        tsn = job['tsn']
+        tivoIP = config.tivos.get(tsn, {}).get('address', job['tivo'])
+        if url not in status or not status[url]['queued']:
+            status[url] = new_status(job['options'])
         PreventComputerFromSleeping(True)
-        while queue[tivoIP]:
-            url = queue[tivoIP][0]
-            print url
-            self.get_tivo_file(tivoIP, url, mak, togo_path)
-            queue[tivoIP].pop(0)
-        del queue[tivoIP]
-        if len(queue) == 0:
-            PreventComputerFromSleeping(False)
+        try:
+            self.get_tivo_file(tivoIP, url, config.get_tsn('tivo_mak', tsn),
+                               job['options']['togo_path'])
+        finally:
+            if self.jobs.active() <= 1:
+                PreventComputerFromSleeping(False)
+        job = self.jobs.get(url)
+        if (job and job['state'] == jobqueue.RUNNING and url in status and
+            not status[url]['queued']):
+            self.jobs.finish(url, status[url]['error'])
 
     def ToGo(self, handler, query):
         togo_path = config.get_server('togo_path')
@@ -976,7 +1229,6 @@ class ToGo(Plugin):
         if togo_path:
             tivoIP = query['TiVo'][0]
             tsn = config.tivos_by_ip(tivoIP)
-            tivo_mak = config.get_tsn('tivo_mak', tsn)
             urls = query.get('Url', [])
             decode = 'decode' in query
             save = 'save' in query
@@ -1006,23 +1258,24 @@ class ToGo(Plugin):
                     postprocess_delete = False
 
             ts_format = 'ts_format' in query and config.is_ts_capable(tsn)
+
+            try:
+                priority = int(query.get('priority', ['0'])[0])
+            except ValueError:
+                priority = 0
+            deferred = 'defer' in query
+
+            options = {'togo_path': togo_path, 'decode': decode, 'save': save,
+                       'ts_format': ts_format, 'postprocess': postprocess,
+                       'postprocess_profile': postprocess_profile,
+                       'postprocess_decrypt': postprocess_decrypt,
+                       'postprocess_delete': postprocess_delete}
             for theurl in urls:
-                if theurl in status:
-                    del status[theurl]
-
-                status[theurl] = {'running': False, 'status': '', 'error': '', 'rate': 0, 'percent': 0,
-                                  'queued': True, 'size': 0, 'postprocessing': False, 'finished': False,
-                                  'decode': decode, 'save': save, 'ts_format': ts_format,
-                                  'postprocess': postprocess, 'postprocess_profile': postprocess_profile,
-                                  'postprocess_decrypt': postprocess_decrypt, 'postprocess_delete': postprocess_delete,
-                                  'retry': 0, 'ts_max_retries': int(config.get_server('togo_ts_max_retries', 0)),
-                                  'ts_error_count': 0, 'best_file': '', 'best_error_count': 0, 'download_delay':0.0}
-                if tivoIP in queue:
-                    queue[tivoIP].append(theurl)
-                else:
-                    queue[tivoIP] = [theurl]
-                    thread.start_new_thread(ToGo.process_queue,
-                                            (self, tivoIP, tivo_mak, togo_path))
+                if theurl in status and status[theurl]['running']:
+                    continue
+
+                status[theurl] = new_status(options)
+                self.jobs.add(theurl, tsn, tivoIP, options, priority, deferred)
                 logger.info('[%s] Queued "%s" for transfer to %s' %
                             (time.strftime('%d/%b/%Y %H:%M:%S'),
                              unquote(theurl), togo_path))
@@ -1043,19 +1296,14 @@ class ToGo(Plugin):
         handler.redir(TRANS_STOP % unquote(theurl))
 
     def remove_from_queue(self, url, tivoIP):
-        if url in status:
-            if status[url]['running']:
-                status[url]['running'] = False
-            else:
-                del status[url]
-
-                if tivoIP in queue:
-                    if url in queue[tivoIP]:
-                        queue[tivoIP].remove(url)
+        if url in status and status[url]['running']:
+            status[url]['running'] = False
+        elif self.jobs.remove(url):
+            status.pop(url, None)
 
-                        logger.info('[%s] Removed "%s" from queue' %
-                                    (time.strftime('%d/%b/%Y %H:%M:%S'),
-                                     unquote(url)))
+            logger.info('[%s] Removed "%s" from queue' %
+                        (time.strftime('%d/%b/%Y %H:%M:%S'),
+                         unquote(url)))
 
 
     def Unqueue(self, handler, query):
@@ -1072,6 +1320,5 @@ class ToGo(Plugin):
 
 
     def UnqueueAll(self, handler, query):
-        for tivoIP in queue:
-            for url in queue[tivoIP]:
-                self.remove_from_queue(url, tivoIP)
+        for url in self.jobs.urls():
+            self.remove_from_queue(url, None)
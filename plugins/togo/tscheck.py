@@ -0,0 +1,298 @@
+""" Integrity checks for an MPEG transport stream, a chunk at a time.
+
+    ToGo downloads in .ts format are checked as they arrive. Each chunk
+    is handled as a whole: the sync bytes are one strided slice, and the
+    packet headers are read as columns (with NumPy when it's installed,
+    otherwise as byte slices), so there's no per-packet unpacking.
+    Without NumPy, a chunk is first checked the quick way, with a loop
+    over its PIDs rather than its packets: each PID's counters are
+    picked out of the column as one byte string, which must match
+    itself stepped on by one. Only a chunk where that doesn't hold (or
+    with a flagged packet or a discontinuity) is gone through packet by
+    packet. On a clean stream, bench/ts_check.py measures about 1500
+    MB/s for the quick check, against 1200 MB/s for the plain sync byte
+    loop ToGo had before and 550 MB/s packet by packet.
+    Besides sync losses, the checker follows each PID's continuity
+    counter and each PCR PID's clock across chunk boundaries, and
+    counts packets the TiVo itself flagged with the transport error
+    indicator. Errors come back as (kind, start, end) byte ranges,
+    merged where they run together.
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PACKET = 188
+SYNC = b'\x47'
+NULL_PID = 0x1fff
+
+# Kinds of error
+SYNC_LOSS = 'sync'
+CONTINUITY = 'continuity'
+PCR_JUMP = 'pcr'
+TRANSPORT = 'transport'
+KINDS = (SYNC_LOSS, CONTINUITY, PCR_JUMP, TRANSPORT)
+
+# PCRs more than this far apart (27 MHz ticks, so 100 ms, as in ETSI
+# TR 101 290), or going backwards, are a discontinuity unless flagged
+PCR_GAP = 2700000
+PCR_WRAP = (1 << 33) * 300
+
+# Below this many packets, the byte slices are quicker than NumPy
+_NUMPY_MIN = 64
+
+# Tables for bytes.translate(), for the quick check without NumPy.
+# In it, a packet's counter is marked with 0x10 to pick it out.
+_CC = bytes(x & 0x0f for x in range(256))
+_NEXT_CC = bytes(0x10 | (x + 1) & 0x0f for x in range(256))
+_PID_HI = bytes(x & 0x1f for x in range(256))
+_ADAPT = bytes(x >> 5 & 1 for x in range(256))
+_PAYLOAD = bytes(x & 0x10 for x in range(256))
+_NO_TEI = bytes(range(0x80))
+_UNMARKED = bytes(range(0x10))
+_MARK = [bytes(0x10 if x == v else 0 for x in range(256)) for v in range(256)]
+
+class TSChecker(object):
+    def __init__(self, start=0):
+        self.pos = start        # stream offset of the next byte fed
+        self.left = b''         # a partial packet, held for next time
+        self.counters = {}      # PID -> last continuity counter
+        self.pcrs = {}          # PID -> last PCR
+        self.counts = dict.fromkeys(KINDS, 0)
+        self.ranges = []        # (kind, start, end), merged
+
+    @property
+    def errors(self):
+        return sum(self.counts.values())
+
+    def feed(self, data):
+        """ Check the next chunk of the stream. Returns the error ranges
+            it added or extended.
+
+        """
+        base = self.pos - len(self.left)
+        data = self.left + data
+        self.pos = base + len(data)
+        found = []
+        p = 0
+        while len(data) - p >= PACKET:
+            n = (len(data) - p) // PACKET
+            syncs = data[p:p + n * PACKET:PACKET]
+            good = n - len(syncs.lstrip(SYNC))
+            if good:
+                self._packets(data, p, good, base, found)
+                p += good * PACKET
+            if good == n:
+                break
+            q = self._resync(data, p)
+            if q is None:
+                # Keep enough to recognise the sync when it comes back
+                q = max(p, len(data) - 2 * PACKET)
+                if q > p:
+                    self._error(SYNC_LOSS, base + p, base + q, found,
+                                (q - p + PACKET - 1) // PACKET)
+                p = q
+                break
+            self._error(SYNC_LOSS, base + p, base + q, found,
+                        (q - p + PACKET - 1) // PACKET)
+            p = q
+        self.left = data[p:]
+        return found
+
+    def finish(self):
+        """ Report a truncated last packet, if there is one. """
+        found = []
+        if self.left:
+            start = self.pos - len(self.left)
+            self._error(SYNC_LOSS, start, self.pos, found)
+            self.left = b''
+        return found
+
+    def _resync(self, data, p):
+        """ Where packets line up again after a sync loss at p: three
+            sync bytes a packet apart. None if that's not in data yet.
+
+        """
+        j = data.find(SYNC, p + 1)
+        while j >= 0 and j + 2 * PACKET < len(data):
+            if (data[j + PACKET:j + PACKET + 1] == SYNC and
+                data[j + 2 * PACKET:j + 2 * PACKET + 1] == SYNC):
+                return j
+            j = data.find(SYNC, j + 1)
+        return None
+
+    def _error(self, kind, start, end, found, count=1):
+        self.counts[kind] += count
+        if self.ranges:
+            last = self.ranges[-1]
+            if last[0] == kind and last[2] >= start:
+                self.ranges[-1] = (kind, last[1], max(last[2], end))
+                if found and found[-1][:2] == last[:2]:
+                    found[-1] = self.ranges[-1]
+                else:
+                    found.append(self.ranges[-1])
+                return
+        self.ranges.append((kind, start, end))
+        found.append((kind, start, end))
+
+    def _packets(self, data, p, n, base, found):
+        """ Check n aligned packets at data[p:]. """
+        if numpy is not None and n >= _NUMPY_MIN:
+            bad, tei, pcr_rows = self._scan_numpy(data, p, n)
+        else:
+            scan = self._scan_runs(data, p, n)
+            if scan is None:
+                scan = self._scan_slices(data, p, n)
+            bad, tei, pcr_rows = scan
+
+        errors = [(i, TRANSPORT) for i in tei]
+        errors += [(i, CONTINUITY) for i in bad]
+        for i in pcr_rows:
+            if self._pcr(data, p + i * PACKET):
+                errors.append((i, PCR_JUMP))
+        errors.sort()
+        for i, kind in errors:
+            start = base + p + i * PACKET
+            self._error(kind, start, start + PACKET, found)
+
+    def _pcr(self, data, at):
+        """ Follow the PCR in the packet at data[at:]; True if it jumps.
+        """
+        b = data[at + 6:at + 12]
+        pcr = (((b[0] << 25) | (b[1] << 17) | (b[2] << 9) | (b[3] << 1) |
+                (b[4] >> 7)) * 300 + (((b[4] & 1) << 8) | b[5]))
+        pid = ((data[at + 1] & 0x1f) << 8) | data[at + 2]
+        last = self.pcrs.get(pid)
+        self.pcrs[pid] = pcr
+        if last is None or data[at + 5] & 0x80:
+            return False
+        gap = (pcr - last) % PCR_WRAP
+        return gap > PCR_GAP
+
+    def _scan_runs(self, data, p, n):
+        """ The quick check of n aligned packets at data[p:]. It only
+            vouches for packets whose errors, if any, are PCR jumps; if
+            there may be others, it returns None, having changed nothing.
+
+        """
+        end = p + n * PACKET
+        col1 = data[p + 1:end:PACKET]
+        col3 = data[p + 3:end:PACKET]
+        if col1.translate(None, _NO_TEI):
+            return None
+
+        pcr_rows = []
+        adapt = col3.translate(_ADAPT)
+        i = adapt.find(1)
+        while i >= 0:
+            at = p + i * PACKET
+            pid = ((data[at + 1] & 0x1f) << 8) | data[at + 2]
+            if data[at + 4] and pid != NULL_PID:
+                flags = data[at + 5]
+                if flags & 0x80:
+                    return None
+                if flags & 0x10 and data[at + 4] >= 7:
+                    pcr_rows.append(i)
+            i = adapt.find(1, i + 1)
+
+        # Each PID's counters, in stream order, as the marked bytes of
+        # its rows; take PIDs in turn until no packet with a payload is
+        # left.
+        hi = col1.translate(_PID_HI)
+        lo = data[p + 2:end:PACKET]
+        ccs = int.from_bytes(col3.translate(_CC), 'big')
+        rows = int.from_bytes(col3.translate(_PAYLOAD), 'big')
+        last = {}
+        while rows:
+            i = n - 1 - (rows.bit_length() - 1) // 8
+            pid = (hi[i] << 8) | lo[i]
+            mine = (int.from_bytes(hi.translate(_MARK[hi[i]]), 'big') &
+                    int.from_bytes(lo.translate(_MARK[lo[i]]), 'big') &
+                    rows)
+            rows ^= mine
+            if pid == NULL_PID:
+                continue
+            run = (mine | ccs).to_bytes(n, 'big').translate(None, _UNMARKED)
+            before = self.counters.get(pid)
+            if before is not None and run[0] != _NEXT_CC[before]:
+                return None
+            if run[1:] != run[:-1].translate(_NEXT_CC):
+                return None
+            last[pid] = run[-1] & 0x0f
+        self.counters.update(last)
+        return [], [], pcr_rows
+
+    def _scan_slices(self, data, p, n):
+        end = p + n * PACKET
+        counters = self.counters
+        bad = []
+        tei = []
+        pcr_rows = []
+        at = p - PACKET
+        for i, b1, b2, b3 in zip(range(n), data[p + 1:end:PACKET],
+                                 data[p + 2:end:PACKET],
+                                 data[p + 3:end:PACKET]):
+            at += PACKET
+            if b1 & 0x80:
+                tei.append(i)
+                continue
+            pid = ((b1 & 0x1f) << 8) | b2
+            if pid == NULL_PID:
+                continue
+            flags = 0
+            if b3 & 0x20 and data[at + 4]:
+                flags = data[at + 5]
+                if flags & 0x10 and data[at + 4] >= 7:
+                    pcr_rows.append(i)
+            if b3 & 0x10:
+                cc = b3 & 0x0f
+                last = counters.get(pid, cc)
+                if cc != last and cc != (last + 1) & 0x0f and \
+                   not flags & 0x80:
+                    bad.append(i)
+                counters[pid] = cc
+        return bad, tei, pcr_rows
+
+    def _scan_numpy(self, data, p, n):
+        packets = numpy.frombuffer(data, numpy.uint8, n * PACKET,
+                                   p).reshape(n, PACKET)
+        b1 = packets[:, 1]
+        b3 = packets[:, 3]
+        b4 = packets[:, 4]
+        pid = ((b1 & 0x1f).astype(numpy.uint16) << 8) | packets[:, 2]
+        flags = numpy.where((b3 & 0x20 != 0) & (b4 != 0), packets[:, 5], 0)
+        flagged = b1 & 0x80 != 0
+
+        tei = numpy.nonzero(flagged)[0]
+        live = ~flagged & (pid != NULL_PID)
+        pcr_rows = numpy.nonzero(live & (flags & 0x10 != 0) & (b4 >= 7))[0]
+
+        # Continuity: gather each PID's packets, in order, side by side
+        rows = numpy.nonzero(live & (b3 & 0x10 != 0))[0]
+        if not len(rows):
+            return [], tei.tolist(), pcr_rows.tolist()
+        rows = rows[numpy.argsort(pid[rows], kind='stable')]
+        pids = pid[rows]
+        cc = (b3[rows] & 0x0f).astype(numpy.int16)
+        first = numpy.ones(len(rows), bool)
+        first[1:] = pids[1:] != pids[:-1]
+        last = numpy.ones(len(rows), bool)
+        last[:-1] = first[1:]
+
+        prev = numpy.empty_like(cc)
+        prev[1:] = cc[:-1]
+        known = ~first
+        for k in numpy.nonzero(first)[0]:
+            before = self.counters.get(int(pids[k]))
+            if before is not None:
+                prev[k] = before
+                known[k] = True
+        step = (cc - prev) & 0x0f
+        bad = known & (step > 1) & (flags[rows] & 0x80 == 0)
+        for k in numpy.nonzero(last)[0]:
+            self.counters[int(pids[k])] = int(cc[k])
+        return (numpy.sort(rows[bad]).tolist(), tei.tolist(),
+                pcr_rows.tolist())
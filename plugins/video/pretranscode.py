@@ -0,0 +1,350 @@
+""" Encode, ahead of time, the videos the TiVos can't play as they are.
+
+    During the pretranscode_hours, while no TiVo is playing a transcode,
+    the video shares each known TiVo can see are scanned for files that
+    tivo_compatible() turns down, and those are encoded into a
+    "pretranscode" folder under cache_dir, most urgent first. send_file()
+    then serves a finished encode the way it serves a compatible file:
+    with a Content-Length, seeking in it without ffmpeg.
+
+    Jobs are encoded in pieces of about SEGMENT seconds, cut at
+    keyframes by segmented.py, pretranscode_workers of them at a time.
+    The pieces go in a work folder that also holds a note of the job, so
+    one that's interrupted -- by the end of the window, a TiVo starting
+    to play, or a restart -- carries on from its first unfinished piece.
+    Once every piece is done they're joined into a finished entry.
+    Encodes are keyed the same way as the transcode cache, so a change
+    to the source file or to the settings for that kind of TiVo leaves
+    the old encode unused.
+
+    .tivo files are left alone; they need a decoder in front of ffmpeg,
+    which can't seek into the middle of one.
+
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import config
+import housekeeping
+import scheduler
+import segmented
+import transcode
+import transcodecache
+
+logger = logging.getLogger('pyTivo.video.pretranscode')
+
+# Job priorities, most urgent first
+PLAYED = 0      # had to be transcoded while a TiVo was playing it
+RESUMED = 1     # partly encoded already
+SCANNED = 2
+
+# Seconds of video encoded by each ffmpeg run
+SEGMENT = 300
+
+# How often (seconds) to check whether it's time to work, and to rescan
+CHECK = 300
+RESCAN = 6 * 3600
+
+WORK = 'work'
+JOB = 'job.json'
+
+def is_idle():
+    """ True inside the pretranscode hours, while nothing is playing. """
+    if not config.in_hours(config.getPreTranscodeHours(),
+                           time.localtime().tm_hour):
+        return False
+    return not scheduler.stats()['playback']['running']
+
+class Job(object):
+    def __init__(self, key, path, tsn, mime, mtime, priority, cuts=None):
+        self.key = key
+        self.path = path
+        self.tsn = tsn
+        self.mime = mime
+        self.mtime = mtime
+        self.priority = priority
+        self.cuts = cuts        # start of each piece, in seconds
+
+    def to_dict(self):
+        return {'path': self.path, 'tsn': self.tsn, 'mime': self.mime,
+                'mtime': self.mtime, 'priority': self.priority,
+                'cuts': self.cuts}
+
+class PreTranscoder(object):
+    def __init__(self, path, budget, plugin):
+        self.store = transcodecache.TranscodeCache(path, budget)
+        self.work = os.path.join(path, WORK)
+        self.plugin = plugin
+        self.lock = threading.Lock()
+        self.heap = []
+        self.jobs = {}          # key -> Job
+        self.failed = set()
+        self.seq = itertools.count()
+        self.worker = None
+        self.last_scan = 0
+        if not os.path.isdir(self.work):
+            os.makedirs(self.work)
+        self._load()
+
+    def _load(self):
+        """ Queue the jobs left from an earlier run. """
+        for key in os.listdir(self.work):
+            jobdir = os.path.join(self.work, key)
+            try:
+                with open(os.path.join(jobdir, JOB)) as f:
+                    saved = json.load(f)
+                if os.path.getmtime(saved['path']) != saved['mtime']:
+                    raise ValueError('source changed')
+            except (IOError, OSError, ValueError, KeyError):
+                shutil.rmtree(jobdir, True)
+                continue
+            priority = saved['priority']
+            if len(os.listdir(jobdir)) > 1:
+                priority = min(priority, RESUMED)
+            job = Job(key, saved['path'], saved['tsn'], saved['mime'],
+                      saved['mtime'], priority, saved.get('cuts'))
+            self.jobs[key] = job
+            self._push(job)
+        if self.jobs:
+            logger.info('%d pretranscode jobs waiting' % len(self.jobs))
+
+    def _push(self, job):
+        heapq.heappush(self.heap, (job.priority, -job.mtime,
+                                   next(self.seq), job))
+
+    def _save(self, job):
+        jobdir = os.path.join(self.work, job.key)
+        if not os.path.isdir(jobdir):
+            os.makedirs(jobdir)
+        with open(os.path.join(jobdir, JOB), 'w') as f:
+            json.dump(job.to_dict(), f)
+
+    def _drop(self, job):
+        with self.lock:
+            self.jobs.pop(job.key, None)
+        shutil.rmtree(os.path.join(self.work, job.key), True)
+
+    def lookup(self, path, tsn, mime):
+        return self.store.lookup(transcode.session_key(path, tsn, mime))
+
+    def add(self, path, tsn, mime, priority):
+        """ Queue path for encoding for this TiVo and mime type, unless
+            it's done already; a job already queued moves up to priority
+            if that's more urgent.
+
+        """
+        key = transcode.session_key(path, tsn, mime)
+        if key in self.store or key in self.failed:
+            return
+        with self.lock:
+            job = self.jobs.get(key)
+            if job:
+                if priority >= job.priority:
+                    return
+                job.priority = priority
+            else:
+                job = Job(key, path, tsn, mime, os.path.getmtime(path),
+                          priority)
+                self.jobs[key] = job
+            self._push(job)
+        try:
+            self._save(job)
+        except (IOError, OSError) as msg:
+            logger.error('Saving pretranscode job for %s: %s' % (path, msg))
+
+    def next_job(self):
+        with self.lock:
+            while self.heap:
+                priority, mtime, seq, job = heapq.heappop(self.heap)
+                # Skip entries left behind when a job moved up
+                if self.jobs.get(job.key) is job and priority == job.priority:
+                    return job
+        return None
+
+    def scan(self):
+        """ Queue what each known TiVo would need transcoded. False if
+            the window closed before the scan was done.
+
+        """
+        for tsn in sorted(config.tivos):
+            for section, settings in config.getShares(tsn):
+                if settings.get('type') != 'video' or 'path' not in settings:
+                    continue
+                base = os.path.normpath(settings['path'])
+                for root, dirs, files in os.walk(base):
+                    dirs[:] = [x for x in dirs if not x.startswith('.')]
+                    for name in sorted(files):
+                        if not is_idle():
+                            return False
+                        path = os.path.join(root, name)
+                        if (name.startswith('.') or
+                            os.path.splitext(name)[1].lower() == '.tivo' or
+                            not self.plugin.video_file_filter(path)):
+                            continue
+                        try:
+                            self.consider(path, tsn)
+                        except Exception as msg:
+                            logger.debug('Skipping %s: %s' % (path, msg))
+        return True
+
+    def consider(self, path, tsn):
+        if not transcode.supported_format(path):
+            return
+        mime = self.plugin.offered_mime(tsn, path)
+        if not transcode.tivo_compatible(path, tsn, mime)[0]:
+            self.add(path, tsn, mime, SCANNED)
+
+    def tick(self):
+        """ Start the worker, if it's time and it isn't running. """
+        with self.lock:
+            if self.worker or not is_idle():
+                return
+            self.worker = threading.Thread(target=self.run,
+                                           name='pretranscode')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def run(self):
+        try:
+            if time.time() - self.last_scan > RESCAN and self.scan():
+                self.last_scan = time.time()
+            while is_idle():
+                job = self.next_job()
+                if not job:
+                    break
+                self.encode(job)
+        except Exception as msg:
+            logger.error('pretranscode: %s' % msg)
+        finally:
+            with self.lock:
+                self.worker = None
+
+    def encode(self, job):
+        try:
+            key = transcode.session_key(job.path, job.tsn, job.mime)
+        except (IOError, OSError):
+            key = None
+        if key != job.key:
+            # The source or the settings changed since it was queued
+            self._drop(job)
+            return
+
+        settings = transcode.get_plan(job.path, job.tsn,
+                                      job.mime).play_settings()
+        if job.cuts is None:
+            # Decided once, so a resumed job's pieces still line up
+            seconds = transcode.video_info(job.path)['millisecs'] / 1000.0
+            keys = []
+            if seconds > SEGMENT:
+                keys = segmented.keyframes(job.path)
+            if keys or not self.copies_video(settings):
+                job.cuts = segmented.plan_cuts(keys, seconds, SEGMENT)
+            else:
+                job.cuts = [0.0]
+            self._save(job)
+
+        jobdir = os.path.join(self.work, job.key)
+        pieces = [os.path.join(jobdir, '%05d%s' % (i, transcodecache.EXT))
+                  for i in range(len(job.cuts))]
+        logger.info('Pretranscoding %s for %s' % (job.path, job.mime))
+        done = segmented.encode(job.path, settings, job.cuts, pieces,
+                                config.getPreTranscodeWorkers(), is_idle)
+        if done is None:
+            # Pick up from here next time
+            with self.lock:
+                job.priority = min(job.priority, RESUMED)
+                self._push(job)
+        elif not done:
+            self.failed.add(job.key)
+            self._drop(job)
+        else:
+            self.join(job, pieces)
+
+    def copies_video(self, settings):
+        # Seeking a copied stream starts at a keyframe, not at the cut,
+        # so without keyframe cuts the pieces wouldn't line up
+        try:
+            return settings[settings.index('-c:v') + 1] == 'copy'
+        except (ValueError, IndexError):
+            return False
+
+    def join(self, job, pieces):
+        writer = self.store.create(job.key)
+        if writer:
+            try:
+                segmented.join(pieces, writer.write)
+            except (IOError, OSError) as msg:
+                logger.error('Joining %s: %s' % (job.path, msg))
+                writer.abort()
+            if writer.aborted:
+                logger.info('Pretranscode of %s did not fit in '
+                            'pretranscode_size' % job.path)
+                self.failed.add(job.key)
+            else:
+                writer.finish()
+                logger.info('Pretranscoded %s' % job.path)
+        self._drop(job)
+
+    def stats(self):
+        with self.lock:
+            result = {'queued': len(self.jobs), 'failed': len(self.failed),
+                      'running': self.worker is not None}
+        result.update(self.store.stats())
+        return result
+
+_pretranscoder = None
+_pretranscoder_lock = threading.Lock()
+
+def start(plugin):
+    """ Set up pretranscoding for the video plugin, if it's turned on.
+        plugin supplies video_file_filter() and offered_mime().
+
+    """
+    global _pretranscoder
+    if not config.getPreTranscode():
+        return
+    with _pretranscoder_lock:
+        if _pretranscoder is not None:
+            return
+        path = os.path.join(config.getCacheDir(), 'pretranscode')
+        try:
+            _pretranscoder = PreTranscoder(path, config.getPreTranscodeSize(),
+                                           plugin)
+        except (IOError, OSError) as msg:
+            logger.error('Unable to open pretranscode folder %s: %s' %
+                         (path, msg))
+            return
+    housekeeping.every(CHECK, _pretranscoder.tick, name='pretranscode')
+
+def lookup(path, tsn, mime):
+    """ Path of the finished encode of path for this TiVo and mime
+        type, or None.
+
+    """
+    if _pretranscoder is None:
+        return None
+    return _pretranscoder.lookup(path, tsn, mime)
+
+def request(path, tsn, mime):
+    """ Note a file that had to be transcoded to play, so it's the
+        first one encoded next time.
+
+    """
+    if _pretranscoder is None or path[-5:].lower() == '.tivo':
+        return
+    try:
+        _pretranscoder.add(path, tsn, mime, PLAYED)
+    except (IOError, OSError) as msg:
+        logger.debug('Not queueing %s: %s' % (path, msg))
+
+def stats():
+    if _pretranscoder is None:
+        return None
+    return _pretranscoder.stats()
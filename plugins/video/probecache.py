@@ -0,0 +1,261 @@
+""" Persistent store for ffmpeg probe results.
+
+    transcode.video_info() keeps what it learns about each file in an
+    in-memory LRUCache, which is lost on every restart. This module
+    keeps the same results in an SQLite database in the cache directory,
+    keyed by path and checked against the file's size and mtime, so a
+    restart doesn't mean re-probing the whole library.
+
+    Run "python -m plugins.video.probecache" from the pyTivo directory
+    to inspect or clear the store.
+
+"""
+
+import getopt
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.video.probecache')
+
+DB_NAME = 'probecache.db'
+
+# Once the store holds more than its limit, the least recently used
+# entries are dropped until this fraction of the limit remains.
+EVICT_TO = 0.9
+
+# Don't rewrite an entry's access time more often than this (seconds)
+TOUCH_INTERVAL = 86400
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    atime REAL NOT NULL,
+    info TEXT NOT NULL)"""
+
+def _key(path):
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    return path
+
+def _decode(info):
+    vInfo = json.loads(info)
+    # JSON has no tuples; put the audio map back the way video_info
+    # builds it
+    if vInfo.get('mapAudio'):
+        vInfo['mapAudio'] = [tuple(x) for x in vInfo['mapAudio']]
+    return vInfo
+
+class ProbeCache(object):
+    def __init__(self, path, max_entries=50000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(SCHEMA)
+        self.db.execute('CREATE INDEX IF NOT EXISTS probes_atime '
+                        'ON probes (atime)')
+        self.db.commit()
+
+    def get(self, path, size, mtime):
+        """ Return the stored vInfo for path, or None if there isn't one
+            or the file has changed since it was probed.
+
+        """
+        key = _key(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, atime, info '
+                                  'FROM probes WHERE path = ?',
+                                  (key,)).fetchone()
+            if not row or row[0] != size or row[1] != mtime:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[2] > TOUCH_INTERVAL:
+                self.db.execute('UPDATE probes SET atime = ? WHERE path = ?',
+                                (now, key))
+                self.db.commit()
+        try:
+            return _decode(row[3])
+        except ValueError:
+            return None
+
+    def put(self, path, size, mtime, vInfo):
+        try:
+            info = json.dumps(vInfo)
+        except (TypeError, ValueError) as msg:
+            logger.debug('not storing probe of %s: %s' % (path, msg))
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO probes '
+                            '(path, size, mtime, atime, info) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (_key(path), size, mtime, time.time(), info))
+            self.db.commit()
+            self._evict()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM probes WHERE path = ?',
+                            (_key(path),))
+            self.db.commit()
+
+    def _evict(self):
+        count = self.db.execute('SELECT COUNT(*) FROM probes').fetchone()[0]
+        if count <= self.max_entries:
+            return
+        excess = count - int(self.max_entries * EVICT_TO)
+        self.db.execute('DELETE FROM probes WHERE path IN '
+                        '(SELECT path FROM probes ORDER BY atime LIMIT ?)',
+                        (excess,))
+        self.db.commit()
+        logger.debug('evicted %d probe entries' % excess)
+
+    def vacuum(self):
+        """ Drop entries for files that no longer exist or have changed,
+            then compact the database. Returns the number dropped.
+
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT path, size, mtime '
+                                   'FROM probes').fetchall()
+        stale = []
+        for path, size, mtime in rows:
+            try:
+                st = os.stat(path)
+                if st.st_size != size or st.st_mtime != mtime:
+                    stale.append((path,))
+            except OSError:
+                stale.append((path,))
+        with self.lock:
+            self.db.executemany('DELETE FROM probes WHERE path = ?', stale)
+            self.db.commit()
+            self.db.execute('VACUUM')
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM probes')
+            self.db.commit()
+            self.db.execute('VACUUM')
+
+    def entries(self):
+        with self.lock:
+            return self.db.execute('SELECT path, size, mtime, atime '
+                                   'FROM probes ORDER BY path').fetchall()
+
+    def lookup(self, path):
+        """ Return the stored vInfo for path without checking it against
+            the file.
+
+        """
+        with self.lock:
+            row = self.db.execute('SELECT info FROM probes WHERE path = ?',
+                                  (_key(path),)).fetchone()
+        if row:
+            return _decode(row[0])
+
+    def stats(self):
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) '
+                                    'FROM probes').fetchone()[0]
+        try:
+            disk = os.path.getsize(self.path)
+        except OSError:
+            disk = 0
+        return {'entries': count, 'max_entries': self.max_entries,
+                'bytes': disk, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """ Return the shared ProbeCache, opening it on first use, or None if
+        the persistent cache is turned off or can't be opened.
+
+    """
+    global _store
+    if not config.getProbeCache():
+        return None
+    with _store_lock:
+        if _store is None:
+            path = os.path.join(config.getCacheDir(), DB_NAME)
+            try:
+                _store = ProbeCache(path, config.getProbeCacheSize())
+            except sqlite3.Error as msg:
+                logger.error('Unable to open probe cache %s: %s' %
+                             (path, msg))
+                return None
+        return _store
+
+USAGE = """usage: python -m plugins.video.probecache [-c config] command
+
+commands:
+  stats         show the number of entries and size of the store
+  list          list stored paths
+  show PATH     print the stored probe result for PATH
+  vacuum        drop entries for missing or changed files, and compact
+  clear         remove every entry
+"""
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'c:', ['config='])
+    except getopt.GetoptError as msg:
+        print(msg)
+        print(USAGE)
+        return 2
+
+    config.init([x for opt in opts for x in opt])
+    path = os.path.join(config.getCacheDir(), DB_NAME)
+    if not args or args[0] not in ('stats', 'list', 'show',
+                                   'vacuum', 'clear'):
+        print(USAGE)
+        return 2
+
+    store = ProbeCache(path, config.getProbeCacheSize())
+    command = args[0]
+    if command == 'stats':
+        print('Store: %s' % path)
+        for key, value in sorted(store.stats().items()):
+            if key not in ('hits', 'misses'):
+                print('%s: %s' % (key, value))
+    elif command == 'list':
+        for fname, size, mtime, atime in store.entries():
+            print('%s\t%d\t%s' % (fname, size,
+                  time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))))
+    elif command == 'show':
+        if len(args) < 2:
+            print(USAGE)
+            return 2
+        vInfo = store.lookup(args[1])
+        if vInfo is None:
+            print('Not in store: %s' % args[1])
+            return 1
+        for key, value in sorted(vInfo.items()):
+            print('%s=%s' % (key, value))
+    elif command == 'vacuum':
+        print('Dropped %d stale entries' % store.vacuum())
+    elif command == 'clear':
+        store.clear()
+        print('Cleared %s' % path)
+    store.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,312 @@
+""" Parsers for the reports of the probe backends.
+
+    transcode.video_info() runs "ffprobe -show_streams -show_format" or
+    "ffmpeg -i" on a file and builds vInfo from what it writes. The
+    parsers here only read text and JSON, and run under Python 2 or 3,
+    so they can be exercised without transcode or ffmpeg around them,
+    as bench/probe_backends.py does.
+
+"""
+
+import logging
+import re
+import sys
+
+logger = logging.getLogger('pyTivo.video.probeparse')
+
+def debug(msg):
+    if isinstance(msg, bytes):
+        try:
+            msg = msg.decode('utf8')
+        except:
+            if sys.platform == 'darwin':
+                msg = msg.decode('macroman')
+            else:
+                msg = msg.decode('cp1252')
+    logger.debug(msg)
+
+def parse_ffmpeg(output):
+    """ Build vInfo from the stream report "ffmpeg -i" writes to stderr. """
+    vInfo = {'Supported': True}
+
+    attrs = {'container': r'Input #0, ([^,]+),',
+             'vCodec': r'Video: ([^, ]+)',             # video codec
+             'aKbps': r'.*Audio: .+, (.+) (?:kb/s).*',     # audio bitrate
+             'aCodec': r'.*Audio: ([^, ]+)',             # audio codec
+             'aFreq': r'.*Audio: .+, (.+) (?:Hz).*',       # audio frequency
+             'mapVideo': r'([0-9]+[.:]+[0-9]+).*: Video:.*'}  # video mapping
+
+    for attr in attrs:
+        rezre = re.compile(attrs[attr])
+        x = rezre.search(output)
+        if x:
+            vInfo[attr] = x.group(1)
+        else:
+            if attr in ['container', 'vCodec']:
+                vInfo[attr] = ''
+                vInfo['Supported'] = False
+            else:
+                vInfo[attr] = None
+            debug('failed at ' + attr)
+
+    rezre = re.compile(r'.*Audio: .+, (?:(\d+)(?:(?:\.(\d).*)?(?: channels.*)?)|(stereo|mono)),.*')
+    x = rezre.search(output)
+    if x:
+        if x.group(3):
+            if x.group(3) == 'stereo':
+                vInfo['aCh'] = 2
+            elif x.group(3) == 'mono':
+                vInfo['aCh'] = 1
+        elif x.group(2):
+            vInfo['aCh'] = int(x.group(1)) + int(x.group(2))
+        elif x.group(1):
+            vInfo['aCh'] = int(x.group(1))
+        else:
+            vInfo['aCh'] = None
+            debug('failed at aCh')
+    else:
+        vInfo['aCh'] = None
+        debug('failed at aCh')
+
+    rezre = re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*')
+    x = rezre.search(output)
+    if x:
+        vInfo['vWidth'] = int(x.group(1))
+        vInfo['vHeight'] = int(x.group(2))
+    else:
+        vInfo['vWidth'] = ''
+        vInfo['vHeight'] = ''
+        vInfo['Supported'] = False
+        debug('failed at vWidth/vHeight')
+
+    rezre = re.compile(r'.*Video: .+, (.+) (?:fps|tb\(r\)|tbr).*')
+    x = rezre.search(output)
+    if x:
+        vInfo['vFps'] = x.group(1)
+        if '.' not in vInfo['vFps']:
+            vInfo['vFps'] += '.00'
+
+        # Allow override only if it is mpeg2 and frame rate was doubled
+        # to 59.94
+
+        if vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] != '29.97':
+            # First look for the build 7215 version
+            rezre = re.compile(r'.*film source: 29.97.*')
+            x = rezre.search(output.lower())
+            if x:
+                debug('film source: 29.97 setting vFps to 29.97')
+                vInfo['vFps'] = '29.97'
+            else:
+                # for build 8047:
+                rezre = re.compile(r'.*frame rate differs from container ' +
+                                   r'frame rate: 29.97.*')
+                debug('Bug in VideoReDo')
+                x = rezre.search(output.lower())
+                if x:
+                    vInfo['vFps'] = '29.97'
+    else:
+        vInfo['vFps'] = ''
+        vInfo['Supported'] = False
+        debug('failed at vFps')
+
+    durre = re.compile(r'.*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),')
+    d = durre.search(output)
+
+    if d:
+        vInfo['millisecs'] = ((int(d.group(1)) * 3600 +
+                               int(d.group(2)) * 60 +
+                               int(d.group(3))) * 1000 +
+                              int(d.group(4)) * (10 ** (3 - len(d.group(4)))))
+    else:
+        vInfo['millisecs'] = 0
+
+    # get bitrate of source for tivo compatibility test.
+    rezre = re.compile(r'.*bitrate: (.+) (?:kb/s).*')
+    x = rezre.search(output)
+    if x:
+        vInfo['kbps'] = x.group(1)
+    else:
+        # Fallback method of getting video bitrate
+        # Sample line:  Stream #0.0[0x1e0]: Video: mpeg2video, yuv420p,
+        #               720x480 [PAR 32:27 DAR 16:9], 9800 kb/s, 59.94 tb(r)
+        rezre = re.compile(r'.*Stream #0\.0\[.*\]: Video: mpeg2video, ' +
+                           r'\S+, \S+ \[.*\], (\d+) (?:kb/s).*')
+        x = rezre.search(output)
+        if x:
+            vInfo['kbps'] = x.group(1)
+        else:
+            vInfo['kbps'] = None
+            debug('failed at kbps')
+
+    # get par.
+    rezre = re.compile(r'.*Video: .+PAR ([0-9]+):([0-9]+) DAR [0-9:]+.*')
+    x = rezre.search(output)
+    if x and x.group(1) != "0" and x.group(2) != "0":
+        vInfo['par1'] = x.group(1) + ':' + x.group(2)
+        vInfo['par2'] = float(x.group(1)) / float(x.group(2))
+    else:
+        vInfo['par1'], vInfo['par2'] = None, None
+
+    # get dar.
+    rezre = re.compile(r'.*Video: .+DAR ([0-9]+):([0-9]+).*')
+    x = rezre.search(output)
+    if x and x.group(1) != "0" and x.group(2) != "0":
+        vInfo['dar1'] = x.group(1) + ':' + x.group(2)
+    else:
+        vInfo['dar1'] = None
+
+    # get Audio Stream mapping.
+    rezre = re.compile(r'([0-9]+[.:]+[0-9]+)(.*): Audio:(.*)')
+    x = rezre.search(output)
+    amap = []
+    if x:
+        for x in rezre.finditer(output):
+            amap.append((x.group(1), x.group(2) + x.group(3)))
+    else:
+        amap.append(('', ''))
+        debug('failed at mapAudio')
+    vInfo['mapAudio'] = amap
+
+    vInfo['par'] = None
+
+    # get Metadata dump (newer ffmpeg).
+    lines = output.split('\n')
+    rawmeta = {}
+    flag = False
+
+    for line in lines:
+        if line.startswith('  Metadata:'):
+            flag = True
+        else:
+            if flag:
+                if line.startswith('  Duration:'):
+                    flag = False
+                else:
+                    try:
+                        key, value = [x.strip() for x in line.split(':', 1)]
+                        if isinstance(value, bytes):
+                            try:
+                                value = value.decode('utf-8')
+                            except:
+                                if sys.platform == 'darwin':
+                                    value = value.decode('macroman')
+                                else:
+                                    value = value.decode('cp1252')
+                        rawmeta[key] = [value]
+                    except:
+                        pass
+
+    vInfo['rawmeta'] = rawmeta
+    return vInfo
+
+def _fps(rate):
+    """ Format an ffprobe frame rate ("30000/1001") the way ffmpeg prints
+        it in its stream report ("29.97").
+
+    """
+    try:
+        num, den = [int(x) for x in rate.split('/')]
+        fps = float(num) / den
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return ''
+    v = int(round(fps * 100))
+    if not v:
+        return ''
+    if v % 100:
+        return '%.2f' % (v / 100.0)
+    return '%d.00' % (v / 100)
+
+def _ratio(value):
+    if not value or value in ('N/A', '0:1') or value.startswith('0:'):
+        return None
+    return value
+
+def _kbps(value):
+    try:
+        return str(int(value) // 1000)
+    except (TypeError, ValueError):
+        return None
+
+def parse_ffprobe(report):
+    """ Build vInfo, with the same keys and value types parse_ffmpeg()
+        produces, from "ffprobe -show_streams -show_format" JSON.
+
+    """
+    vInfo = {'Supported': True}
+    fmt = report['format']
+    streams = report.get('streams', [])
+    video = [x for x in streams if x.get('codec_type') == 'video' and
+             not x.get('disposition', {}).get('attached_pic')]
+    audio = [x for x in streams if x.get('codec_type') == 'audio']
+
+    vInfo['container'] = fmt.get('format_name', '').split(',')[0]
+    if not vInfo['container']:
+        vInfo['Supported'] = False
+
+    if video:
+        v = video[0]
+        vInfo['vCodec'] = v.get('codec_name', '')
+        vInfo['mapVideo'] = '0:%d' % v['index']
+        vInfo['vWidth'] = v.get('width', '')
+        vInfo['vHeight'] = v.get('height', '')
+        vInfo['vFps'] = _fps(v.get('r_frame_rate')) or \
+                        _fps(v.get('avg_frame_rate'))
+        # Same VideoReDo workaround as parse_ffmpeg: a doubled rate on
+        # 29.97 film source
+        if (vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] and
+            vInfo['vFps'] != '29.97' and
+            _fps(v.get('avg_frame_rate')) == '29.97'):
+            vInfo['vFps'] = '29.97'
+        vInfo['par1'] = _ratio(v.get('sample_aspect_ratio'))
+        if vInfo['par1']:
+            num, den = vInfo['par1'].split(':')
+            vInfo['par2'] = float(num) / float(den)
+        else:
+            vInfo['par2'] = None
+        vInfo['dar1'] = _ratio(v.get('display_aspect_ratio'))
+    else:
+        vInfo.update({'vCodec': '', 'mapVideo': None, 'vWidth': '',
+                      'vHeight': '', 'vFps': '', 'par1': None,
+                      'par2': None, 'dar1': None})
+    if not (vInfo['vCodec'] and vInfo['vWidth'] and vInfo['vFps']):
+        vInfo['Supported'] = False
+
+    amap = []
+    for a in audio:
+        desc = [a.get('codec_name', '')]
+        if a.get('sample_rate'):
+            desc.append('%s Hz' % a['sample_rate'])
+        if a.get('channel_layout'):
+            desc.append(a['channel_layout'])
+        if a.get('sample_fmt'):
+            desc.append(a['sample_fmt'])
+        if _kbps(a.get('bit_rate')):
+            desc.append('%s kb/s' % _kbps(a['bit_rate']))
+        lang = a.get('tags', {}).get('language')
+        prefix = lang and '(%s)' % lang or ''
+        amap.append(('0:%d' % a['index'], prefix + ' ' + ', '.join(desc)))
+    if audio:
+        a = audio[0]
+        vInfo['aCodec'] = a.get('codec_name')
+        vInfo['aKbps'] = _kbps(a.get('bit_rate'))
+        vInfo['aFreq'] = a.get('sample_rate')
+        vInfo['aCh'] = a.get('channels')
+    else:
+        vInfo.update({'aCodec': None, 'aKbps': None, 'aFreq': None,
+                      'aCh': None})
+        amap.append(('', ''))
+    vInfo['mapAudio'] = amap
+
+    try:
+        vInfo['millisecs'] = int(float(fmt['duration']) * 1000)
+    except (KeyError, ValueError):
+        vInfo['millisecs'] = 0
+
+    vInfo['kbps'] = _kbps(fmt.get('bit_rate'))
+    if vInfo['kbps'] is None and video:
+        vInfo['kbps'] = _kbps(video[0].get('bit_rate'))
+
+    vInfo['par'] = None
+    vInfo['rawmeta'] = dict((key, [value]) for key, value in
+                            fmt.get('tags', {}).items())
+    return vInfo
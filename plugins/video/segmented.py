@@ -0,0 +1,178 @@
+""" Encode one video as several pieces at once.
+
+    A single ffmpeg encoding MPEG-2 keeps only a few cores busy, which
+    can leave a 1080p source below real time on a box with many more.
+    Here the source is cut at video keyframes into pieces of about the
+    requested length, each piece is encoded by its own ffmpeg, as many
+    at a time as there are workers, and the outputs are joined in order.
+    MPEG program and transport streams can be joined byte for byte, and
+    each piece carries on the timestamps of the one before it.
+
+    Cutting at keyframes means input seeking lands exactly on the cut,
+    so no frames are lost or repeated at the joins, even when the video
+    is copied rather than encoded.
+
+"""
+
+import bisect
+import logging
+import os
+import subprocess
+import threading
+
+import config
+import scheduler
+
+logger = logging.getLogger('pyTivo.video.segmented')
+
+BLOCKSIZE = 512 * 1024
+PART = '.part'
+
+def keyframes(inFile):
+    """ Times, in seconds from the start of inFile, of its video
+        keyframes; empty if they can't be read.
+
+    """
+    ffprobe_path = config.get_bin('ffprobe')
+    if not ffprobe_path:
+        return []
+    cmd = [ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0',
+           inFile]
+    with scheduler.acquire(scheduler.BACKGROUND, inFile):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output = proc.communicate()[0]
+    if proc.returncode:
+        return []
+
+    times = []
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split(',')
+        if len(fields) < 2 or 'K' not in fields[1]:
+            continue
+        try:
+            times.append(float(fields[0]))
+        except ValueError:
+            pass
+    if not times:
+        return []
+    times.sort()
+    first = times[0]
+    return [t - first for t in times]
+
+def plan_cuts(keys, duration, length):
+    """ Start times for pieces of about length seconds of a video
+        duration seconds long, each on the keyframe in keys nearest its
+        target.
+        Without keyframes, the cuts are simply every length seconds.
+
+    """
+    if duration <= length:
+        return [0.0]
+    if not keys:
+        return [float(x) for x in range(0, int(duration), int(length))]
+    cuts = [0.0]
+    while cuts[-1] + length < duration - length / 4.0:
+        target = cuts[-1] + length
+        i = bisect.bisect_left(keys, target)
+        near = [t for t in keys[max(i - 1, 0):i + 1] if t > cuts[-1]]
+        if not near:
+            break
+        cut = min(near, key=lambda t: abs(t - target))
+        if cut >= duration - length / 4.0:
+            break
+        cuts.append(cut)
+    return cuts
+
+def command(inFile, settings, start, end, outFile, threads=0):
+    """ The ffmpeg command line to encode [start, end) of inFile, in
+        seconds, with settings (as transcode.select_settings() gives
+        them, ending in the output name) to outFile. end is None for the
+        rest of the file.
+
+    """
+    cmd = [config.get_bin('ffmpeg'), '-v', 'error', '-y']
+    if start:
+        cmd += ['-ss', '%.6f' % start]
+    cmd += ['-i', inFile]
+    if end is not None:
+        cmd += ['-t', '%.6f' % (end - start)]
+    # -copyts keeps the source timestamps already
+    if start and '-copyts' not in settings:
+        cmd += ['-output_ts_offset', '%.6f' % start]
+    options = settings[:-1]
+    if threads and '-threads' not in options:
+        options = options + ['-threads', str(threads)]
+    return cmd + options + [outFile]
+
+def encode_piece(inFile, settings, start, end, outFile, threads=0):
+    """ Encode one piece into outFile, by way of a .part file so that
+        outFile only ever exists complete. True if ffmpeg succeeded.
+
+    """
+    tmp = outFile + PART
+    cmd = command(inFile, settings, start, end, tmp, threads)
+    with scheduler.acquire(scheduler.BACKGROUND, inFile):
+        logger.debug(' '.join(cmd))
+        ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        output = ffmpeg.communicate()[1]
+    if ffmpeg.returncode:
+        logger.error('Encoding %s from %.1fs failed: %s' %
+                     (inFile, start, output.decode('utf-8', 'replace')))
+        return False
+    os.rename(tmp, outFile)
+    return True
+
+def encode(inFile, settings, cuts, pieces, workers=1, keep_going=None):
+    """ Encode the piece of inFile starting at each time in cuts into
+        the matching file in pieces, workers at a time, skipping pieces
+        already there. New pieces are only started while keep_going()
+        (if given) is true. Returns True once every piece is done, False
+        if one failed, or None if it stopped early.
+
+    """
+    todo = [i for i in range(len(cuts)) if not os.path.exists(pieces[i])]
+    workers = max(1, min(workers, len(todo)))
+    threads = 0
+    if workers > 1:
+        threads = max(1, scheduler.cpu_count() // workers)
+    ends = cuts[1:] + [None]
+    failed = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not todo or failed:
+                    return
+                if keep_going and not keep_going():
+                    return
+                i = todo.pop(0)
+            if not encode_piece(inFile, settings, cuts[i], ends[i],
+                                pieces[i], threads):
+                failed.append(i)
+
+    if workers == 1:
+        work()
+    else:
+        running = [threading.Thread(target=work) for x in range(workers)]
+        for thread in running:
+            thread.daemon = True
+            thread.start()
+        for thread in running:
+            thread.join()
+
+    if failed:
+        return False
+    if all(os.path.exists(piece) for piece in pieces):
+        return True
+    return None
+
+def join(pieces, write):
+    """ Feed the pieces, in order, to write(). """
+    for piece in pieces:
+        with open(piece, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCKSIZE), b''):
+                write(block)
@@ -0,0 +1,307 @@
+""" Transcoding sessions that several transfers can share.
+
+    A Session wraps one running ffmpeg (or decoder) and keeps the most
+    recent part of its output in a SpillBuffer: the newest few megabytes
+    in memory, and older output, up to the configured window, in a
+    temporary file used as a ring. Any number of readers can
+    follow it, each at its own offset; whichever reader needs data past
+    the end of the buffer reads the next block from the process, so
+    ffmpeg runs at the pace of the furthest-ahead viewer. A reader that
+    falls behind the start of the buffer gets None from read(), and must
+    find its data elsewhere.
+
+    Offsets here count only the process output, not any TiVo header the
+    transfer sends ahead of it.
+
+"""
+
+import collections
+import logging
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('pyTivo.video.session')
+
+BLOCKSIZE = 512 * 1024
+
+# Bytes of recent output kept for readers that are behind the leader
+WINDOW = 64 * 1024 * 1024
+
+# How much of the window stays in memory before spilling to disk
+MEMORY = 16 * 1024 * 1024
+
+# Encode speed (relative to playback) below which a stream can't keep up
+SLOW = 1.0
+
+# Milliseconds of output before speed is judged, while ffmpeg warms up
+WARMUP = 10000
+
+def parse_progress(report, duration=0):
+    """ Turn one block of ffmpeg -progress key=value pairs into
+        transfer status values. duration is the source length in ms.
+
+    """
+    progress = {}
+    # Despite the name, out_time_ms is in microseconds too
+    for key in ('out_time_us', 'out_time_ms'):
+        try:
+            progress['encoded'] = int(report[key]) // 1000
+            break
+        except (KeyError, ValueError):
+            pass
+    try:
+        progress['speed'] = float(report['speed'].rstrip('x'))
+    except (KeyError, ValueError):
+        pass
+    try:
+        progress['fps'] = float(report['fps'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        progress['bitrate'] = float(report['bitrate'].replace('kbits/s', ''))
+    except (KeyError, ValueError):
+        pass
+    if duration and 'encoded' in progress:
+        progress['percent'] = min(100, progress['encoded'] * 100 // duration)
+    if 'speed' in progress:
+        progress['realtime'] = progress['speed'] >= SLOW
+        # Seconds until the encode is done, at the current speed
+        if duration and progress['speed'] > 0 and 'encoded' in progress:
+            progress['eta'] = max(0, duration - progress['encoded']) / \
+                              (progress['speed'] * 1000)
+    return progress
+
+class SpillBuffer(object):
+    """ The last window bytes of a stream. The newest output is held in
+        memory; once that passes MEMORY bytes, the oldest blocks move to
+        a temporary file, where offset N lives at N % window. Not
+        thread-safe; Session locks around it.
+
+    """
+    def __init__(self, window=WINDOW, memory=MEMORY):
+        self.window = window
+        self.memory = min(memory, window)
+        self.blocks = collections.deque()
+        self.start = 0          # oldest offset still held
+        self.spilled = 0        # offsets below this are in the file
+        self.end = 0
+        self.file = None
+
+    def append(self, block):
+        self.blocks.append(block)
+        self.end += len(block)
+        while self.end - self.spilled - len(self.blocks[0]) >= self.memory:
+            # Only let go of the block once it's safely on disk
+            self._spill(self.blocks[0])
+            self.blocks.popleft()
+        self.start = max(self.start, self.end - self.window)
+        if not self.file:
+            self.start = max(self.start, self.spilled)
+
+    def _spill(self, block):
+        if self.window > self.memory:
+            if not self.file:
+                self.file = tempfile.TemporaryFile()
+            pos = self.spilled % self.window
+            head = block[:self.window - pos]
+            self.file.seek(pos)
+            self.file.write(head)
+            if len(head) < len(block):
+                self.file.seek(0)
+                self.file.write(block[len(head):])
+        self.spilled += len(block)
+
+    def drop_disk(self):
+        """ Stop spilling, and forget what was spilled. """
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.window = self.memory
+        self.start = max(self.start, self.spilled)
+
+    def read(self, offset, count=BLOCKSIZE):
+        """ Up to count bytes from offset, which must be in
+            [start, end).
+
+        """
+        if offset >= self.spilled:
+            pos = self.spilled
+            for block in self.blocks:
+                if offset < pos + len(block):
+                    return block[offset - pos:]
+                pos += len(block)
+            return b''
+        pos = offset % self.window
+        count = min(count, self.spilled - offset, self.window - pos)
+        self.file.flush()
+        self.file.seek(pos)
+        return self.file.read(count)
+
+    def close(self):
+        self.blocks.clear()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class Session(object):
+    def __init__(self, process, job=None, cache=None, prefix=0,
+                 window=WINDOW):
+        self.process = process
+        self.job = job
+        self.cache = cache
+        self.prefix = prefix
+        self.buffer = SpillBuffer(window)
+        self.cond = threading.Condition()
+        self.done = False
+        self.pulling = False
+        self.readers = 0
+        self.last_read = time.time()
+        self.progress = {}
+
+    @property
+    def start(self):
+        return self.buffer.start
+
+    @property
+    def end(self):
+        return self.buffer.end
+
+    def attach(self):
+        with self.cond:
+            self.readers += 1
+            self.last_read = time.time()
+
+    def detach(self):
+        with self.cond:
+            self.readers -= 1
+            self.last_read = time.time()
+
+    def read(self, offset):
+        """ Return the output at offset, up to the end of the block that
+            holds it. Returns '' once the process has finished and
+            everything has been read, or None if offset has already left
+            the buffer.
+
+        """
+        while True:
+            with self.cond:
+                if offset < self.buffer.start:
+                    return None
+                if offset < self.buffer.end:
+                    return self.buffer.read(offset)
+                if self.done:
+                    return b''
+                if self.pulling:
+                    self.cond.wait()
+                    continue
+                self.pulling = True
+            self._pull()
+
+    def _pull(self):
+        failed = False
+        try:
+            block = self.process.stdout.read(BLOCKSIZE)
+        except Exception as msg:
+            logger.info(msg)
+            block = b''
+            failed = True
+
+        if block and self.cache:
+            self.cache.write(block)
+
+        with self.cond:
+            self.pulling = False
+            self.last_read = time.time()
+            if block:
+                try:
+                    self.buffer.append(block)
+                except (IOError, OSError) as msg:
+                    # Out of temp space; carry on with what fits in memory
+                    logger.error('Spilling transcode buffer: %s' % msg)
+                    self.buffer.drop_disk()
+            else:
+                self.done = True
+            self.cond.notify_all()
+
+        if not block:
+            self._finish(failed)
+
+    def _finish(self, failed):
+        # A process that was killed, or failed, must not leave a
+        # truncated file in the cache
+        if not failed and self.process.wait() != 0:
+            failed = True
+        if self.job:
+            self.job.release()
+        if self.cache:
+            if failed:
+                self.cache.abort()
+            else:
+                self.cache.finish()
+
+    def watch(self, pipe, duration=0, name=''):
+        """ Follow the ffmpeg -progress reports written to pipe, in a
+            thread of their own. Other lines are ffmpeg's usual messages,
+            and go to the debug log.
+
+        """
+        thread = threading.Thread(target=self._read_progress,
+                                  args=(pipe, duration, name))
+        thread.daemon = True
+        thread.start()
+
+    def _read_progress(self, pipe, duration, name):
+        report = {}
+        slow = False
+        for line in iter(pipe.readline, b''):
+            line = line.decode('utf-8', 'replace').strip()
+            if '=' not in line:
+                if line:
+                    logger.debug(line)
+                continue
+            key, value = line.split('=', 1)
+            report[key.strip()] = value.strip()
+            if key != 'progress':
+                continue
+
+            progress = parse_progress(report, duration)
+            report = {}
+            with self.cond:
+                self.progress = progress
+            if ('speed' not in progress or
+                progress.get('encoded', 0) < WARMUP):
+                continue
+            if progress['speed'] < SLOW and not slow:
+                logger.warning('Transcode of %s is running at %.2fx, '
+                               'slower than playback' %
+                               (name, progress['speed']))
+                slow = True
+            elif progress['speed'] >= SLOW and slow:
+                logger.info('Transcode of %s is back up to %.2fx' %
+                            (name, progress['speed']))
+                slow = False
+        pipe.close()
+
+    def report(self, status):
+        """ Copy the latest encoder progress into a transfer status. """
+        with self.cond:
+            status.update(self.progress)
+
+    def close(self):
+        """ Free the buffer, once nobody will read it again. """
+        with self.cond:
+            self.buffer.close()
+
+    def stop(self, kill):
+        """ End the session early, stopping the process with kill(). """
+        with self.cond:
+            if self.done:
+                return
+            self.done = True
+            self.cond.notify_all()
+        kill(self.process)
+        if self.job:
+            self.job.release()
+        if self.cache:
+            self.cache.abort()
@@ -1,6 +1,8 @@
+import json
 import logging
 import math
 import os
+import queue
 import re
 import shlex
 import shutil
@@ -13,21 +15,46 @@ import time
 import lrucache
 
 import config
+import filestream
+import housekeeping
 import metadata
+import probecache
+from probeparse import parse_ffmpeg, parse_ffprobe
+import scheduler
+import session
+import tivodecoder
+import transcodecache
 
 logger = logging.getLogger('pyTivo.video.transcode')
 
 info_cache = lrucache.LRUCache(1000)
-ffmpeg_procs = {}
+
+# Plans, by (path, TiVo class, mime)
+plan_cache = lrucache.LRUCache(5000)
+
+# Running transcodes, by (path, output key), and their reaper tasks
+sessions = {}
 reapers = {}
+session_lock = threading.RLock()
+
+# Resume requests served without re-encoding, and those that weren't
+resume_stats = {'hits': 0, 'misses': 0}
+
+# Background probes queued by probe_files(), by path, and the queue
+# their workers take them from
+probe_pending = {}
+probe_lock = threading.Lock()
+probe_queue = None
 
 GOOD_MPEG_FPS = ['23.98', '24.00', '25.00', '29.97',
                  '30.00', '50.00', '59.94', '60.00']
 
 BLOCKSIZE = 512 * 1024
-MAXBLOCKS = 2
 TIMEOUT = 600
 
+# Have ffmpeg report its progress on stderr, instead of its status line
+PROGRESS = ['-progress', 'pipe:2', '-nostats']
+
 # XXX BIG HACK
 # subprocess is broken for me on windows so super hack
 def patchSubprocess():
@@ -53,7 +80,204 @@ def debug(msg):
                 msg = msg.decode('cp1252')
     logger.debug(msg)
 
-def transcode(isQuery, inFile, outFile, status=None, isTivoFile=False, tsn='', mime='', thead=''):
+class Plan(object):
+    """ What sending one file to one class of TiVo as one mime type
+        involves -- whether it needs transcoding and why, the ffmpeg
+        options, the likely size -- each worked out the first time it's
+        asked for. A plan is only good for the file and settings it was
+        made from; get_plan() checks both.
+
+    """
+    def __init__(self, inFile, tsn, mime, fingerprint, generation):
+        self.inFile = inFile
+        self.tsn = tsn
+        self.mime = mime
+        self.fingerprint = fingerprint
+        self.generation = generation
+        self.values = {}
+
+    def _once(self, name, func, *args):
+        try:
+            return self.values[name]
+        except KeyError:
+            value = self.values[name] = func(*args)
+            return value
+
+    def verdict(self):
+        """ (compatible, reason), as tivo_compatible() returns them. """
+        return self._once('verdict', check_compatible, self.inFile,
+                          self.tsn, self.mime)
+
+    @property
+    def compatible(self):
+        return self.verdict()[0]
+
+    @property
+    def reason(self):
+        return self.verdict()[1]
+
+    def settings(self):
+        """ The ffmpeg output options, as transcode(True, ...) gives
+            them.
+
+        """
+        return list(self._once('settings', select_settings, True,
+                               self.inFile, self.tsn, self.mime))
+
+    def play_settings(self):
+        """ The ffmpeg output options a transcode actually runs with,
+            with the audio codec worked out where a query leaves it
+            'TBA'. Cached transcodes and shared sessions are keyed on
+            these.
+
+        """
+        return list(self._once('play_settings', select_settings, False,
+                               self.inFile, self.tsn, self.mime))
+
+    def est_size(self):
+        return self._once('size', estimate_size, self.inFile, self.tsn,
+                          self.mime, self.compatible, self.fingerprint)
+
+    # These don't depend on the mime type, and are asked of the plan
+    # for mime ''
+
+    def aspect(self):
+        return self._once('aspect', choose_aspect, self.inFile, self.tsn)
+
+    def audiolang(self):
+        return self._once('audiolang', choose_audiolang, self.inFile,
+                          self.tsn)
+
+def tivo_class(tsn):
+    """ What decides how a TiVo is treated: its own config section, if
+        it has one, or else the section for its kind and its model
+        number (the first three digits of the TSN).
+
+    """
+    if tsn and config.isTsnInConfig(tsn):
+        return '_tivo_' + tsn
+    return config.get_section(tsn) + ':' + tsn[:3]
+
+def get_plan(inFile, tsn='', mime=''):
+    """ The Plan for sending inFile to this TiVo as mime, made fresh if
+        the file or the config has changed since the last one.
+
+    """
+    try:
+        st = os.stat(inFile)
+    except OSError:
+        # Let whatever asks find out the usual way; don't keep it
+        return Plan(inFile, tsn, mime, None, config.generation)
+    fingerprint = (st.st_size, st.st_mtime)
+    key = (inFile, tivo_class(tsn), mime)
+    plan = plan_cache.get(key)
+    if (plan is None or plan.fingerprint != fingerprint or
+        plan.generation != config.generation):
+        plan = Plan(inFile, tsn, mime, fingerprint, config.generation)
+        plan_cache[key] = plan
+    return plan
+
+def estimate_size(inFile, tsn, mime, compatible, fingerprint=None):
+    """ Bytes sent for inFile: its own size if it goes as it is, or
+        else its length at the audio and video bit rates, plus 2%.
+
+    """
+    if compatible:
+        if fingerprint:
+            return fingerprint[0]
+        return os.path.getsize(unicode(inFile, 'utf-8'))
+    # Must be re-encoded
+    audioBPS = config.getMaxAudioBR(tsn) * 1000
+    videoBPS = select_videostr(inFile, tsn)
+    bitrate = audioBPS + videoBPS
+    return int((video_info(inFile)['millisecs'] / 1000) *
+               (bitrate * 1.02 / 8))
+
+def reserve(inFile, isTivoFile=False, tsn=''):
+    """ The ffmpeg slot a transcode of inFile will run in, taken before
+        the response starts, or None if it won't need one. Raises
+        scheduler.Busy if none comes free within ffmpeg_slot_wait.
+
+    """
+    if isTivoFile and tivo_compatible(inFile, tsn)[0]:
+        # Just decrypted; no ffmpeg
+        return None
+    return scheduler.acquire(scheduler.PLAYBACK, inFile,
+                             config.getFFmpegSlotWait())
+
+def transcode(isQuery, inFile, outFile, status=None, isTivoFile=False, tsn='', mime='', thead='', job=None):
+    """ Send inFile, transcoded, to outFile. job, from reserve(), is the
+        slot to run ffmpeg in; it's released if ffmpeg isn't needed.
+
+    """
+    if isQuery:
+        return get_plan(inFile, tsn, mime).settings()
+    try:
+        settings = get_plan(inFile, tsn, mime).play_settings()
+        decode_only = isTivoFile and tivo_compatible(inFile, tsn)[0]
+    except:
+        if job:
+            job.release()
+        raise
+
+    if decode_only:
+        key = transcodecache.make_key(inFile, tsn, mime, ['decode'])
+    else:
+        key = session_key(inFile, tsn, mime)
+        cache = transcodecache.get_cache()
+        cached = cache and cache.lookup(key)
+        if cached:
+            debug('serving cached transcode %s' % cached)
+            if job:
+                job.release()
+            return send_cached(cached, outFile, 0, thead, status)
+
+    # Join a viewer already watching this with the same settings, if
+    # it's still near the start
+    with session_lock:
+        shared = sessions.get((inFile, key))
+        if shared and shared.start == 0:
+            shared.attach()
+        else:
+            shared = None
+    if shared:
+        debug('sharing transcode of %s' % inFile)
+        if job:
+            job.release()
+        try:
+            return send_session(shared, inFile, outFile, 0, status, tsn,
+                                mime, thead, True)
+        finally:
+            shared.detach()
+            retire(inFile, key)
+
+    sess = start_session(inFile, settings, status, isTivoFile, tsn, mime,
+                         decode_only, len(thead), key, job)
+    with session_lock:
+        if (inFile, key) in sessions:
+            # Someone else's is shared; this one stays private
+            key = None
+        else:
+            sessions[(inFile, key)] = sess
+            reap_process(inFile, key)
+        sess.attach()
+    try:
+        return send_session(sess, inFile, outFile, 0, status, tsn, mime,
+                            thead, key is not None)
+    finally:
+        sess.detach()
+        if key is None:
+            sess.stop(kill)
+            sess.close()
+        else:
+            retire(inFile, key)
+
+def select_settings(isQuery, inFile, tsn='', mime=''):
+    """ The ffmpeg output options for sending inFile to this TiVo as
+        mime. A query may leave the audio codec as 'TBA' rather than
+        probe the audio further.
+
+    """
     vcodec = select_videocodec(inFile, tsn, mime)
 
     settings = select_buffsize(tsn) + vcodec
@@ -75,162 +299,300 @@ def transcode(isQuery, inFile, outFile, status=None, isTivoFile=False, tsn='', m
 
     settings += select_format(tsn, mime)
 
-    settings = ' '.join(settings).split()
-    if isQuery:
-        return settings
+    return ' '.join(settings).split()
 
+def start_session(inFile, settings, status=None, isTivoFile=False, tsn='',
+                  mime='', decode_only=False, prefix=0, key=None, job=None):
     ffmpeg_path = config.get_bin('ffmpeg')
 
     fname = unicode(inFile, 'utf-8')
     if mswindows:
         fname = fname.encode('cp1252')
 
-    if isTivoFile:
-        if status:
-            status['decrypting'] = True
-
-        tivo_mak = config.get_server('tivo_mak')
-        tivodecode_path = config.get_bin('tivodecode')
-        tcmd = [tivodecode_path, '-m', tivo_mak, fname]
+    if decode_only:
+        # Only decrypting, which takes no ffmpeg slot
+        if job:
+            job.release()
+        job = None
+    elif job is None:
+        # Wait for an ffmpeg slot
+        job = scheduler.acquire(scheduler.PLAYBACK, inFile)
+    if status is not None and job:
+        status['wait'] = job.wait
+    # Take a fair share of the cores
+    options = settings
+    if '-threads' not in settings:
+        options = (settings[:-1] + ['-threads', str(scheduler.thread_share())]
+                   + settings[-1:])
 
-        if bool(config.get_bin('tivolibre')):
-            decoder_path = config.get_bin('tivolibre')
-            tcmd = [tivodecode_path, '-m', tivo_mak, '-i', fname]
+    try:
+        if isTivoFile:
+            if status:
+                status['decrypting'] = True
 
-        tivodecode = subprocess.Popen(tcmd, stdout=subprocess.PIPE,
-                                      bufsize=(512 * 1024))
-        if tivo_compatible(inFile, tsn)[0]:
-            cmd = ''
-            ffmpeg = tivodecode
+            tivo_mak = config.get_server('tivo_mak')
+            if tivodecoder.use_python(tivodecoder.is_ts_file(inFile)):
+                tivodecode = tivodecoder.DecodeThread(inFile, tivo_mak)
+            else:
+                tivodecode_path = config.get_bin('tivodecode')
+                tcmd = [tivodecode_path, '-m', tivo_mak, fname]
+
+                if bool(config.get_bin('tivolibre')):
+                    decoder_path = config.get_bin('tivolibre')
+                    tcmd = [tivodecode_path, '-m', tivo_mak, '-i', fname]
+
+                tivodecode = subprocess.Popen(tcmd, stdout=subprocess.PIPE,
+                                              bufsize=(512 * 1024))
+            if decode_only:
+                cmd = ''
+                ffmpeg = tivodecode
+            else:
+                cmd = [ffmpeg_path] + PROGRESS + ['-i', '-'] + options
+                ffmpeg = subprocess.Popen(cmd, stdin=tivodecode.stdout,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          bufsize=(512 * 1024))
+                if not tivodecode.pid:
+                    # ffmpeg has the pipe now; with our end closed, the
+                    # decoder stops when ffmpeg does
+                    tivodecode.stdout.close()
         else:
-            cmd = [ffmpeg_path, '-i', '-'] + settings
-            ffmpeg = subprocess.Popen(cmd, stdin=tivodecode.stdout,
+            cmd = [ffmpeg_path] + PROGRESS + ['-i', fname] + options
+            ffmpeg = subprocess.Popen(cmd, bufsize=(512 * 1024),
                                       stdout=subprocess.PIPE,
-                                      bufsize=(512 * 1024))
-    else:
-        cmd = [ffmpeg_path, '-i', fname] + settings
-        ffmpeg = subprocess.Popen(cmd, bufsize=(512 * 1024),
-                                  stdout=subprocess.PIPE)
+                                      stderr=subprocess.PIPE)
+    except:
+        if job:
+            job.release()
+        raise
 
     if cmd:
         debug('transcoding to tivo model ' + tsn[:3] + ' using ffmpeg command:')
         debug(' '.join(cmd))
 
-    ffmpeg_procs[inFile] = {'process': ffmpeg, 'start': 0, 'end': 0,
-                            'last_read': time.time(), 'blocks': []}
-    if thead:
-        ffmpeg_procs[inFile]['blocks'].append(thead)
-    reap_process(inFile)
-    return resume_transfer(inFile, outFile, 0)
-
-def is_resumable(inFile, offset):
-    if inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['start'] <= offset < proc['end']:
-            return True
-        else:
-            cleanup(inFile)
-            kill(proc['process'])
-    return False
-
-def resume_transfer(inFile, outFile, offset, status=None):
-    proc = ffmpeg_procs[inFile]
-    offset -= proc['start']
-    count = 0
+    writer = None
+    cache = transcodecache.get_cache()
+    if cache and key and not decode_only:
+        writer = cache.create(key)
+    sess = session.Session(ffmpeg, job, writer, prefix,
+                           config.getTranscodeBuffer())
+    if cmd:
+        sess.watch(ffmpeg.stderr, video_info(inFile)['millisecs'],
+                   os.path.basename(inFile))
+    # What a reader that falls behind needs to start its own
+    sess.is_tivo_file = isTivoFile
+    sess.decode_only = decode_only
+    return sess
+
+def session_key(inFile, tsn, mime):
+    """ The key a transcode of inFile for this TiVo and mime type is
+        cached and shared under: made from the settings it runs with,
+        so lookups find what transcode() wrote.
+
+    """
+    settings = get_plan(inFile, tsn, mime).play_settings()
+    return transcodecache.make_key(inFile, tsn, mime, settings)
+
+def cached_output(inFile, tsn, mime):
+    """ Path of the finished cached transcode of inFile for this TiVo
+        and mime type, if there is one.
+
+    """
+    cache = transcodecache.get_cache()
+    if not cache:
+        return None
+    return cache.lookup(session_key(inFile, tsn, mime))
+
+def find_session(inFile, tsn, mime):
+    """ The shared session for inFile on this TiVo and mime type, as
+        (key, session), attached; or (key, None).
+
+    """
+    keys = [session_key(inFile, tsn, mime)]
+    if inFile[-5:].lower() == '.tivo':
+        keys.append(transcodecache.make_key(inFile, tsn, mime, ['decode']))
+    with session_lock:
+        for key in keys:
+            sess = sessions.get((inFile, key))
+            if sess:
+                sess.attach()
+                return key, sess
+    return keys[0], None
+
+def count_resume(hit, offset):
+    resume_stats[['misses', 'hits'][hit]] += 1
+    total = resume_stats['hits'] + resume_stats['misses']
+    debug('resume at %d %s; %d of %d resumes served without re-encoding' %
+          (offset, ['missed', 'hit'][hit], resume_stats['hits'], total))
+    return hit
+
+def resume_hit_rate():
+    total = resume_stats['hits'] + resume_stats['misses']
+    return total and float(resume_stats['hits']) / total
+
+def is_resumable(inFile, offset, tsn='', mime=''):
+    key, sess = find_session(inFile, tsn, mime)
+    if sess:
+        try:
+            pos = offset - sess.prefix
+            if sess.start <= pos <= sess.end:
+                return count_resume(True, offset)
+            if sess.cache and not sess.cache.aborted and pos < sess.end:
+                return count_resume(True, offset)
+            # Too far back; that's only worth a new transcode if the
+            # session itself is still serving someone
+            if sess.readers > 1:
+                count_resume(False, offset)
+                return True
+        finally:
+            sess.detach()
+        with session_lock:
+            if not sess.readers and sessions.get((inFile, key)) is sess:
+                cleanup(inFile, key)
+                sess.stop(kill)
+    return count_resume(bool(cached_output(inFile, tsn, mime)), offset)
+
+def send_cached(path, outFile, offset, thead='', status=None):
+    """ Send a cached transcode, with thead ahead of it, from offset. """
     output = 0
-
     try:
-        start_time = time.time()
-        last_interval = start_time
-        now = start_time
-        for block in proc['blocks']:
-            length = len(block)
-            if offset < length:
-                if offset > 0:
-                    block = block[offset:]
-                outFile.write('%x\r\n' % len(block))
-                outFile.write(block)
-                outFile.write('\r\n')
-                count += len(block)
-                output += len(block)
-
-                now = time.time()
-                elapsed = now - last_interval
-                if elapsed >= 1:
-                    status['rate'] = (count * 8.0) / elapsed
-                    status['output'] += count
-                    count = 0
-                    last_interval = now
-
-            offset -= length
-        outFile.flush()
-    except Exception, msg:
-        status['error'] = str(msg)
+        f = open(path, 'rb')
+    except IOError as msg:
         logger.info(msg)
         return output
+    meter = filestream.Meter(status)
+    try:
+        if offset < len(thead):
+            block = thead[offset:]
+            outFile.write('%x\r\n' % len(block))
+            outFile.write(block)
+            outFile.write('\r\n')
+            output += len(block)
+            meter.add(len(block))
+        else:
+            f.seek(offset - len(thead))
+        while True:
+            block = f.read(BLOCKSIZE)
+            if not block:
+                break
+            outFile.write('%x\r\n' % len(block))
+            outFile.write(block)
+            outFile.write('\r\n')
+            output += len(block)
+            meter.add(len(block))
+        outFile.flush()
+    except Exception as msg:
+        if status is not None:
+            status['error'] = str(msg)
+        logger.info(msg)
+    f.close()
+    return output
 
-    proc['start'] = proc['end']
-    proc['blocks'] = []
-
-    return output + transfer_blocks(inFile, outFile)
-
-def transfer_blocks(inFile, outFile):
-    proc = ffmpeg_procs[inFile]
-    blocks = proc['blocks']
-    count = 0
-
-    while True:
-        try:
-            block = proc['process'].stdout.read(BLOCKSIZE)
-            proc['last_read'] = time.time()
-        except Exception, msg:
-            logger.info(msg)
-            cleanup(inFile)
-            kill(proc['process'])
-            break
+def send_session(sess, inFile, outFile, offset, status=None, tsn='', mime='',
+                 thead='', fallback=True):
+    """ Send a session's output, with thead ahead of it, from offset. If
+        the reader falls behind what the session still holds (in memory
+        or in its cache file), and fallback is set, the rest comes from a
+        transcode of its own.
 
-        if not block:
-            try:
+    """
+    output = 0
+    meter = filestream.Meter(status)
+    try:
+        if offset < len(thead):
+            block = thead[offset:]
+            outFile.write('%x\r\n' % len(block))
+            outFile.write(block)
+            outFile.write('\r\n')
+            output += len(block)
+            meter.add(len(block))
+            offset = len(thead)
+        pos = offset - len(thead)
+
+        while True:
+            block = sess.read(pos)
+            if block is None and sess.cache:
+                block = sess.cache.read_range(pos, BLOCKSIZE) or None
+            if block is None:
+                break
+            if not block:
                 outFile.flush()
-            except Exception, msg:
-                logger.info(msg)
-            else:
-                cleanup(inFile)
-            break
-
-        blocks.append(block)
-        proc['end'] += len(block)
-        if len(blocks) > MAXBLOCKS:
-            proc['start'] += len(blocks[0])
-            blocks.pop(0)
-
-        try:
+                return output
             outFile.write('%x\r\n' % len(block))
             outFile.write(block)
             outFile.write('\r\n')
-            count += len(block)
-        except Exception, msg:
-            logger.info(msg)
-            break
+            pos += len(block)
+            output += len(block)
+            meter.add(len(block))
+            if status is not None:
+                sess.report(status)
+    except Exception as msg:
+        if status is not None:
+            status['error'] = str(msg)
+        logger.info(msg)
+        return output
 
-    return count
+    if not fallback:
+        return output
+
+    debug('reader of %s fell behind at %d, starting its own transcode' %
+          (inFile, pos))
+    settings = get_plan(inFile, tsn, mime).play_settings()
+    own = start_session(inFile, settings, status, sess.is_tivo_file, tsn,
+                        mime, sess.decode_only, len(thead))
+    own.attach()
+    try:
+        return output + send_session(own, inFile, outFile,
+                                     pos + len(thead), status, tsn, mime,
+                                     thead, False)
+    finally:
+        own.detach()
+        own.stop(kill)
+        own.close()
+
+def resume_transfer(inFile, outFile, offset, status=None, tsn='', mime='',
+                    thead=''):
+    key, sess = find_session(inFile, tsn, mime)
+    if not sess:
+        path = cached_output(inFile, tsn, mime)
+        if not path:
+            return 0
+        return send_cached(path, outFile, offset, thead, status)
 
-def reap_process(inFile):
-    if ffmpeg_procs and inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['last_read'] + TIMEOUT < time.time():
-            del ffmpeg_procs[inFile]
-            del reapers[inFile]
-            kill(proc['process'])
+    try:
+        return send_session(sess, inFile, outFile, offset, status, tsn, mime,
+                            thead)
+    finally:
+        sess.detach()
+        retire(inFile, key)
+
+def retire(inFile, key):
+    """ Forget a finished session once its last reader is gone. """
+    with session_lock:
+        sess = sessions.get((inFile, key))
+        if sess and sess.done and not sess.readers:
+            cleanup(inFile, key)
+
+def reap_process(inFile, key):
+    with session_lock:
+        sess = sessions.get((inFile, key))
+        if not sess:
+            return
+        if sess.last_read + TIMEOUT < time.time() and not sess.readers:
+            del sessions[(inFile, key)]
+            del reapers[(inFile, key)]
+            sess.stop(kill)
+            sess.close()
         else:
-            reaper = threading.Timer(TIMEOUT, reap_process, (inFile,))
-            reapers[inFile] = reaper
-            reaper.start()
+            due = max(sess.last_read + TIMEOUT - time.time(), 1)
+            reapers[(inFile, key)] = housekeeping.schedule(due, reap_process,
+                (inFile, key), 'reap %s' % os.path.basename(inFile))
 
-def cleanup(inFile):
-    del ffmpeg_procs[inFile]
-    reapers[inFile].cancel()
-    del reapers[inFile]
+def cleanup(inFile, key):
+    sess = sessions.pop((inFile, key))
+    reapers.pop((inFile, key)).cancel()
+    if not sess.readers:
+        sess.close()
 
 def select_audiocodec(isQuery, inFile, tsn='', mime=''):
     if inFile[-5:].lower() == '.tivo':
@@ -281,6 +643,9 @@ def select_audioch(inFile, tsn):
     return []
 
 def select_audiolang(inFile, tsn):
+    return get_plan(inFile, tsn).audiolang()
+
+def choose_audiolang(inFile, tsn):
     vInfo = video_info(inFile)
     audio_lang = config.get_tsn('audio_lang', tsn)
     debug('audio_lang: %s' % audio_lang)
@@ -405,6 +770,9 @@ def pad_LR(TIVO_WIDTH, TIVO_HEIGHT, multiplier, vInfo):
             TIVO_HEIGHT, TIVO_WIDTH, TIVO_HEIGHT, leftPadding)]
 
 def select_aspect(inFile, tsn = ''):
+    return get_plan(inFile, tsn).aspect()
+
+def choose_aspect(inFile, tsn):
     TIVO_WIDTH = config.getTivoWidth(tsn)
     TIVO_HEIGHT = config.getTivoHeight(tsn)
 
@@ -645,6 +1013,9 @@ def tivo_compatible_container(vInfo, inFile, mime=''):
     return message
 
 def tivo_compatible(inFile, tsn='', mime=''):
+    return get_plan(inFile, tsn, mime).verdict()
+
+def check_compatible(inFile, tsn='', mime=''):
     vInfo = video_info(inFile)
 
     message = (True, 'all compatible')
@@ -675,7 +1046,6 @@ def tivo_compatible(inFile, tsn='', mime=''):
     return message
 
 def video_info(inFile, cache=True):
-    vInfo = dict()
     fname = unicode(inFile, 'utf-8')
     mtime = os.path.getmtime(fname)
     if cache:
@@ -683,216 +1053,30 @@ def video_info(inFile, cache=True):
             debug('CACHE HIT! %s' % inFile)
             return info_cache[inFile][1]
 
-    vInfo['Supported'] = True
-
-    ffmpeg_path = config.get_bin('ffmpeg')
-    if not ffmpeg_path:
-        if os.path.splitext(inFile)[1].lower() not in ['.mpg', '.mpeg',
-                                                       '.vob', '.tivo', '.ts']:
-            vInfo['Supported'] = False
-        vInfo.update({'millisecs': 0, 'vWidth': 704, 'vHeight': 480,
-                      'rawmeta': {}})
-        if cache:
-            info_cache[inFile] = (mtime, vInfo)
-        return vInfo
-
-    if mswindows:
-        fname = fname.encode('cp1252')
-    cmd = [ffmpeg_path, '-i', fname]
-    # Windows and other OS buffer 4096 and ffmpeg can output more than that.
-    err_tmp = tempfile.TemporaryFile()
-    ffmpeg = subprocess.Popen(cmd, stderr=err_tmp, stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE)
-
-    # wait configured # of seconds: if ffmpeg is not back give up
-    limit = config.getFFmpegWait()
-    if limit:
-        for i in xrange(limit * 20):
-            time.sleep(.05)
-            if not ffmpeg.poll() == None:
-                break
-
-        if ffmpeg.poll() == None:
-            kill(ffmpeg)
-            vInfo['Supported'] = False
+    # The persistent store holds the raw probe; overrides from the
+    # metadata files are applied on top every time, since they can
+    # change without the video changing.
+    store = cache and probecache.get_store()
+    vInfo = None
+    if store:
+        size = os.path.getsize(fname)
+        vInfo = store.get(inFile, size, mtime)
+        if vInfo is not None:
+            debug('PROBE CACHE HIT! %s' % inFile)
+
+    if vInfo is None:
+        probe = None
+        if config.getProbeBackend() == 'ffprobe':
+            probe = ffprobe_info(inFile)
+        if probe is None:
+            probe = ffmpeg_info(inFile)
+        vInfo, complete = probe
+        if not complete:
             if cache:
                 info_cache[inFile] = (mtime, vInfo)
             return vInfo
-    else:
-        ffmpeg.wait()
-
-    err_tmp.seek(0)
-    output = err_tmp.read()
-    err_tmp.close()
-    debug('ffmpeg output=%s' % output)
-
-    attrs = {'container': r'Input #0, ([^,]+),',
-             'vCodec': r'Video: ([^, ]+)',             # video codec
-             'aKbps': r'.*Audio: .+, (.+) (?:kb/s).*',     # audio bitrate
-             'aCodec': r'.*Audio: ([^, ]+)',             # audio codec
-             'aFreq': r'.*Audio: .+, (.+) (?:Hz).*',       # audio frequency
-             'mapVideo': r'([0-9]+[.:]+[0-9]+).*: Video:.*'}  # video mapping
-
-    for attr in attrs:
-        rezre = re.compile(attrs[attr])
-        x = rezre.search(output)
-        if x:
-            vInfo[attr] = x.group(1)
-        else:
-            if attr in ['container', 'vCodec']:
-                vInfo[attr] = ''
-                vInfo['Supported'] = False
-            else:
-                vInfo[attr] = None
-            debug('failed at ' + attr)
-
-    rezre = re.compile(r'.*Audio: .+, (?:(\d+)(?:(?:\.(\d).*)?(?: channels.*)?)|(stereo|mono)),.*')
-    x = rezre.search(output)
-    if x:
-        if x.group(3):
-            if x.group(3) == 'stereo':
-                vInfo['aCh'] = 2
-            elif x.group(3) == 'mono':
-                vInfo['aCh'] = 1
-        elif x.group(2):
-            vInfo['aCh'] = int(x.group(1)) + int(x.group(2))
-        elif x.group(1):
-            vInfo['aCh'] = int(x.group(1))
-        else:
-            vInfo['aCh'] = None
-            debug('failed at aCh')
-    else:
-        vInfo['aCh'] = None
-        debug('failed at aCh')
-
-    rezre = re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*')
-    x = rezre.search(output)
-    if x:
-        vInfo['vWidth'] = int(x.group(1))
-        vInfo['vHeight'] = int(x.group(2))
-    else:
-        vInfo['vWidth'] = ''
-        vInfo['vHeight'] = ''
-        vInfo['Supported'] = False
-        debug('failed at vWidth/vHeight')
-
-    rezre = re.compile(r'.*Video: .+, (.+) (?:fps|tb\(r\)|tbr).*')
-    x = rezre.search(output)
-    if x:
-        vInfo['vFps'] = x.group(1)
-        if '.' not in vInfo['vFps']:
-            vInfo['vFps'] += '.00'
-
-        # Allow override only if it is mpeg2 and frame rate was doubled
-        # to 59.94
-
-        if vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] != '29.97':
-            # First look for the build 7215 version
-            rezre = re.compile(r'.*film source: 29.97.*')
-            x = rezre.search(output.lower())
-            if x:
-                debug('film source: 29.97 setting vFps to 29.97')
-                vInfo['vFps'] = '29.97'
-            else:
-                # for build 8047:
-                rezre = re.compile(r'.*frame rate differs from container ' +
-                                   r'frame rate: 29.97.*')
-                debug('Bug in VideoReDo')
-                x = rezre.search(output.lower())
-                if x:
-                    vInfo['vFps'] = '29.97'
-    else:
-        vInfo['vFps'] = ''
-        vInfo['Supported'] = False
-        debug('failed at vFps')
-
-    durre = re.compile(r'.*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),')
-    d = durre.search(output)
-
-    if d:
-        vInfo['millisecs'] = ((int(d.group(1)) * 3600 +
-                               int(d.group(2)) * 60 +
-                               int(d.group(3))) * 1000 +
-                              int(d.group(4)) * (10 ** (3 - len(d.group(4)))))
-    else:
-        vInfo['millisecs'] = 0
-
-    # get bitrate of source for tivo compatibility test.
-    rezre = re.compile(r'.*bitrate: (.+) (?:kb/s).*')
-    x = rezre.search(output)
-    if x:
-        vInfo['kbps'] = x.group(1)
-    else:
-        # Fallback method of getting video bitrate
-        # Sample line:  Stream #0.0[0x1e0]: Video: mpeg2video, yuv420p,
-        #               720x480 [PAR 32:27 DAR 16:9], 9800 kb/s, 59.94 tb(r)
-        rezre = re.compile(r'.*Stream #0\.0\[.*\]: Video: mpeg2video, ' +
-                           r'\S+, \S+ \[.*\], (\d+) (?:kb/s).*')
-        x = rezre.search(output)
-        if x:
-            vInfo['kbps'] = x.group(1)
-        else:
-            vInfo['kbps'] = None
-            debug('failed at kbps')
-
-    # get par.
-    rezre = re.compile(r'.*Video: .+PAR ([0-9]+):([0-9]+) DAR [0-9:]+.*')
-    x = rezre.search(output)
-    if x and x.group(1) != "0" and x.group(2) != "0":
-        vInfo['par1'] = x.group(1) + ':' + x.group(2)
-        vInfo['par2'] = float(x.group(1)) / float(x.group(2))
-    else:
-        vInfo['par1'], vInfo['par2'] = None, None
-
-    # get dar.
-    rezre = re.compile(r'.*Video: .+DAR ([0-9]+):([0-9]+).*')
-    x = rezre.search(output)
-    if x and x.group(1) != "0" and x.group(2) != "0":
-        vInfo['dar1'] = x.group(1) + ':' + x.group(2)
-    else:
-        vInfo['dar1'] = None
-
-    # get Audio Stream mapping.
-    rezre = re.compile(r'([0-9]+[.:]+[0-9]+)(.*): Audio:(.*)')
-    x = rezre.search(output)
-    amap = []
-    if x:
-        for x in rezre.finditer(output):
-            amap.append((x.group(1), x.group(2) + x.group(3)))
-    else:
-        amap.append(('', ''))
-        debug('failed at mapAudio')
-    vInfo['mapAudio'] = amap
-
-    vInfo['par'] = None
-
-    # get Metadata dump (newer ffmpeg).
-    lines = output.split('\n')
-    rawmeta = {}
-    flag = False
-
-    for line in lines:
-        if line.startswith('  Metadata:'):
-            flag = True
-        else:
-            if flag:
-                if line.startswith('  Duration:'):
-                    flag = False
-                else:
-                    try:
-                        key, value = [x.strip() for x in line.split(':', 1)]
-                        try:
-                            value = value.decode('utf-8')
-                        except:
-                            if sys.platform == 'darwin':
-                                value = value.decode('macroman')
-                            else:
-                                value = value.decode('cp1252')
-                        rawmeta[key] = [value]
-                    except:
-                        pass
-
-    vInfo['rawmeta'] = rawmeta
+        if store:
+            store.put(inFile, size, mtime, vInfo)
 
     data = metadata.from_text(inFile)
     for key in data:
@@ -914,6 +1098,95 @@ def video_info(inFile, cache=True):
     debug("; ".join(["%s=%s" % (k, v) for k, v in vInfo.items()]))
     return vInfo
 
+def run_probe(cmd, use_stdout=False):
+    """ Run a probe command and return what it wrote (stderr, or stdout
+        if use_stdout), or None if it didn't finish within ffmpeg_wait.
+
+    """
+    # Windows and other OS buffer 4096 and ffmpeg can output more than that.
+    out_tmp = tempfile.TemporaryFile()
+    with scheduler.acquire(scheduler.PROBE, cmd[-1]):
+        if use_stdout:
+            proc = subprocess.Popen(cmd, stdout=out_tmp,
+                                    stderr=subprocess.PIPE,
+                                    stdin=subprocess.PIPE)
+        else:
+            proc = subprocess.Popen(cmd, stderr=out_tmp,
+                                    stdout=subprocess.PIPE,
+                                    stdin=subprocess.PIPE)
+
+        # wait configured # of seconds: if ffmpeg is not back give up
+        limit = config.getFFmpegWait()
+        if limit:
+            for i in xrange(limit * 20):
+                time.sleep(.05)
+                if not proc.poll() == None:
+                    break
+
+            if proc.poll() == None:
+                kill(proc)
+                out_tmp.close()
+                return None
+        else:
+            proc.communicate()
+
+    out_tmp.seek(0)
+    output = out_tmp.read()
+    out_tmp.close()
+    return output
+
+def ffmpeg_info(inFile):
+    """ Run "ffmpeg -i" on inFile and parse its report. Returns vInfo and
+        whether the probe completed (False if ffmpeg is missing or timed
+        out, in which case vInfo is only a placeholder).
+
+    """
+    fname = unicode(inFile, 'utf-8')
+
+    ffmpeg_path = config.get_bin('ffmpeg')
+    if not ffmpeg_path:
+        vInfo = {'Supported': True}
+        if os.path.splitext(inFile)[1].lower() not in ['.mpg', '.mpeg',
+                                                       '.vob', '.tivo', '.ts']:
+            vInfo['Supported'] = False
+        vInfo.update({'millisecs': 0, 'vWidth': 704, 'vHeight': 480,
+                      'rawmeta': {}})
+        return vInfo, False
+
+    if mswindows:
+        fname = fname.encode('cp1252')
+    output = run_probe([ffmpeg_path, '-i', fname])
+    if output is None:
+        return {'Supported': False}, False
+
+    debug('ffmpeg output=%s' % output)
+    return parse_ffmpeg(output), True
+
+def ffprobe_info(inFile):
+    """ Run ffprobe on inFile and read its JSON report. Returns vInfo and
+        whether the probe completed, like ffmpeg_info(), or None if
+        ffprobe is missing or its report can't be used.
+
+    """
+    ffprobe_path = config.get_bin('ffprobe')
+    if not ffprobe_path:
+        return None
+
+    fname = unicode(inFile, 'utf-8')
+    if mswindows:
+        fname = fname.encode('cp1252')
+    output = run_probe([ffprobe_path, '-v', 'error', '-print_format', 'json',
+                        '-show_streams', '-show_format', fname], True)
+    if output is None:
+        return {'Supported': False}, False
+
+    try:
+        vInfo = parse_ffprobe(json.loads(output))
+    except (ValueError, KeyError, TypeError) as msg:
+        debug('unusable ffprobe output for %s: %s' % (inFile, msg))
+        return None
+    return vInfo, True
+
 def audio_check(inFile, tsn):
     cmd_string = ('-y -c:v mpeg2video -r 29.97 -b:v 1000k -c:a copy ' +
                   select_audiolang(inFile, tsn) + ' -t 00:00:01 -f vob -')
@@ -921,16 +1194,19 @@ def audio_check(inFile, tsn):
     if mswindows:
         fname = fname.encode('cp1252')
     cmd = [config.get_bin('ffmpeg'), '-i', fname] + cmd_string.split()
-    ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE)
     fd, testname = tempfile.mkstemp()
     testfile = os.fdopen(fd, 'wb')
+    job = scheduler.acquire(scheduler.PROBE, fname)
+    ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE)
     try:
         shutil.copyfileobj(ffmpeg.stdout, testfile)
     except:
         kill(ffmpeg)
+        job.release()
         testfile.close()
         vInfo = None
     else:
+        job.release()
         testfile.close()
         vInfo = video_info(testname, False)
     os.remove(testname)
@@ -943,7 +1219,58 @@ def supported_format(inFile):
         debug('FALSE, file not supported %s' % inFile)
         return False
 
+def _probe_worker():
+    while True:
+        inFile = probe_queue.get()
+        try:
+            video_info(inFile)
+        except Exception as msg:
+            logger.error('probe of %s failed: %s' % (inFile, msg))
+        finally:
+            with probe_lock:
+                event = probe_pending.pop(inFile)
+            event.set()
+
+def probe_files(files, budget):
+    """ Probe the files not already in info_cache in parallel, on a
+        fixed set of probe_threads workers. Returns when all of them are
+        cached or after budget seconds, whichever comes first; probes
+        still queued or running then carry on in the background, so
+        their results are ready for the next request.
+
+    """
+    global probe_queue
+
+    events = []
+    with probe_lock:
+        if probe_queue is None:
+            probe_queue = queue.Queue()
+            for i in range(config.getProbeThreads()):
+                thread = threading.Thread(target=_probe_worker,
+                                          name='probe-%d' % i)
+                thread.daemon = True
+                thread.start()
+        for inFile in files:
+            if inFile in info_cache:
+                continue
+            event = probe_pending.get(inFile)
+            if not event:
+                event = threading.Event()
+                probe_pending[inFile] = event
+                probe_queue.put(inFile)
+            events.append(event)
+
+    deadline = time.time() + budget
+    for event in events:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not event.wait(remaining):
+            break
+
 def kill(popen):
+    if not popen.pid:
+        # A tivodecoder.DecodeThread, not a process
+        popen.kill()
+        return
     debug('killing pid=%s' % str(popen.pid))
     if mswindows:
         win32kill(popen.pid)
@@ -0,0 +1,236 @@
+""" Disk cache of transcoded output.
+
+    transcode.transcode() tees what ffmpeg produces into a file here,
+    keyed by everything that determines the output: the source path and
+    mtime, the TiVo class, the requested mime type and the ffmpeg
+    settings. A finished file can then be replayed, from any offset,
+    instead of running ffmpeg again, and one that is still being written
+    lets a resume reach back past the in-memory window.
+
+    The cache is held to a disk budget by dropping the least recently
+    used files.
+
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger('pyTivo.video.transcodecache')
+
+EXT = '.mpg'
+PART = '.part'
+
+def make_key(inFile, tsn, mime, settings):
+    mtime = os.path.getmtime(inFile)
+    key = '\0'.join([inFile, repr(mtime), config.get_section(tsn), mime] +
+                    list(settings))
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+class Writer(object):
+    """ Appends one transcode's output to its .part file, which becomes
+        a cache entry when finish() is called.
+
+    """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.path = os.path.join(cache.path, key + PART)
+        self.f = open(self.path, 'wb')
+        self.size = 0
+        self.done = False
+        self.aborted = False
+
+    def write(self, block):
+        if self.done:
+            return
+        try:
+            self.f.write(block)
+        except (IOError, OSError) as msg:
+            logger.error('Writing %s: %s' % (self.path, msg))
+            self.abort()
+            return
+        self.size += len(block)
+        if not self.cache.grow(len(block), self.size):
+            logger.info('Transcode of %s exceeds the cache budget' %
+                        self.key)
+            self.abort()
+
+    def read_range(self, offset, count):
+        """ Return up to count bytes from offset in what's been written
+            so far.
+
+        """
+        if self.aborted:
+            return b''
+        if not self.done:
+            self.f.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(count)
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.f.close()
+        final = os.path.join(self.cache.path, self.key + EXT)
+        try:
+            os.rename(self.path, final)
+        except OSError as msg:
+            logger.error('Saving %s: %s' % (final, msg))
+            self._remove()
+            self.cache.finished(self, False)
+            return
+        self.path = final
+        self.cache.finished(self, True)
+
+    def abort(self):
+        if self.done:
+            return
+        self.done = True
+        self.aborted = True
+        self.f.close()
+        self._remove()
+        self.cache.finished(self, False)
+
+    def _remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class TranscodeCache(object):
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> size, oldest use first
+        self.writers = {}
+        self.used = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        found = []
+        for name in os.listdir(path):
+            fname = os.path.join(path, name)
+            if name.endswith(PART):
+                # Left over from an interrupted run
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+            elif name.endswith(EXT):
+                st = os.stat(fname)
+                found.append((st.st_mtime, name[:-len(EXT)], st.st_size))
+        for mtime, key, size in sorted(found):
+            self.entries[key] = size
+            self.used += size
+        with self.lock:
+            self._evict()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def lookup(self, key):
+        """ Return the path of the finished entry for key, or None. """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = os.path.join(self.path, key + EXT)
+        try:
+            # The file's mtime is its last use, for LRU order on restart
+            os.utime(path, None)
+        except OSError:
+            with self.lock:
+                if key in self.entries:
+                    self._drop(key)
+            return None
+        return path
+
+    def create(self, key):
+        """ Return a Writer for key, or None if it is already cached or
+            being written.
+
+        """
+        with self.lock:
+            if key in self.entries or key in self.writers:
+                return None
+            try:
+                writer = Writer(self, key)
+            except (IOError, OSError) as msg:
+                logger.error('Unable to cache transcode: %s' % msg)
+                return None
+            self.writers[key] = writer
+            return writer
+
+    def grow(self, length, size):
+        """ Account for length more bytes written to an entry now size
+            bytes long, evicting to make room. False if the entry alone
+            is over budget.
+
+        """
+        with self.lock:
+            self.used += length
+            if size > self.budget:
+                return False
+            self._evict()
+            return True
+
+    def finished(self, writer, keep):
+        with self.lock:
+            self.writers.pop(writer.key, None)
+            if keep:
+                self.entries[writer.key] = writer.size
+            else:
+                self.used -= writer.size
+
+    def _drop(self, key):
+        size = self.entries.pop(key)
+        self.used -= size
+        try:
+            os.remove(os.path.join(self.path, key + EXT))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.used > self.budget and self.entries:
+            key = next(iter(self.entries))
+            self._drop(key)
+            logger.debug('evicted cached transcode %s' % key)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'writing': len(self.writers),
+                    'bytes': self.used, 'budget': self.budget}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """ Return the shared TranscodeCache, or None if transcode caching is
+        turned off or the cache directory can't be used.
+
+    """
+    global _cache
+    if not config.getTranscodeCache():
+        return None
+    with _cache_lock:
+        if _cache is None:
+            path = os.path.join(config.getCacheDir(), 'transcode')
+            try:
+                _cache = TranscodeCache(path, config.getTranscodeCacheSize())
+            except (IOError, OSError) as msg:
+                logger.error('Unable to open transcode cache %s: %s' %
+                             (path, msg))
+                return None
+        return _cache
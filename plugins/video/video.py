@@ -18,7 +18,12 @@ from Cheetah.Template import Template
 from lrucache import LRUCache
 
 import config
+import filestream
+import housekeeping
 import metadata
+import pretranscode
+import scheduler
+import tivodecoder
 import transcode
 from plugin import EncodeUnicode, Plugin, quote
 
@@ -51,6 +56,24 @@ LIKELYTS = """.ts .tp .trp .3g2 .3gp .3gp2 .3gpp .m2t .m2ts .mts .mp4
 
 status = {} # Global variable to track uploads
 
+def cleanup_status():
+    """ Drop upload status entries a day after they finish, to keep the
+        status object from getting too big. Run hourly by housekeeping.
+
+    """
+    now = time.time()
+    for tivo in list(status):
+        for file in list(status[tivo]):
+            if not status[tivo][file]['active']:
+                elapsed = now - status[tivo][file]['end']
+                if elapsed >= 86400: # 86400 = one day
+                    del status[tivo][file]
+
+        if len(status[tivo]) < 1:
+            del status[tivo]
+
+housekeeping.every(3600, cleanup_status, name='video status expiry')
+
 use_extensions = True
 try:
     assert(config.get_bin('ffmpeg'))
@@ -72,6 +95,9 @@ class Video(Plugin):
 
     tvbus_cache = LRUCache(1)
 
+    def init(self):
+        pretranscode.start(self)
+
     def video_file_filter(self, full_path, type=None):
         if os.path.isdir(unicode(full_path, 'utf-8')):
             return True
@@ -96,26 +122,18 @@ class Video(Plugin):
         global status
         handler.send_json(json.dumps(status))
 
-    def cleanup_status(self):
-        global status
-
-        now = time.time()
-        for tivo in status.keys():
-            for file in status[tivo].keys():
-                if not status[tivo][file]['active']:
-                    elapsed = now - status[tivo][file]['end']
-                    if elapsed >= 86400: # 86400 = one day
-                        del status[tivo][file]
-
-            if len(status[tivo]) < 1:
-                del status[tivo]
-
+    def GetTranscodeStats(self, handler, query):
+        json_config = {}
+        json_config['resume'] = dict(transcode.resume_stats,
+                                     rate=transcode.resume_hit_rate())
+        json_config['housekeeping'] = [
+            {'task': name, 'due': round(delay, 1)}
+            for delay, name in housekeeping.deadlines()]
+        handler.send_json(json.dumps(json_config))
 
     def send_file(self, handler, path, query):
         global status
 
-        self.cleanup_status() # Keep status object from getting too big
-
         mime = 'video/x-tivo-mpeg'
         tsn = handler.headers.getheader('tsn', '')
 
@@ -151,31 +169,41 @@ class Video(Plugin):
         has_tivolibre = bool(config.get_bin('tivolibre'))
         has_tivodecode = bool(config.get_bin('tivodecode'))
 
+        # Decrypting in pyTivo stands in for tivolibre
+        python_decoder = is_tivo_file and tivodecoder.use_python(is_tivo_ts)
+
         use_tivolibre = False
         tivolibre_upload = bool(config.get_server('tivolibre_upload', 'true') == 'true')
-        if has_tivolibre and tivolibre_upload:
+        if (has_tivolibre or python_decoder) and tivolibre_upload:
             use_tivolibre = True
 
         if 'Format' in query:
             mime = query['Format'][0]
 
-        needs_converion = (((is_tivo_file and is_tivo_ts) or (is_tivo_file and not has_tivolibre)) and mime == 'video/mpeg')
+        needs_converion = (((is_tivo_file and is_tivo_ts) or (is_tivo_file and not (has_tivolibre or python_decoder))) and mime == 'video/mpeg')
         compatible = (not needs_converion and
                       transcode.tivo_compatible(path, tsn, mime)[0])
 
+        # An encode made ahead of time plays like a compatible file
+        ready = None
+        if not compatible and not is_tivo_file:
+            ready = pretranscode.lookup(path, tsn, mime)
+
         try:  # "bytes=XXX-"
             offset = int(handler.headers.getheader('Range')[6:-1])
         except:
             offset = 0
 
         if needs_converion:
-            valid = bool((has_tivodecode or has_tivolibre) and tivo_mak)
+            valid = bool((has_tivodecode or has_tivolibre or python_decoder) and tivo_mak)
         else:
             valid = True
 
         if valid and offset:
             valid = ((compatible and offset < os.path.getsize(path)) or
-                     (not compatible and transcode.is_resumable(path, offset)))
+                     (ready and offset < os.path.getsize(ready)) or
+                     (not (compatible or ready) and
+                      transcode.is_resumable(path, offset, tsn, mime)))
 
             if status[tivo_name][path]:
                 valid = (offset != status[tivo_name][path]['offset']) # Don't let the TiVo loop over and over in the same spot
@@ -189,17 +217,33 @@ class Video(Plugin):
         if faking:
             thead = self.tivo_header(tsn, path, mime)
 
-        size = os.path.getsize(fname) + len(thead)
-        if compatible:
-            handler.send_response(206)
-            handler.send_header('Content-Length', size - offset)
-            handler.send_header('Content-Range', 'bytes %d-%d/%d' % 
-                                (offset, size - offset - 1, size))
-        else:
-            handler.send_response(206)
-            handler.send_header('Transfer-Encoding', 'chunked')
-        handler.send_header('Content-Type', mime)
-        handler.end_headers()
+        # Take the ffmpeg slot now, while the TiVo can still be told
+        # to come back later
+        job = None
+        if valid and not (compatible or ready or offset):
+            try:
+                job = transcode.reserve(path, is_tivo_file, tsn)
+            except scheduler.Busy as msg:
+                logger.info(msg)
+                handler.send_busy()
+                return
+
+        try:
+            size = os.path.getsize(ready or fname) + len(thead)
+            if compatible or ready:
+                handler.send_response(206)
+                handler.send_header('Content-Length', size - offset)
+                handler.send_header('Content-Range', 'bytes %d-%d/%d' % 
+                                    (offset, size - offset - 1, size))
+            else:
+                handler.send_response(206)
+                handler.send_header('Transfer-Encoding', 'chunked')
+            handler.send_header('Content-Type', mime)
+            handler.end_headers()
+        except:
+            if job:
+                job.release()
+            raise
 
         logger.info('[%s] Start sending "%s" to %s' %
                     (time.strftime('%d/%b/%Y %H:%M:%S'), fname, tivo_name))
@@ -222,52 +266,40 @@ class Video(Plugin):
                 logger.debug('"%s" is tivo compatible' % fname)
                 f = open(fname, 'rb')
                 tivolibre = None
-                if not offset:
-                    if faking:
-                        handler.wfile.write(thead)
-                        count += len(thead)
-                        output += len(thead)
-                    elif tivo_header_size > 0:
-                        block = f.read(tivo_header_size)
-                        handler.wfile.write(block)
-                        count += len(block)
-                        output += len(block)
+                prefix = thead
                 try:
                     if is_tivo_file and use_tivolibre:
                         status[tivo_name][path]['decrypting'] = True
 
-                        f.close()
-                        tivolibre_path = config.get_bin('tivolibre')
-                        tcmd = [tivolibre_path, '-m', tivo_mak, '-i', fname]
-                        tivolibre = subprocess.Popen(tcmd, stdout=subprocess.PIPE, bufsize=(512 * 1024))
-                        f = tivolibre.stdout
-
-                    if offset:
-                        if tivolibre:
+                        if offset and not python_decoder:
                             raise Exception('tivolibre does not support offset')
-                        offset -= len(thead)
-                        f.seek(offset)
-
-                    while True:
-                        block = f.read(512 * 1024)
-                        if not block:
-                            break
-                        handler.wfile.write(block)
-                        count += len(block)
-                        output += len(block)
-
-                        now = time.time()
-                        elapsed = now - last_interval
-                        if elapsed >= 1:
-                            status[tivo_name][path]['rate'] = (count * 8.0) / elapsed
-                            status[tivo_name][path]['output'] += count
-                            count = 0
-                            last_interval = now
+
+                        # The header goes out as-is, ahead of the
+                        # decrypted stream
+                        if tivo_header_size > 0:
+                            prefix = f.read(tivo_header_size)
+                        f.close()
+                        if python_decoder:
+                            # The decrypted stream is the same size as the
+                            # encrypted one, so offsets carry straight over
+                            skip = max(offset - len(prefix), 0)
+                            prefix = prefix[offset:]
+                            offset = 0
+                            f = tivodecoder.Reader(tivodecoder.decode(
+                                open(fname, 'rb'), tivo_mak, skip))
+                        else:
+                            tivolibre_path = config.get_bin('tivolibre')
+                            tcmd = [tivolibre_path, '-m', tivo_mak, '-i', fname]
+                            tivolibre = subprocess.Popen(tcmd, stdout=subprocess.PIPE, bufsize=(512 * 1024))
+                            f = tivolibre.stdout
+
+                    count = filestream.stream_file(handler, f, offset,
+                        prefix=prefix, status=status[tivo_name][path])
 
                     if tivolibre:
                         tivolibre.wait()
 
-                except Exception, msg:
+                except Exception as msg:
                     status[tivo_name][path]['error'] = str(msg)
                     if tivolibre:
                         tivolibre.kill()
@@ -276,15 +308,26 @@ class Video(Plugin):
                     logger.info(msg)
 
                 f.close()
+            elif ready:
+                logger.debug('sending pretranscoded "%s"' % ready)
+                try:
+                    with open(ready, 'rb') as f:
+                        count = filestream.stream_file(handler, f, offset,
+                            prefix=thead, status=status[tivo_name][path])
+                except Exception as msg:
+                    status[tivo_name][path]['error'] = str(msg)
+                    logger.info(msg)
             else:
                 status[tivo_name][path]['transcoding'] = True
                 logger.debug('"%s" is not tivo compatible' % fname)
+                pretranscode.request(path, tsn, mime)
                 if offset:
                     count = transcode.resume_transfer(path, handler.wfile,
-                                                      offset, status[tivo_name][path])
+                                                      offset, status[tivo_name][path],
+                                                      tsn, mime, thead)
                 else:
                     count = transcode.transcode(False, path, handler.wfile, status[tivo_name][path],
-                                                is_tivo_file, tsn, mime, thead)
+                                                is_tivo_file, tsn, mime, thead, job)
 
             end_time = time.time()
             elapsed = end_time - status[tivo_name][path]['start']
@@ -302,7 +345,7 @@ class Video(Plugin):
             logger.info('Invalid file "%s" requested by %s' % fname, tivo_name)
 
         try:
-            if not compatible:
+            if not (compatible or ready):
                 handler.wfile.write('0\r\n\r\n')
             handler.wfile.flush()
         except Exception, msg:
@@ -334,18 +377,7 @@ class Video(Plugin):
         return count
 
     def __est_size(self, full_path, tsn='', mime=''):
-        # Size is estimated by taking audio and video bit rate adding 2%
-
-        if transcode.tivo_compatible(full_path, tsn, mime)[0]:
-            return os.path.getsize(unicode(full_path, 'utf-8'))
-        else:
-            # Must be re-encoded
-            audioBPS = config.getMaxAudioBR(tsn) * 1000
-            #audioBPS = config.strtod(config.getAudioBR(tsn))
-            videoBPS = transcode.select_videostr(full_path, tsn)
-            bitrate =  audioBPS + videoBPS
-            return int((self.__duration(full_path) / 1000) *
-                       (bitrate * 1.02 / 8))
+        return transcode.get_plan(full_path, tsn, mime).est_size()
 
     def metadata_full(self, full_path, tsn='', mime='', mtime=None):
         data = {}
@@ -371,12 +403,12 @@ class Video(Plugin):
             data['episodeNumber'] = str(ep)
 
         if config.getDebug() and 'vHost' not in data:
-            compatible, reason = transcode.tivo_compatible(full_path, tsn, mime)
+            plan = transcode.get_plan(full_path, tsn, mime)
+            compatible, reason = plan.verdict()
             if compatible:
                 transcode_options = []
             else:
-                transcode_options = transcode.transcode(True, full_path,
-                                                        '', None, False, tsn, mime)
+                transcode_options = plan.settings()
             data['vHost'] = (
                 ['TRANSCODE=%s, %s' % (['YES', 'NO'][compatible], reason)] +
                 ['SOURCE INFO: '] +
@@ -442,6 +474,10 @@ class Video(Plugin):
                                              self.video_file_filter,
                                              force_alpha, allow_recurse)
 
+        if len(files) > 1:
+            transcode.probe_files([f.name for f in files if not f.isdir],
+                                  config.getProbeBudget())
+
         videos = []
         local_base_path = self.get_local_base_path(handler, query)
         for f in files:
@@ -477,10 +513,7 @@ class Video(Plugin):
                     video['valid'] = True
                     video.update(metadata.basic(f.name, mtime))
 
-                if self.use_ts(tsn, f.name):
-                    video['mime'] = 'video/x-tivo-mpeg-ts'
-                else:
-                    video['mime'] = 'video/x-tivo-mpeg'
+                video['mime'] = self.offered_mime(tsn, f.name)
 
                 video['textSize'] = metadata.human_size(f.size)
 
@@ -499,6 +532,11 @@ class Video(Plugin):
         t.tivos = config.tivos
         handler.send_xml(str(t))
 
+    def offered_mime(self, tsn, file_path):
+        if self.use_ts(tsn, file_path):
+            return 'video/x-tivo-mpeg-ts'
+        return 'video/x-tivo-mpeg'
+
     def use_ts(self, tsn, file_path):
         if config.is_ts_capable(tsn):
             ext = os.path.splitext(file_path)[1].lower()
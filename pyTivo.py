@@ -82,6 +82,7 @@ def mainloop():
     httpd = setup()
     serve(httpd)
     httpd.beacon.stop()
+    httpd.server_close()
     return httpd.restart 
 
 if __name__ == '__main__':
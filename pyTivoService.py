@@ -34,6 +34,7 @@ class PyTivoService(win32serviceutil.ServiceFramework):
                 break
 
         httpd.beacon.stop()
+        httpd.server_close()
         return httpd.restart
 
     def SvcDoRun(self):
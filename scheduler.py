@@ -0,0 +1,195 @@
+""" Limit how many ffmpeg processes run at once.
+
+    Every ffmpeg run -- transcodes for playback, probes for file
+    details, thumbnails, overnight encodes -- takes a slot from here
+    first, and gives it back when the process is done. There are as
+    many slots as cores (or ffmpeg_slots). When they're all taken,
+    callers queue, and a freed slot goes to the waiting job with the
+    highest priority class, then to whoever has waited longest.
+
+    A playback slot is held for as long as the stream runs, so when
+    streams hold every slot, probes (needed to browse a container)
+    may still run, up to ffmpeg_probe_slots at a time, rather than
+    wait for a stream to end. A caller that can't wait, such as a
+    request for a stream, gives a timeout and gets Busy when it runs
+    out.
+
+"""
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.scheduler')
+
+# Priority classes, most urgent first
+PLAYBACK = 0
+PROBE = 1
+THUMBNAIL = 2
+BACKGROUND = 3
+
+CLASS_NAMES = {PLAYBACK: 'playback', PROBE: 'probe', THUMBNAIL: 'thumbnail',
+               BACKGROUND: 'background'}
+
+# Waits longer than this (seconds) are logged
+WAIT_LOG = 0.5
+
+class Busy(Exception):
+    """ No ffmpeg slot came free within the timeout. """
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class Job(object):
+    """ A slot held by one ffmpeg run. Release it when the process ends;
+        releasing twice is harmless. Also usable as a context manager.
+
+    """
+    def __init__(self, scheduler, priority, name):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.name = name
+        self.queued = time.time()
+        self.wait = 0
+        self.released = False
+
+    def release(self):
+        self.scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class Scheduler(object):
+    def __init__(self, slots, cores, probe_slots=1):
+        self.slots = slots
+        self.cores = cores
+        self.probe_slots = probe_slots
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.running = []
+        self.seq = itertools.count()
+        # class -> [jobs started, total wait, longest wait]
+        self.waits = dict((x, [0, 0.0, 0.0]) for x in CLASS_NAMES)
+
+    def _fits(self, priority):
+        """ Whether a job of this class may start now. """
+        if len(self.running) < self.slots:
+            return True
+        if priority != PROBE:
+            return False
+        # Every slot is busy: a probe may still go alongside streams
+        probes = 0
+        for job in self.running:
+            if job.priority == PROBE:
+                probes += 1
+            elif job.priority != PLAYBACK:
+                return False
+        return probes < self.probe_slots
+
+    def _next(self):
+        """ The first waiting entry, in order, that may start now. """
+        for entry in sorted(self.waiting):
+            if self._fits(entry[0]):
+                return entry
+        return None
+
+    def acquire(self, priority, name='', timeout=None):
+        """ Wait for a slot and return the Job holding it. With a
+            timeout (seconds), raise Busy if none comes free in time.
+
+        """
+        job = Job(self, priority, name)
+        entry = (priority, next(self.seq), job)
+        with self.cond:
+            heapq.heappush(self.waiting, entry)
+            deadline = timeout is not None and job.queued + timeout
+            while self._next() is not entry:
+                left = deadline and deadline - time.time()
+                if deadline and left <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    # Someone behind may fit now
+                    self.cond.notify_all()
+                    raise Busy('no ffmpeg slot for %s after %ss' %
+                               (name, timeout))
+                self.cond.wait(left or None)
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+            self.running.append(job)
+            job.wait = time.time() - job.queued
+            waits = self.waits[priority]
+            waits[0] += 1
+            waits[1] += job.wait
+            waits[2] = max(waits[2], job.wait)
+            # The next in line may fit in another free slot
+            self.cond.notify_all()
+        if job.wait > WAIT_LOG:
+            logger.debug('%s job waited %.1fs for an ffmpeg slot: %s' %
+                         (CLASS_NAMES[priority], job.wait, name))
+        return job
+
+    def release(self, job):
+        with self.cond:
+            if job.released:
+                return
+            job.released = True
+            self.running.remove(job)
+            self.cond.notify_all()
+
+    def thread_share(self):
+        """ ffmpeg -threads for a new playback transcode: the cores split
+            evenly among the running transcodes.
+
+        """
+        with self.cond:
+            streams = len([x for x in self.running
+                           if x.priority == PLAYBACK])
+        return max(1, self.cores // max(1, streams))
+
+    def stats(self):
+        with self.cond:
+            result = {'slots': self.slots, 'cores': self.cores,
+                      'probe_slots': self.probe_slots}
+            for priority, cname in CLASS_NAMES.items():
+                started, total, longest = self.waits[priority]
+                result[cname] = {
+                    'running': len([x for x in self.running
+                                    if x.priority == priority]),
+                    'queued': len([x for x in self.waiting
+                                   if x[0] == priority]),
+                    'started': started,
+                    'mean_wait': started and total / started or 0.0,
+                    'max_wait': longest}
+            return result
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            cores = cpu_count()
+            _scheduler = Scheduler(config.getFFmpegSlots() or cores, cores,
+                                   config.getFFmpegProbeSlots())
+        return _scheduler
+
+def acquire(priority, name='', timeout=None):
+    return get_scheduler().acquire(priority, name, timeout)
+
+def thread_share():
+    return get_scheduler().thread_share()
+
+def stats():
+    return get_scheduler().stats()
@@ -0,0 +1,387 @@
+""" Decrypt .tivo program streams in pyTivo, without tivodecode.
+
+    A .tivo file is a short header, a few metadata chunks, and then an
+    MPEG program stream in which the payload of each audio and video
+    packet is Turing encrypted. The stream key is the SHA-1 of the MAK
+    and the plaintext metadata chunk; each elementary stream is rekeyed
+    from it, by stream id and block number, whenever a packet's private
+    header starts a new block, and otherwise carries on with the same
+    keystream. Decryption doesn't change the size of anything, so the
+    output is the same length as the stream part of the input, and the
+    TiVo header itself is left out, as tivodecode leaves it out.
+
+    Decoder takes the file in pieces of any size; decode() turns a file
+    object into a generator of decrypted blocks; decode_file() decrypts
+    one file into another, for ToGo's post-processing; and DecodeThread
+    stands in for tivodecode's stdout.
+
+    Only program streams are handled; transport stream .tivo files still
+    need tivolibre or tivodecode.
+
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import threading
+
+import config
+import turing
+
+logger = logging.getLogger('pyTivo.tivodecoder')
+
+BLOCKSIZE = 512 * 1024
+
+HEADER = 16
+
+# Bytes taken by each optional PES header field ahead of the extension
+_OPTIONAL = ((0x80, 5), (0x40, 5), (0x20, 6), (0x10, 3), (0x08, 1),
+             (0x04, 1), (0x02, 2))
+
+class FormatError(Exception):
+    pass
+
+def is_transport_stream(header):
+    """ True if the first HEADER bytes of a .tivo file say it holds a
+        transport stream.
+
+    """
+    return len(header) > 7 and bool(bytearray(header)[7] & 0x20)
+
+def is_ts_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return is_transport_stream(f.read(HEADER))
+    except (IOError, OSError):
+        return False
+
+def use_python(is_ts=False):
+    """ True if .tivo files are decrypted here rather than by tivolibre
+        or tivodecode.
+
+    """
+    if is_ts:
+        return False
+    decoder = config.getTivoDecoder()
+    if decoder == 'auto':
+        return not (config.get_bin('tivolibre') or config.get_bin('tivodecode'))
+    return decoder == 'python'
+
+def stream_key(mak, header):
+    """ The stream key, from the MAK and the header of a .tivo file, up
+        to the start of the stream.
+
+    """
+    if header[:4] != b'TiVo':
+        raise FormatError('not a .tivo file')
+    chunks = struct.unpack('>H', header[14:16])[0]
+    key = None
+    pos = HEADER
+    for i in range(chunks):
+        if pos + 12 > len(header):
+            raise FormatError('truncated header')
+        chunk_size, data_size, id, enc = struct.unpack('>LLHH',
+                                                       header[pos:pos + 12])
+        if not enc:
+            data = bytes(header[pos + 12:pos + 12 + data_size])
+            key = hashlib.sha1(mak.encode('utf-8') + data).digest()
+        if chunk_size < 12:
+            raise FormatError('bad chunk size')
+        pos += chunk_size
+    if key is None:
+        raise FormatError('no plaintext metadata chunk')
+    return key
+
+def parse_private(data):
+    """ The block number in the 16 bytes of PES private data that a TiVo
+        puts ahead of each encrypted block, or None if the marker bits
+        say it isn't one.
+
+    """
+    if not (data[0] & 0x80 and data[1] & 0x40 and data[3] & 0x20 and
+            data[4] & 0x10):
+        return None
+    return (((data[1] & 0x3f) << 18) | (data[2] << 10) |
+            ((data[3] & 0xc0) << 2) | ((data[3] & 0x1f) << 3) |
+            ((data[4] & 0xe0) >> 5))
+
+class KeyStream(object):
+    """ The keystream of one elementary stream. The Turing key depends
+        only on the stream id, so the S-boxes are built once; each new
+        block just loads a new IV.
+
+    """
+    def __init__(self, key, stream_id):
+        self.key = bytearray(key[:16] + struct.pack('>L', stream_id << 24))
+        self.turing = turing.Turing(hashlib.sha1(self.key[:17]).digest())
+        self.block_id = None
+        self.left = b''         # the unused end of the last round
+
+    def start(self, block_id):
+        self.key[17:] = struct.pack('>L', block_id & 0xffffff)[1:]
+        self.turing.loadiv(hashlib.sha1(self.key).digest())
+        self.block_id = block_id
+        self.left = b''
+
+    def take(self, count):
+        data = self.left
+        if len(data) < count:
+            need = count - len(data)
+            data += self.turing.gen(0, (need + 19) // 20 * 20)
+        self.left = data[count:]
+        return data[:count]
+
+    def skip(self, count):
+        if count <= len(self.left):
+            self.left = self.left[count:]
+            return
+        count -= len(self.left)
+        end = (count + 19) // 20 * 20
+        self.left = self.turing.gen(count, end - count)
+
+class Decoder(object):
+    """ Turns a .tivo program stream, fed in pieces with feed(), into
+        the plain MPEG stream. Output before offset is dropped, without
+        the work of decrypting it.
+
+    """
+    def __init__(self, mak, offset=0):
+        self.mak = mak
+        self.offset = offset
+        self.buf = bytearray()
+        self.key = None
+        self.start = None       # where the stream begins in the input
+        self.pos = 0            # output bytes so far, including dropped
+        self.streams = {}       # stream id -> KeyStream
+        self.unkeyed = set()
+        self.out = []
+
+    def feed(self, data):
+        """ Add the next piece of input; returns what output it
+            completes.
+
+        """
+        self.buf += data
+        if self.key is None and not self._header():
+            return b''
+        self._packets()
+        return self._output()
+
+    def finish(self):
+        """ Whatever is left once the input is done. """
+        if self.key is None:
+            if self.buf:
+                raise FormatError('truncated header')
+            return b''
+        self._emit(self.buf)
+        del self.buf[:]
+        return self._output()
+
+    def _header(self):
+        if self.start is None:
+            if len(self.buf) < HEADER:
+                return False
+            if is_transport_stream(self.buf[:HEADER]):
+                raise FormatError('transport streams are not supported')
+            self.start = struct.unpack('>L', bytes(self.buf[10:14]))[0]
+        if len(self.buf) < self.start:
+            return False
+        self.key = stream_key(self.mak, bytes(self.buf[:self.start]))
+        del self.buf[:self.start]
+        return True
+
+    def _output(self):
+        result = b''.join(self.out)
+        self.out = []
+        return result
+
+    def _emit(self, data):
+        end = self.pos + len(data)
+        if end > self.offset:
+            if self.pos < self.offset:
+                data = data[self.offset - self.pos:]
+            self.out.append(bytes(data))
+        self.pos = end
+
+    def _packets(self):
+        buf = self.buf
+        size = len(buf)
+        p = 0
+        while size - p >= 6:
+            if buf[p] or buf[p + 1] or buf[p + 2] != 1:
+                # Out of step; pass everything up to the next start code
+                q = buf.find(b'\0\0\1', p + 1)
+                if q < 0:
+                    q = size - 2
+                self._emit(buf[p:q])
+                p = q
+                continue
+            code = buf[p + 3]
+            if code == 0xba:
+                if size - p < 14:
+                    break
+                if buf[p + 4] & 0xc0 == 0x40:
+                    length = 14 + (buf[p + 13] & 7)
+                else:
+                    length = 12     # MPEG-1
+            elif code == 0xb9:
+                length = 4
+            elif code > 0xba:
+                length = 6 + ((buf[p + 4] << 8) | buf[p + 5])
+            else:
+                q = buf.find(b'\0\0\1', p + 1)
+                if q < 0:
+                    q = size - 2
+                self._emit(buf[p:q])
+                p = q
+                continue
+            if size - p < length:
+                break
+            packet = buf[p:p + length]
+            if ((code == 0xbd or 0xc0 <= code <= 0xef) and length > 9 and
+                packet[6] & 0xf0 == 0xb0):
+                self._decrypt(packet, code)
+            self._emit(packet)
+            p += length
+        del buf[:p]
+
+    def _decrypt(self, packet, code):
+        """ Decrypt one scrambled MPEG-2 PES packet in place. """
+        flags = packet[7]
+        end = 9 + packet[8]
+        stream = self.streams.get(code)
+        if flags & 0x01:
+            ext = 9 + sum(size for bit, size in _OPTIONAL if flags & bit)
+            if ext + 17 <= end and packet[ext] & 0x80:
+                block_id = parse_private(packet[ext + 1:ext + 17])
+                if block_id is not None:
+                    if stream is None:
+                        stream = KeyStream(self.key, code)
+                        self.streams[code] = stream
+                    if stream.block_id != block_id:
+                        stream.start(block_id)
+                    # Four bytes of keystream go to a check word
+                    stream.skip(4)
+        if stream is None:
+            if code not in self.unkeyed:
+                logger.debug('Stream %02x is scrambled, with no key yet' %
+                             code)
+                self.unkeyed.add(code)
+            return
+        packet[6] &= 0xcf
+        count = len(packet) - end
+        if count <= 0:
+            return
+        if self.pos + len(packet) <= self.offset:
+            stream.skip(count)
+            return
+        mask = stream.take(count)
+        packet[end:] = (int.from_bytes(packet[end:], 'big') ^
+                        int.from_bytes(mask, 'big')).to_bytes(count, 'big')
+
+def decode(f, mak, offset=0, blocksize=BLOCKSIZE):
+    """ Yield the decrypted stream of the .tivo file object f, which can
+        be a file or an HTTP response, starting offset bytes in.
+
+    """
+    decoder = Decoder(mak, offset)
+    while True:
+        data = f.read(blocksize)
+        if not data:
+            break
+        output = decoder.feed(data)
+        if output:
+            yield output
+    output = decoder.finish()
+    if output:
+        yield output
+
+def decode_file(src, dest, mak):
+    """ Decrypt the .tivo file at src into dest. """
+    with open(src, 'rb') as f:
+        with open(dest, 'wb') as out:
+            for block in decode(f, mak):
+                out.write(block)
+
+class Reader(object):
+    """ File-like read() over the blocks from decode(). """
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.left = b''
+
+    def read(self, count=-1):
+        result = []
+        have = 0
+        while count < 0 or have < count:
+            if not self.left:
+                self.left = next(self.blocks, b'')
+                if not self.left:
+                    break
+            if count < 0:
+                piece = self.left
+            else:
+                piece = self.left[:count - have]
+            self.left = self.left[len(piece):]
+            result.append(piece)
+            have += len(piece)
+        return b''.join(result)
+
+    def close(self):
+        self.blocks.close()
+
+class DecodeThread(object):
+    """ Takes the place of a tivodecode process: decrypts path in a
+        thread, into a pipe read through stdout, so the output can go
+        to ffmpeg's stdin or into a transcode Session. There's no pid;
+        stop it with kill().
+
+    """
+    pid = None
+
+    def __init__(self, path, mak, offset=0):
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, 'rb', BLOCKSIZE)
+        self.pipe = os.fdopen(w, 'wb')
+        self.returncode = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run,
+                                       args=(path, mak, offset),
+                                       name='tivodecoder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, path, mak, offset):
+        code = 1
+        try:
+            with open(path, 'rb') as f:
+                for block in decode(f, mak, offset):
+                    if self.stopped:
+                        break
+                    self.pipe.write(block)
+            if not self.stopped:
+                code = 0
+        except (IOError, OSError, FormatError) as msg:
+            if not self.stopped:
+                logger.error('Decrypting %s: %s' % (path, msg))
+        finally:
+            try:
+                self.pipe.close()
+            except (IOError, OSError):
+                pass
+            self.returncode = code
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.thread.join()
+        return self.returncode
+
+    def kill(self):
+        # Closing our end of the pipe unblocks a write to a full one
+        self.stopped = True
+        try:
+            self.stdout.close()
+        except (IOError, OSError, ValueError):
+            pass
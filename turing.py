@@ -62,15 +62,30 @@
     A Python implementation of Qualcomm's Turing pseudo-random number
     generator. Loosely based on Greg Rose's TuringFast.c et al. This is
     immensely slower than the C version, but useful for some limited
-    purposes. For Python 2.5 through 2.7.
+    purposes.
+
+    Turing is the one to use. SimpleTuring is the original, direct
+    rendering of the algorithm, kept to check Turing against: Turing
+    walks the LFSR in place with a moving index, runs whole batches of
+    rounds with everything in local variables, and XORs the data in one
+    operation, using NumPy when it's available.
 
 """
 
 __author__ = 'William McBrine <wmcbrine@gmail.com>'
 __version__ = '1.5'
 
-from itertools import izip
-from struct import pack, unpack
+from struct import pack, pack_into, unpack
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # 8->32 _SBOX generated by Millan et. al. at Queensland University of
 # Technology. See: E. Dawson, W. Millan, L. Burnett, G. Carter, "On the
@@ -237,7 +252,7 @@ class KeyLengthError(Exception):
 class IVLengthError(Exception):
     pass
 
-class Turing(object):
+class SimpleTuring(object):
     def __init__(self, key=None, iv=None):
         self.sbox = [[], [], [], []]  # precalculated S-boxes
 
@@ -271,7 +286,7 @@ class Turing(object):
             sh1 = 8 * l
             sh2 = 24 - sh1
             mask = (0xff << sh2) ^ 0xffffffff
-            for j in xrange(256):
+            for j in range(256):
                 w = 0
                 k = j
                 for i, key in enumerate(mkey):
@@ -337,7 +352,7 @@ class Turing(object):
         while skip > 20:
             self._step(5)
             skip -= 20
-        buf = ''
+        buf = b''
         while len(buf) < length + skip:
             buf += self._round()
         return buf[skip:length + skip]
@@ -353,3 +368,163 @@ class Turing(object):
         d2 = unpack(fmt, source)
         x2 = unpack(fmt, xor_data)
         return pack(fmt, *(a ^ b for a, b in izip(d2, x2)))
+
+# Word positions in the circular LFSR: _INDEX[p][k] is where word k is
+# when word 0 is at p
+_INDEX = tuple(tuple((p + k) % _LFSRLEN for k in range(_LFSRLEN))
+               for p in range(_LFSRLEN))
+
+# _QBOX rotated left by each possible amount, and cut to 32 bits
+_QROT = tuple(tuple(_rotl(q, r) & 0xffffffff for q in _QBOX)
+              for r in range(32))
+
+# Below this many bytes, XOR as big integers rather than with NumPy
+_NUMPY_MIN = 4096
+
+class Turing(SimpleTuring):
+    """ Same API and output as SimpleTuring, several times faster. The
+        LFSR never moves; self.pos marks where word 0 is.
+
+    """
+    def __init__(self, key=None, iv=None):
+        self.reg = [0] * _LFSRLEN
+        self.pos = 0
+        SimpleTuring.__init__(self, key, iv)
+
+    @property
+    def lfsr(self):
+        """ The LFSR words, in order """
+        return [self.reg[i] for i in _INDEX[self.pos]]
+
+    @lfsr.setter
+    def lfsr(self, words):
+        self.reg = list(words)
+        self.pos = 0
+
+    def setkey(self, key):
+        keylength = len(key)
+        if keylength & 3 or keylength > _MAXKEY:
+            raise KeyLengthError
+        fmt = '>%dL' % (keylength // 4)
+        mkey = _mixwords([_fixed_strans(n) for n in unpack(fmt, key)])
+
+        # build S-box lookup tables, as SimpleTuring does
+        sbox = []
+        for l in range(4):
+            sh1 = 8 * l
+            sh2 = 24 - sh1
+            mask = (0xff << sh2) ^ 0xffffffff
+            keybytes = [(key >> sh2) & 0xff for key in mkey]
+            rots = _QROT[sh1:sh1 + len(mkey)]
+            table = []
+            for j in range(256):
+                w = 0
+                k = j
+                for kb, rot in zip(keybytes, rots):
+                    k = _SBOX[kb ^ k]
+                    w ^= rot[k]
+                table.append((w & mask) | (k << sh2))
+            sbox.append(tuple(table))
+
+        self.sbox = sbox
+        self.mkey = mkey
+
+    def _step(self, n=1):
+        reg, pos = self.reg, self.pos
+        while n:
+            ix = _INDEX[pos]
+            oldw = reg[pos]
+            reg[pos] = (reg[ix[15]] ^ reg[ix[4]] ^
+                        ((oldw & 0xffffff) << 8) ^ _MULTAB[oldw >> 24])
+            pos = ix[1]
+            n -= 1
+        self.pos = pos
+
+    def _rounds(self, count):
+        """ The words of count rounds of output """
+        reg, pos = self.reg, self.pos
+        s0, s1, s2, s3 = self.sbox
+        multab = _MULTAB
+        index = _INDEX
+        words = []
+        extend = words.extend
+        for r in range(count):
+            ix = index[pos]
+            oldw = reg[pos]
+            reg[pos] = (reg[ix[15]] ^ reg[ix[4]] ^
+                        ((oldw & 0xffffff) << 8) ^ multab[oldw >> 24])
+            pos = ix[1]
+
+            ix = index[pos]
+            a, b, c, d, e = (reg[ix[16]], reg[ix[13]], reg[ix[6]],
+                             reg[ix[1]], reg[ix[0]])
+            t = a + b + c + d + e
+            a = (a + t) & 0xffffffff
+            b = (b + t) & 0xffffffff
+            c = (c + t) & 0xffffffff
+            d = (d + t) & 0xffffffff
+            e = t & 0xffffffff
+
+            # the keyed S-boxes, with the bytes of b, c and d rotated
+            a = (s0[a >> 24] ^ s1[(a >> 16) & 0xff] ^
+                 s2[(a >> 8) & 0xff] ^ s3[a & 0xff])
+            b = (s0[(b >> 16) & 0xff] ^ s1[(b >> 8) & 0xff] ^
+                 s2[b & 0xff] ^ s3[b >> 24])
+            c = (s0[(c >> 8) & 0xff] ^ s1[c & 0xff] ^
+                 s2[c >> 24] ^ s3[(c >> 16) & 0xff])
+            d = (s0[d & 0xff] ^ s1[d >> 24] ^
+                 s2[(d >> 16) & 0xff] ^ s3[(d >> 8) & 0xff])
+            e = (s0[e >> 24] ^ s1[(e >> 16) & 0xff] ^
+                 s2[(e >> 8) & 0xff] ^ s3[e & 0xff])
+            t = a + b + c + d + e
+            a = (a + t) & 0xffffffff
+            b = (b + t) & 0xffffffff
+            c = (c + t) & 0xffffffff
+            d = (d + t) & 0xffffffff
+            e = t & 0xffffffff
+
+            for i in (0, 1, 2):
+                ix = index[pos]
+                oldw = reg[pos]
+                reg[pos] = (reg[ix[15]] ^ reg[ix[4]] ^
+                            ((oldw & 0xffffff) << 8) ^ multab[oldw >> 24])
+                pos = ix[1]
+
+            ix = index[pos]
+            extend(((a + reg[ix[14]]) & 0xffffffff,
+                    (b + reg[ix[12]]) & 0xffffffff,
+                    (c + reg[ix[8]]) & 0xffffffff,
+                    (d + reg[ix[1]]) & 0xffffffff,
+                    (e + reg[pos]) & 0xffffffff))
+
+            oldw = reg[pos]
+            reg[pos] = (reg[ix[15]] ^ reg[ix[4]] ^
+                        ((oldw & 0xffffff) << 8) ^ multab[oldw >> 24])
+            pos = ix[1]
+        self.pos = pos
+        return words
+
+    def _round(self):
+        return pack('>5L', *self._rounds(1))
+
+    def gen(self, skip, length):
+        if skip > 20:
+            # Skipped rounds only step the LFSR
+            n = (skip - 1) // 20
+            self._step(5 * n)
+            skip -= 20 * n
+        count = (length + skip + 19) // 20
+        words = self._rounds(count)
+        buf = bytearray(4 * len(words))
+        if words:
+            pack_into('>%dL' % len(words), buf, 0, *words)
+        return bytes(buf[skip:length + skip])
+
+    def crypt(self, source, skip=0):
+        length = len(source)
+        xor_data = self.gen(skip, length)
+        if numpy is not None and length >= _NUMPY_MIN:
+            return (numpy.frombuffer(source, numpy.uint8) ^
+                    numpy.frombuffer(xor_data, numpy.uint8)).tobytes()
+        return (int.from_bytes(source, 'big') ^
+                int.from_bytes(xor_data, 'big')).to_bytes(length, 'big')